@@ -0,0 +1,75 @@
+from data_processing.pre_processing import DataPreprocessor
+
+
+def get_tokens(words):
+    return " ".join([w.text.lower() for w in words])
+
+
+def get_pos_sequence(words):
+    return " ".join([w.xpos for w in words])
+
+
+def get_tags(words, sought_after_tokens, beg_tag, inside_tag, tag_list=None):
+    if tag_list is None:
+        tags = ["O" for _ in range(len(words))]
+    else:
+        tags = tag_list
+    for i in range(len(words)):
+        if words[i].text == sought_after_tokens[0]:
+            complete_match = True
+            for j in range(len(sought_after_tokens)):
+                if i+j >= len(words) or sought_after_tokens[j] != words[i+j].text:
+                    complete_match = False
+                    break
+            if complete_match:
+                tags[i] = beg_tag
+                for j in range(i+1, i+len(sought_after_tokens)):
+                    tags[j] = inside_tag
+    return tags
+
+
+def get_entity_tags(question_doc, answers, facts_sentences):
+    q_entities = [ent.text for ent in question_doc.entities]
+    q_ent_tags = ["O" for _ in range(question_doc.num_words)]
+    facts_ent_tags = [["O" for _ in range(len(facts_sentences[i].words))] for i in range(len(facts_sentences))]
+    for q_entity in q_entities:
+        q_entity_toks = q_entity.split()
+        # Marks named entities in question
+        q_ent_tags = get_tags(list(question_doc.iter_words()), q_entity_toks, beg_tag="BN", inside_tag="IN",
+                              tag_list=q_ent_tags)
+        # Marks NEs from the question in facts
+        facts_ent_tags = [get_tags(facts_sentences[i].words, q_entity_toks, "BN", "IN", facts_ent_tags[i])
+                          for i in range(len(facts_sentences))]
+    # Overwrites tags with answer tags if any in facts
+    for answer in answers:
+        answer_tokens = answer.lower().split()
+        facts_ent_tags = [get_tags(facts_sentences[i].words, answer_tokens, "BA", "IA", facts_ent_tags[i])
+                          for i in range(len(facts_sentences))]
+    return " ".join(q_ent_tags), [" ".join(f) for f in facts_ent_tags]
+
+
+def get_cases(words):
+    return " ".join(["UP" if word.text[0].isupper() else "LOW" for word in words])
+
+
+def annotated_example(analyzed_question, analyzed_facts, answers):
+    """
+    :param analyzed_question: Stanza document of the base question.
+    :param analyzed_facts: Stanza sentences of the facts.
+    :param answers: Answers to the base question, tagged in the facts.
+    :return: The example's fields of a RepeatQ dataset file, target excepted.
+    """
+    base_question_entity_tags, facts_entity_tags = get_entity_tags(analyzed_question, answers, analyzed_facts)
+    question_words = list(analyzed_question.iter_words())
+    return {
+        "base_question": get_tokens(question_words),
+        "base_question_pos_tags": get_pos_sequence(question_words),
+        "base_question_entity_tags": base_question_entity_tags,
+        "base_question_letter_cases": get_cases(question_words),
+        "base_question_ner": DataPreprocessor.create_ner_sequence(True, question_words),
+        "facts": [get_tokens(fact.words) for fact in analyzed_facts],
+        "facts_entity_tags": facts_entity_tags,
+        "facts_pos_tags": [get_pos_sequence(fact.words) for fact in analyzed_facts],
+        "facts_letter_cases": [get_cases(sentence.words) for sentence in analyzed_facts],
+        "facts_ner": [DataPreprocessor.create_ner_sequence(True, fact.words) for fact in analyzed_facts]
+    }
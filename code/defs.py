@@ -37,4 +37,6 @@ REPEAT_Q_SQUAD_DATA_DIR = f"{REPEAT_Q_DATA_DIR}/squad"
 REPEAT_Q_EMBEDDINGS_FILENAME = "embeddings.npy"
 REPEAT_Q_VOCABULARY_FILENAME = "vocabulary.txt"
 REPEAT_Q_FEATURE_VOCABULARY_FILENAME = "feature_vocabulary.txt"
+REPEAT_Q_LENGTH_BUDGET_FILENAME = "length_budget.json"
+REPEAT_Q_SHORTLIST_CANDIDATES_FILENAME = "shortlist_candidates.npy"
 REPEAT_Q_TRAIN_CHECKPOINTS_DIR = f"{TRAINED_MODELS_DIR}/repeat_q"
@@ -0,0 +1,70 @@
+import os
+import time
+from typing import Callable, Dict, List
+
+import nltk
+import numpy as np
+
+from evaluating.rouge_score import rouge_l_sentence_level
+
+
+def strip_padding(tokens) -> List[str]:
+    """
+    :return: The tokens (as strings) up to the first padding token.
+    """
+    tokens = list(np.asarray(tokens))
+    if 0 in tokens:
+        tokens = tokens[:tokens.index(0)]
+    return [str(t) for t in tokens]
+
+
+def decode_dataset(decode: Callable, data, warmup=True):
+    """
+    Decodes a whole dataset and measures the throughput.
+    :param decode: Function mapping a batch of features to the predicted tokens (ex: `RepeatQ.greedy_decode`).
+    :param data: Dataset of (features, labels) batches.
+    :param warmup: If True, the first batch is decoded once before timing so that tracing isn't measured.
+    :return: The predictions and references (lists of token strings), and the number of examples per second.
+    """
+    predictions, references = [], []
+    elapsed, nb_examples = 0.0, 0
+    for i, (features, labels) in enumerate(data):
+        if warmup and i == 0:
+            decode(features)
+        start = time.perf_counter()
+        preds = decode(features)
+        elapsed += time.perf_counter() - start
+        nb_examples += len(labels)
+        predictions.extend(strip_padding(p) for p in preds)
+        references.extend(strip_padding(label) for label in labels)
+    return predictions, references, nb_examples / max(elapsed, 1e-9)
+
+
+def resident_memory() -> float:
+    """
+    :return: The resident memory of the process in bytes (Linux only).
+    """
+    with open("/proc/self/statm", mode='r') as f:
+        return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+
+
+def corpus_scores(predictions: List[List[str]], references: List[List[str]]) -> Dict[str, float]:
+    # ROUGE-L is undefined for empty predictions, these are scored as a single padding token
+    rouge_predictions = [p if len(p) > 0 else ["0"] for p in predictions]
+    return {
+        "BLEU-4": 100 * nltk.translate.bleu_score.corpus_bleu([[r] for r in references], predictions),
+        "ROUGE-L": 100 * float(rouge_l_sentence_level(rouge_predictions, [[r] for r in references]))
+    }
+
+
+def format_report(rows: Dict[str, Dict[str, float]]) -> str:
+    """
+    :param rows: Metrics of each configuration, every configuration having the same metrics.
+    :return: A plain text table with one line per configuration.
+    """
+    columns = list(next(iter(rows.values())).keys())
+    name_width = max(len(name) for name in rows)
+    lines = [" | ".join([" " * name_width] + [f"{c:>12}" for c in columns])]
+    for name, metrics in rows.items():
+        lines.append(" | ".join([f"{name:<{name_width}}"] + [f"{metrics[c]:>12.2f}" for c in columns]))
+    return "\n".join(lines)
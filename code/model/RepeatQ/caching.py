@@ -0,0 +1,36 @@
+from collections import OrderedDict
+
+
+class LRUCache:
+    """
+    Mapping holding at most `max_size` entries, the least recently used one being evicted first.
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.hits, self.misses = 0, 0
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key, default=None):
+        if key not in self.entries:
+            self.misses += 1
+            return default
+        self.hits += 1
+        self.entries.move_to_end(key)
+        return self.entries[key]
+
+    def put(self, key, value):
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    @property
+    def hit_rate(self):
+        return self.hits / max(self.hits + self.misses, 1)
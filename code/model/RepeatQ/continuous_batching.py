@@ -0,0 +1,130 @@
+import numpy as np
+import tensorflow as tf
+
+from model.RepeatQ.model import RepeatQ
+
+
+class ContinuousBatchingScheduler:
+    """
+    Greedy decoding over a fixed pool of decoder slots, one decoder step at a time. Each slot holds the encoder
+    outputs, decoder state and last observation of one sequence. A slot is freed as soon as its sequence emits a
+    question mark or a padding token (or exhausts its length budget) and new sequences are spliced into free slots
+    between steps, so that a long sequence never keeps the other slots idle. Every step runs on the whole pool, whose
+    shapes are fixed, so the step function is traced once.
+    """
+
+    def __init__(self, model: RepeatQ, nb_slots, question_length, nb_facts, fact_length):
+        """
+        :param question_length: Base question length of the slots, longer questions can't be admitted.
+        :param nb_facts: Number of facts of the slots.
+        :param fact_length: Fact length of the slots.
+        """
+        self.model = model
+        self.nb_slots = nb_slots
+        self.shape = (question_length, nb_facts, fact_length)
+        self.max_length = model.config.max_generated_question_length
+        self.state = None
+        self.is_first_step = np.zeros((nb_slots,), dtype=bool)
+        self.history = np.zeros((nb_slots, self.max_length), dtype=np.int32)
+        self.steps = np.zeros((nb_slots,), dtype=np.int32)
+        self.budgets = np.full((nb_slots,), self.max_length, dtype=np.int32)
+        # Key of the sequence decoded by each slot, None for free slots
+        self.keys = [None] * nb_slots
+
+    @property
+    def free_slots(self):
+        return [i for i, key in enumerate(self.keys) if key is None]
+
+    @property
+    def nb_active(self):
+        return self.nb_slots - len(self.free_slots)
+
+    def fits(self, question_length, nb_facts, fact_length):
+        return all(length <= limit for length, limit in zip((question_length, nb_facts, fact_length), self.shape))
+
+    def admit(self, keys, features):
+        """
+        Encodes new sequences and splices them into free slots.
+        :param keys: Identifiers of the new sequences, at most the number of free slots.
+        :param features: Their inputs padded to the slots' shapes, with as many rows as keys or more (padding rows are
+        ignored).
+        """
+        slots = self.free_slots[:len(keys)]
+        assert len(slots) == len(keys), "Not enough free slots."
+        network_state = self._encode(features)
+        if self.state is None:
+            # The pool is initialized with copies of the first sequences, unused slots being free
+            self.state = RepeatQ.gather_network_state(network_state, np.zeros((self.nb_slots,), dtype=np.int32))
+        indices = tf.constant(np.array(slots, dtype=np.int32)[:, None])
+        rows = np.arange(len(slots))
+        self.state = RepeatQ.NetworkState(*(
+            ContinuousBatchingScheduler._splice(pooled, tf.gather(new, rows), indices)
+            for pooled, new in zip(self.state[:4], network_state[:4])
+        ), decoder_states=tuple(
+            ContinuousBatchingScheduler._splice(pooled, tf.gather(new, rows), indices)
+            for pooled, new in zip(self.state.decoder_states, network_state.decoder_states)
+        ), observation=ContinuousBatchingScheduler._splice(
+            self.state.observation, tf.zeros((len(slots),), dtype=tf.int32), indices
+        ), is_first_step=None)
+        budget = self.model.decoding_budget(features["base_question"], features["facts"])
+        budget = None if budget is None else budget.numpy()
+        for row, (slot, key) in enumerate(zip(slots, keys)):
+            self.keys[slot] = key
+            self.is_first_step[slot] = True
+            self.history[slot] = 0
+            self.steps[slot] = 0
+            self.budgets[slot] = self.max_length if budget is None else budget[row]
+
+    def step(self):
+        """
+        Runs one decoder step on every slot.
+        :return: The (key, predicted tokens) pairs of the sequences which finished, their slots being freed.
+        """
+        network_state = self.state._replace(is_first_step=tf.constant(self.is_first_step))
+        predicted_tokens, decoder_states = self.model.greedy_step(
+            network_state, tf.constant(self.history), tf.constant(np.minimum(self.steps, self.max_length - 1))
+        )
+        predicted_tokens = predicted_tokens.numpy()
+        active = np.array([key is not None for key in self.keys])
+        active_slots = np.where(active)[0]
+        self.history[active_slots, self.steps[active_slots]] = predicted_tokens[active_slots]
+        self.steps[active_slots] += 1
+        finished = np.logical_and(active, np.logical_or(
+            np.logical_or(predicted_tokens == 0, predicted_tokens == self.model.question_mark_id),
+            self.steps >= self.budgets
+        ))
+        # Free slots keep a padding observation, so their state is left untouched by the next steps
+        observation = np.where(np.logical_and(active, ~finished), predicted_tokens, 0).astype(np.int32)
+        self.state = self.state._replace(decoder_states=decoder_states, observation=tf.constant(observation))
+        self.is_first_step[:] = False
+        results = []
+        for slot in np.where(finished)[0]:
+            results.append((self.keys[slot], self.history[slot, :self.steps[slot]].copy()))
+            self.keys[slot] = None
+        return results
+
+    def evict(self, key):
+        """
+        Frees the slot of a sequence which is no longer needed (ex: its deadline passed).
+        """
+        for slot, slot_key in enumerate(self.keys):
+            if slot_key == key:
+                self.keys[slot] = None
+                self.state = self.state._replace(observation=tf.tensor_scatter_nd_update(
+                    self.state.observation, [[slot]], [0]
+                ))
+                self.is_first_step[slot] = False
+
+    def _encode(self, features):
+        return self.model.get_initial_state(
+            base_question=features["base_question"],
+            base_question_features=features["base_question_features"],
+            facts=features["facts"],
+            facts_features=features["facts_features"],
+            batch_size=features["base_question"].get_shape()[0],
+            training=False
+        )
+
+    @staticmethod
+    def _splice(pooled, new, indices):
+        return tf.tensor_scatter_nd_update(pooled, indices, tf.cast(new, pooled.dtype))
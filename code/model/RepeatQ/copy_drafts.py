@@ -0,0 +1,39 @@
+import tensorflow as tf
+
+
+def propose_copy_drafts(history, positions, base_question, facts, draft_length):
+    """
+    Proposes for each row a multi-token draft copied from the base question or the facts: the words that follow the
+    last generated token in them. Occurrences also preceded by the token before the last one are preferred. When
+    nothing was generated yet, the draft is the beginning of the base question.
+    :param history: Tokens generated so far, [rows, max length].
+    :param positions: Number of tokens generated so far for each row, [rows].
+    :param base_question: [rows, question length].
+    :param facts: [rows, number of facts, fact length].
+    :param draft_length: Number of tokens to propose.
+    :return: The drafts, [rows, draft length]. Rows without any candidate span get a padding draft.
+    """
+    copy_words = tf.concat((base_question, tf.reshape(facts, (tf.shape(facts)[0], -1))), axis=-1, name="copy_words")
+    nb_words = tf.shape(copy_words)[1]
+    positions = tf.reshape(positions, (-1, 1))
+    no_token = -tf.ones_like(positions)
+    last_token = tf.where(
+        tf.greater_equal(positions, 1), tf.gather(history, tf.maximum(positions - 1, 0), batch_dims=1), no_token
+    )
+    token_before_last = tf.where(
+        tf.greater_equal(positions, 2), tf.gather(history, tf.maximum(positions - 2, 0), batch_dims=1), no_token
+    )
+    matches_last = tf.logical_and(tf.equal(copy_words, last_token), tf.not_equal(copy_words, 0))
+    previous_words = tf.pad(copy_words[:, :-1], paddings=((0, 0), (1, 0)))
+    matches_before_last = tf.equal(previous_words, token_before_last)
+    scores = tf.cast(matches_last, tf.int32) * (1 + tf.cast(matches_before_last, tf.int32))
+    # Index of the word the draft continues from, -1 means the draft starts at the first word
+    match = tf.where(
+        tf.equal(positions, 0),
+        no_token,
+        tf.argmax(scores, axis=-1, output_type=tf.int32)[:, None]
+    )
+    has_match = tf.logical_or(tf.reduce_any(matches_last, axis=-1, keepdims=True), tf.equal(positions, 0))
+    draft_positions = match + 1 + tf.range(draft_length)[None, :]
+    drafts = tf.gather(copy_words, tf.minimum(draft_positions, nb_words - 1), batch_dims=1)
+    return tf.where(tf.logical_and(tf.less(draft_positions, nb_words), has_match), drafts, tf.zeros_like(drafts))
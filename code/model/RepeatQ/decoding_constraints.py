@@ -0,0 +1,73 @@
+import tensorflow as tf
+
+
+def banned_tokens_mask(history, step, vocab_size, no_repeat_ngram_size=0, max_adjacent_duplicate_size=0):
+    """
+    Computes which tokens can't be generated next without repeating an n-gram or duplicating adjacent n-grams.
+    Everything is vectorized over the rows of the history (batch elements or beams).
+    :param history: Tokens generated so far, [rows, max length]. Only the first `step` positions are considered.
+    :param step: Number of tokens generated so far, either a scalar or one per row ([rows]).
+    :param vocab_size: Number of words in the output vocabulary.
+    :param no_repeat_ngram_size: Size of the n-grams that can't appear twice. 0 disables the constraint.
+    :param max_adjacent_duplicate_size: Tokens completing an n-gram identical to the one right before it are banned,
+    for every n up to this size (ex: "the the" or "of the of the"). 0 disables the constraint.
+    :return: A boolean mask of banned tokens, [rows, vocab size].
+    """
+    max_length = history.get_shape()[1]
+    nb_rows = tf.shape(history)[0]
+    # [rows, 1]
+    step = tf.broadcast_to(tf.reshape(step, (-1, 1)), (nb_rows, 1))
+    banned_tokens, is_banned = [], []
+
+    def gather_positions(offsets):
+        # Positions can be negative at the beginning of the sequence, these are masked out by the callers
+        return tf.gather(history, tf.maximum(step + offsets, 0), batch_dims=1)
+
+    if 0 < no_repeat_ngram_size <= max_length:
+        n = no_repeat_ngram_size
+        nb_windows = max_length - n + 1
+        # [rows, windows, n]
+        windows = tf.gather(history, tf.range(nb_windows)[:, None] + tf.range(n)[None, :], axis=1)
+        # Last n - 1 generated tokens, [rows, 1, n - 1]
+        prefix = tf.expand_dims(gather_positions(-n + 1 + tf.range(n - 1)), axis=1)
+        matches = tf.reduce_all(tf.equal(windows[..., :n - 1], prefix), axis=-1)
+        # Windows need to be entirely generated already
+        matches = tf.logical_and(matches, tf.less_equal(tf.expand_dims(tf.range(nb_windows), axis=0), step - n))
+        banned_tokens.append(windows[..., n - 1])
+        is_banned.append(matches)
+
+    for n in range(1, max_adjacent_duplicate_size + 1):
+        # The next token w completes a duplicate if h[t-2n+1:t-n] == h[t-n+1:t] and w == h[t-n]
+        matches = tf.greater_equal(step, 2 * n - 1)
+        # The halves are empty for n = 1 (not gathered, as TFLite crashes on empty gathers)
+        if n > 1:
+            first_half = gather_positions(-2 * n + 1 + tf.range(n - 1))
+            second_half = gather_positions(-n + 1 + tf.range(n - 1))
+            matches = tf.logical_and(
+                tf.reduce_all(tf.equal(first_half, second_half), axis=-1, keepdims=True),
+                matches
+            )
+        banned_tokens.append(gather_positions(tf.constant([-n])))
+        is_banned.append(matches)
+
+    if len(banned_tokens) == 0:
+        return tf.zeros((nb_rows, vocab_size), dtype=tf.bool)
+    banned_tokens = tf.concat(banned_tokens, axis=1)
+    # Padding tokens are never banned
+    is_banned = tf.logical_and(tf.concat(is_banned, axis=1), tf.not_equal(banned_tokens, 0))
+    row_indices = tf.broadcast_to(tf.range(nb_rows)[:, None], tf.shape(banned_tokens))
+    indices = tf.stack((row_indices, banned_tokens), axis=-1)
+    counts = tf.scatter_nd(
+        tf.reshape(indices, (-1, 2)),
+        tf.reshape(tf.cast(is_banned, tf.int32), (-1,)),
+        shape=(nb_rows, vocab_size)
+    )
+    return tf.greater(counts, 0)
+
+
+def write_step(history, step, tokens):
+    """
+    Writes the tokens generated at the given step (a scalar or one step per row) into the history, [rows, max length].
+    """
+    is_step = tf.equal(tf.expand_dims(tf.range(history.get_shape()[1]), axis=0), tf.reshape(step, (-1, 1)))
+    return tf.where(is_step, tf.expand_dims(tokens, axis=-1), history)
@@ -0,0 +1,43 @@
+import tensorflow as tf
+
+
+def copy_indicators(target, base_question, facts):
+    """
+    Computes the copy indicators of arbitrary targets (ex: a teacher's beam search outputs) the same way the dataset
+    does: a word is copied from the last fact containing it, or else from the base question, at its first occurrence.
+    :param target: [batch size, target length]
+    :param base_question: [batch size, question length]
+    :param facts: [batch size, number of facts, fact length]
+    :return: Position of each target word in [base question, fact 1, ..., fact l], -1 if it can't be copied,
+    [batch size, target length].
+    """
+    question_length = tf.shape(base_question)[1]
+    fact_length = tf.shape(facts)[2]
+    copy_words = tf.concat((base_question, tf.reshape(facts, (tf.shape(facts)[0], -1))), axis=-1)
+    nb_words = tf.shape(copy_words)[1]
+    positions = tf.range(nb_words)
+    # 0 for the base question, i + 1 for the i-th fact
+    segments = tf.where(positions < question_length, 0, (positions - question_length) // fact_length + 1)
+    # [batch size, target length, copy words]
+    matches = tf.logical_and(
+        tf.equal(tf.expand_dims(target, axis=-1), tf.expand_dims(copy_words, axis=1)),
+        tf.expand_dims(tf.not_equal(target, 0), axis=-1)
+    )
+    # Later segments first, then earlier positions within a segment
+    priorities = tf.where(matches, segments * nb_words + nb_words - positions, tf.zeros_like(matches, dtype=tf.int32))
+    indicators = tf.argmax(priorities, axis=-1, output_type=tf.int32)
+    return tf.where(tf.reduce_any(matches, axis=-1), indicators, -tf.ones_like(indicators))
+
+
+def soft_cross_entropy(teacher_distributions, student_distributions, target, epsilon=1e-7):
+    """
+    Cross-entropy between the teacher's and the student's output distributions at every step of the teacher-forced
+    target, averaged over the non-padding steps.
+    :param teacher_distributions: [batch size, target length, output size]
+    :param student_distributions: [batch size, target length, output size]
+    """
+    weights = tf.cast(tf.not_equal(target, 0), tf.float32)
+    losses = -tf.reduce_sum(
+        teacher_distributions * tf.math.log(tf.clip_by_value(student_distributions, epsilon, 1.0)), axis=-1
+    )
+    return tf.reduce_sum(weights * losses) / tf.reduce_sum(weights)
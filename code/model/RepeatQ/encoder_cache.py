@@ -0,0 +1,140 @@
+import time
+from logging import info
+
+import numpy as np
+import tensorflow as tf
+
+from model.RepeatQ.caching import LRUCache
+
+
+class EncoderCache:
+    """
+    LRU caches of the encoder outputs of inference: the encodings and initial decoder hidden state of each base
+    question, and the encodings of each fact, keyed by their ids and features. Padding positions are masked in the
+    encoders, so the outputs of a sentence don't depend on the length it is padded to: entries are stored unpadded and
+    batches are assembled from cached entries and the freshly encoded misses, padded with zeros. Facts are first
+    looked up in the optional precomputed `FactEncodingStore`.
+    """
+
+    def __init__(self, question_cache_size, fact_cache_size, fact_store=None):
+        self.questions = LRUCache(question_cache_size)
+        self.facts = LRUCache(fact_cache_size)
+        self.fact_store = fact_store
+        self.timings = {"question": 0.0, "fact": 0.0, "lookup": 0.0}
+        self.nb_encoded = {"question": 0, "fact": 0}
+
+    def encode(self, model, base_question, base_question_features, facts, facts_features):
+        """
+        :return: The base question encodings, [batch size, question length, encoding size], the initial decoder hidden
+        state, [batch size, decoder hidden size], and the facts encodings, [batch size, nb facts, fact length, encoding
+        size], as computed by `RepeatQ.get_initial_state` in inference mode.
+        """
+        start = time.perf_counter()
+        base_question, base_question_features = np.asarray(base_question), np.asarray(base_question_features)
+        facts, facts_features = np.asarray(facts), np.asarray(facts_features)
+        batch_size, nb_facts, fact_length = facts.shape
+
+        question_keys, question_entries = self._lookup(self.questions, base_question, base_question_features)
+        missing = self._missing(question_entries)
+        if missing:
+            encoding_start = time.perf_counter()
+            rows = [question_keys.index(key) for key in missing]
+            encodings, hidden_state = model.encode_question(
+                *EncoderCache._padded_rows((base_question, base_question_features), rows), training=False
+            )
+            encodings, hidden_state = encodings.numpy(), hidden_state.numpy()
+            for i, key in enumerate(missing):
+                length = len(np.trim_zeros(base_question[rows[i]], 'b'))
+                question_entries[key] = (encodings[i, :length], hidden_state[i])
+                self.questions.put(key, question_entries[key])
+            self.timings["question"] += time.perf_counter() - encoding_start
+            self.nb_encoded["question"] += len(missing)
+
+        fact_rows = facts.reshape((batch_size * nb_facts, fact_length))
+        fact_features_rows = facts_features.reshape((batch_size * nb_facts, fact_length, -1))
+        fact_keys, fact_entries = self._lookup(self.facts, fact_rows, fact_features_rows, store=self.fact_store,
+                                               dtype=tf.as_dtype(model.float_dtype).as_numpy_dtype)
+        missing = self._missing(fact_entries)
+        if missing:
+            encoding_start = time.perf_counter()
+            rows = [fact_keys.index(key) for key in missing]
+            # Missing facts are encoded as a batch of single facts
+            missing_facts, missing_features = EncoderCache._padded_rows((fact_rows, fact_features_rows), rows)
+            encodings = model.encode_facts(missing_facts[:, None], missing_features[:, None], training=False)
+            encodings = encodings.numpy()[:, 0]
+            for i, key in enumerate(missing):
+                fact_entries[key] = encodings[i, :len(np.trim_zeros(fact_rows[rows[i]], 'b'))]
+                self.facts.put(key, fact_entries[key])
+            self.timings["fact"] += time.perf_counter() - encoding_start
+            self.nb_encoded["fact"] += len(missing)
+
+        question_encodings, hidden_state = EncoderCache._assemble(
+            [question_entries[key][0] for key in question_keys], base_question.shape[1]
+        ), np.stack([question_entries[key][1] for key in question_keys])
+        facts_encodings = EncoderCache._assemble([fact_entries[key] for key in fact_keys], fact_length)
+        facts_encodings = facts_encodings.reshape((batch_size, nb_facts, fact_length, -1))
+        self.timings["lookup"] += time.perf_counter() - start
+        return tf.constant(question_encodings), tf.constant(hidden_state), tf.constant(facts_encodings)
+
+    @staticmethod
+    def sentence_key(ids, features):
+        ids = np.trim_zeros(np.asarray(ids, dtype=np.int32), 'b')
+        return ids.tobytes() + b"|" + np.ascontiguousarray(features[:len(ids)], dtype=np.float32).tobytes()
+
+    @staticmethod
+    def _lookup(cache: LRUCache, sentences, features, store=None, dtype=None):
+        """
+        :param store: Optional `FactEncodingStore` looked up before the cache, its entries being cast to `dtype`.
+        :return: The key of each sentence and the cached entries of the distinct keys (None when missing).
+        """
+        keys = [EncoderCache.sentence_key(ids, sentence_features) for ids, sentence_features in zip(sentences, features)]
+        entries = {}
+        for key, ids, sentence_features in zip(keys, sentences, features):
+            if key in entries:
+                continue
+            # Padding facts are never in the store
+            entry = None if store is None or not np.any(ids) else store.get(ids, sentence_features)
+            entries[key] = cache.get(key) if entry is None else np.asarray(entry, dtype=dtype)
+        return keys, entries
+
+    @staticmethod
+    def _missing(entries):
+        return [key for key, entry in entries.items() if entry is None]
+
+    @staticmethod
+    def _padded_rows(arrays, rows):
+        """
+        :return: The given rows of the arrays, padded with zero rows to a power of two, which bounds the number of
+        distinct shapes the encoders run on.
+        """
+        nb_rows = 1 << (len(rows) - 1).bit_length()
+        return tuple(np.concatenate((a[rows], np.zeros((nb_rows - len(rows), *a.shape[1:]), dtype=a.dtype)))
+                     for a in arrays)
+
+    @staticmethod
+    def _assemble(encodings, length):
+        assembled = np.zeros((len(encodings), length, encodings[0].shape[-1]), dtype=encodings[0].dtype)
+        for i, encoding in enumerate(encodings):
+            assembled[i, :len(encoding)] = encoding
+        return assembled
+
+    def log_stats(self):
+        """
+        Logs the hit rates and the encoding time saved, estimated from the mean encoding time of the misses. Nothing is
+        logged if no batch was encoded through the cache (ex: every prediction came from the prediction cache).
+        """
+        if self.questions.hits + self.questions.misses == 0:
+            return
+        encoding_time = self.timings["question"] + self.timings["fact"]
+        saved = sum(self.timings[kind] / self.nb_encoded[kind] * cache.hits
+                    for kind, cache in (("question", self.questions), ("fact", self.facts)) if self.nb_encoded[kind])
+        if self.fact_store is not None and self.nb_encoded["fact"]:
+            saved += self.timings["fact"] / self.nb_encoded["fact"] * self.fact_store.hits
+        # The LRU caches are disabled when only the fact encoding store is used
+        if self.questions.max_size > 0:
+            info(f"Encoder cache: question hit rate {100 * self.questions.hit_rate:.1f}% ({len(self.questions)} "
+                 f"cached), fact hit rate {100 * self.facts.hit_rate:.1f}% ({len(self.facts)} cached).")
+        if self.fact_store is not None:
+            info(f"Fact encoding store hit rate: {100 * self.fact_store.hit_rate:.1f}% ({len(self.fact_store)} facts).")
+        info(f"Encoder outputs reuse: encoding time saved ~{saved:.2f} s, overhead "
+             f"{self.timings['lookup'] - encoding_time:.2f} s.")
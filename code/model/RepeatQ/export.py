@@ -0,0 +1,68 @@
+import tensorflow as tf
+
+
+class RepeatQServingModule(tf.Module):
+    """
+    Wraps a trained RepeatQ model for SavedModel export. The model's layers need static shapes, so the serving
+    signatures take inputs of fixed shapes (the ones of the dataset it was trained on), callers pad their batches to
+    them (see `saved_model_loader.ExportedRepeatQ`).
+    """
+
+    def __init__(self, model, config, features_shape, beam_sizes=(5,), name=None):
+        """
+        :param features_shape: Shapes of the base question, base question features, facts and facts features of a
+        batch, ([batch size, question length], [..., nb features], [batch size, nb facts, fact length], [...]).
+        :param beam_sizes: A `beam_<k>` signature is exported for each of these beam sizes.
+        """
+        super(RepeatQServingModule, self).__init__(name=name)
+        # Only the model's variables are tracked: saving the Keras model itself would trace its call for an unknown
+        # batch size, which the decoder doesn't support
+        self.model_variables = model.variables
+        self._setattr_tracking = False
+        self.model = model
+        self._setattr_tracking = True
+        self.max_length = config.max_generated_question_length
+        self.beam_sizes = beam_sizes
+        self.vocabulary = tf.saved_model.Asset(config.vocabulary_path)
+        self.feature_vocabulary = tf.saved_model.Asset(config.feature_vocabulary_path)
+        question_shape, question_features_shape, facts_shape, facts_features_shape = features_shape
+        self.input_signature = [
+            tf.TensorSpec(question_shape, dtype=tf.int32, name="base_question"),
+            tf.TensorSpec(question_features_shape, dtype=tf.float32, name="base_question_features"),
+            tf.TensorSpec(facts_shape, dtype=tf.int32, name="facts"),
+            tf.TensorSpec(facts_features_shape, dtype=tf.float32, name="facts_features")
+        ]
+
+    def signatures(self):
+        signatures = {"greedy": tf.function(self._greedy, input_signature=self.input_signature)}
+        for k in self.beam_sizes:
+            signatures[f"beam_{k}"] = tf.function(self._beam_decoder(k), input_signature=self.input_signature)
+        return {name: f.get_concrete_function() for name, f in signatures.items()}
+
+    @staticmethod
+    def _inputs(base_question, base_question_features, facts, facts_features):
+        return {
+            "base_question": base_question,
+            "base_question_features": base_question_features,
+            "facts": facts,
+            "facts_features": facts_features
+        }
+
+    def _pad_tokens(self, tokens):
+        tokens = tf.pad(tokens, paddings=((0, 0), (0, self.max_length - tf.shape(tokens)[1])))
+        tokens.set_shape((tokens.get_shape()[0], self.max_length))
+        return tokens
+
+    def _greedy(self, base_question, base_question_features, facts, facts_features):
+        tokens, _ = self.model.get_actions(
+            self._inputs(base_question, base_question_features, facts, facts_features), None, training=False
+        )
+        return {"tokens": self._pad_tokens(tokens)}
+
+    def _beam_decoder(self, beam_size):
+        def _beam(base_question, base_question_features, facts, facts_features):
+            tokens = self.model.beam_search(
+                self._inputs(base_question, base_question_features, facts, facts_features), beam_search_size=beam_size
+            )
+            return {"tokens": self._pad_tokens(tokens)}
+        return _beam
@@ -0,0 +1,107 @@
+import hashlib
+import json
+import os
+from logging import info
+
+import numpy as np
+import tensorflow as tf
+from tqdm import tqdm
+
+from model.RepeatQ.encoder_cache import EncoderCache
+from model.RepeatQ.prediction_cache import checkpoint_hash
+
+
+def fact_id(ids, features):
+    """
+    :return: The identifier of a fact in a store, the digest of its unpadded ids and features.
+    """
+    return hashlib.sha1(EncoderCache.sentence_key(ids, features)).digest()
+
+
+class FactEncodingStore:
+    """
+    Precomputed `FactEncoder` outputs of a fixed fact corpus for one checkpoint. The per-token encodings of every fact
+    are concatenated in a memory-mapped array, [nb tokens, encoding size], and an index maps each fact id (see
+    `fact_id`) to its first row and its length, so that lookups only read the rows of the requested facts.
+    """
+
+    def __init__(self, path, model_dir=None):
+        """
+        :param model_dir: If given, the store must have been written with this checkpoint.
+        """
+        with open(f"{path}/metadata.json", mode='r') as f:
+            self.metadata = json.load(f)
+        if model_dir is not None and self.metadata["checkpoint"] != checkpoint_hash(model_dir):
+            raise ValueError(f"The fact encoding store '{path}' was written with another checkpoint than '{model_dir}'.")
+        self.encodings = np.load(f"{path}/encodings.npy", mmap_mode='r')
+        index = np.load(f"{path}/index.npz")
+        self.rows = {key.tobytes(): (offset, length)
+                     for key, offset, length in zip(index["ids"], index["offsets"], index["lengths"])}
+        self.hits, self.misses = 0, 0
+        info(f"Fact encoding store '{path}' loaded: {len(self.rows)} facts, {self.encodings.shape[0]} tokens "
+             f"({self.encodings.dtype}).")
+
+    def __len__(self):
+        return len(self.rows)
+
+    def get(self, ids, features):
+        """
+        :return: The encodings of a fact, [fact length, encoding size], None if the fact isn't in the store.
+        """
+        row = self.rows.get(fact_id(ids, features))
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        offset, length = row
+        return self.encodings[offset:offset + length]
+
+    @property
+    def hit_rate(self):
+        return self.hits / max(self.hits + self.misses, 1)
+
+    @staticmethod
+    def write(path, model, model_dir, facts, facts_features, float16=False, batch_size=256):
+        """
+        Encodes a fact corpus and writes its store.
+        :param facts: The ids of each fact (unpadded or padded with 0).
+        :param facts_features: Their features, [fact length, nb features] each.
+        :param float16: If True, encodings are stored in float16, halving the store's size.
+        """
+        distinct = {}
+        for ids, features in zip(facts, facts_features):
+            ids = np.trim_zeros(np.asarray(ids, dtype=np.int32), 'b')
+            if len(ids) > 0:
+                distinct.setdefault(fact_id(ids, features), (ids, np.asarray(features, dtype=np.float32)[:len(ids)]))
+        # Facts are encoded by decreasing length, so that each batch is padded to similar lengths
+        keys = sorted(distinct, key=lambda k: len(distinct[k][0]), reverse=True)
+        lengths = np.array([len(distinct[key][0]) for key in keys], dtype=np.int64)
+        offsets = np.cumsum(lengths) - lengths
+        encoding_size = 2 * model.config.fact_encoder_hidden_size
+        dtype = np.float16 if float16 else np.float32
+        os.makedirs(path, exist_ok=True)
+        encodings = np.lib.format.open_memmap(f"{path}/encodings.npy", mode='w+', dtype=dtype,
+                                              shape=(int(np.sum(lengths)), encoding_size))
+        for i in tqdm(range(0, len(keys), batch_size)):
+            batch_keys = keys[i:i + batch_size]
+            fact_length = len(distinct[batch_keys[0]][0])
+            nb_features = distinct[batch_keys[0]][1].shape[-1]
+            batch_facts = np.zeros((len(batch_keys), 1, fact_length), dtype=np.int32)
+            batch_features = np.zeros((len(batch_keys), 1, fact_length, nb_features), dtype=np.float32)
+            for j, key in enumerate(batch_keys):
+                ids, features = distinct[key]
+                batch_facts[j, 0, :len(ids)] = ids
+                batch_features[j, 0, :len(ids)] = features
+            batch_encodings = model.encode_facts(
+                tf.constant(batch_facts), tf.constant(batch_features), training=False
+            ).numpy()[:, 0]
+            for j, key in enumerate(batch_keys):
+                offset, length = offsets[i + j], lengths[i + j]
+                encodings[offset:offset + length] = batch_encodings[j, :length]
+        encodings.flush()
+        ids = np.frombuffer(b"".join(keys), dtype=np.uint8).reshape((len(keys), -1))
+        np.savez(f"{path}/index.npz", ids=ids, offsets=offsets, lengths=lengths)
+        with open(f"{path}/metadata.json", mode='w') as f:
+            json.dump({"checkpoint": checkpoint_hash(model_dir), "nb_facts": len(keys), "dtype": np.dtype(dtype).name,
+                       "encoding_size": encoding_size}, f)
+        info(f"Encodings of {len(keys)} facts ({encodings.shape[0]} tokens) saved to '{path}'.")
@@ -14,12 +14,10 @@ class Attention(tf.keras.layers.Layer):
         if attention_style == "additive":
             self.attention_matrix = tf.keras.layers.Dense(
                 units=attention_depth,
-                dtype=tf.float32,
                 name=f"{self.name}_additive_attention_matrix",
             )
             self.attention_vector = tf.keras.layers.Dense(
                 units=1,
-                dtype=tf.float32,
                 name=f"{self.name}_additive_attention_vector"
             )
         else:
@@ -44,7 +42,7 @@ class Attention(tf.keras.layers.Layer):
             dense_input = self.attention_dropout(attention_input)
             dense_result = self.attention_matrix(dense_input)
             scores = self.attention_vector(tf.math.tanh(dense_result))
-            scores = tf.where(tf.expand_dims(mask, axis=-1), scores, tf.zeros_like(scores, dtype=tf.float32))
+            scores = tf.where(tf.expand_dims(mask, axis=-1), scores, tf.zeros_like(scores))
             if apply_softmax:
                 return tf.math.softmax(scores, axis=-2)
             return scores
@@ -1,6 +1,8 @@
 import tensorflow as tf
 import tensorflow_addons as tfa
 
+from model.RepeatQ.precision import compute_dtype
+
 
 class Decoder(tf.keras.layers.Layer):
 
@@ -14,6 +16,7 @@ class Decoder(tf.keras.layers.Layer):
                  readout_size,
                  vocab_size,
                  bos_token,
+                 tied_embeddings=False,
                  **kwargs):
         """
         :param embedding_layer: Embedding layer to embed the tokens predicted by this decoder.
@@ -25,9 +28,12 @@ class Decoder(tf.keras.layers.Layer):
         :param readout_size: Size of the readout state.
         :param vocab_size: Number of words in the output vocabulary.
         :param bos_token: Beginning of sentence token (it's id).
+        :param tied_embeddings: If True, the output layer reuses the embedding matrix: the maxout readout is projected
+        into the embedding space by W_e and scored against every word embedding, instead of going through W_y.
         """
         super(Decoder, self).__init__(**kwargs)
         self.supports_masking = True
+        self.float_dtype = compute_dtype()
         self.embedding_layer = embedding_layer
         self.lstm_cell = tf.keras.layers.LSTMCell(units, recurrent_dropout=recurrent_dropout, dropout=dropout_rate)
         self.hidden_size = units
@@ -56,14 +62,26 @@ class Decoder(tf.keras.layers.Layer):
 
         self.maxout = tfa.layers.Maxout(int(self.readout_size / 2))
 
-        self.W_y = tf.keras.layers.Dense(units=self.vocabulary_size, name="decoder_W_y")
+        self.tied_embeddings = tied_embeddings
+        if tied_embeddings:
+            self.W_y = None
+            self.W_e = tf.keras.layers.Dense(units=self.embedding_layer.size, name="decoder_W_e")
+            self.output_bias = self.add_weight(name="decoder_output_bias", shape=(self.vocabulary_size,),
+                                               initializer="zeros")
+        else:
+            self.W_y = tf.keras.layers.Dense(units=self.vocabulary_size, name="decoder_W_y")
         self.W_y_dropout = tf.keras.layers.Dropout(rate=dropout_rate, name="maxout_input_dropout")
 
     def build(self, input_shape):
         self.batch_dim = input_shape["base_question_encodings"][0]
         self.sequence_length = input_shape["base_question_encodings"][1]
 
-    def call(self, inputs, training=None, mask=None, **kwargs):
+    def call(self, inputs, training=None, mask=None, token_projections=None, shortlist=None, **kwargs):
+        """
+        :param token_projections: Optional slice for the current step of the projections computed by
+        `precompute_token_projections`. When given, the previous token embedding isn't used.
+        :param shortlist: Optional `OutputShortlist`. When given, the logits are only computed for its words.
+        """
         base_question_encodings = inputs["base_question_encodings"]
         base_question_mask = mask["base_question"]
         facts_encodings = inputs["facts_encodings"]
@@ -73,14 +91,15 @@ class Decoder(tf.keras.layers.Layer):
 
         hidden_state, carry_state = tf.cond(
             tf.equal(tf.size(inputs["decoder_state"][0]), 0),
-            lambda: tuple(self.lstm_cell.get_initial_state(batch_size=batch_dim, dtype=tf.float32)),
+            lambda: tuple(self.lstm_cell.get_initial_state(batch_size=batch_dim, dtype=self.float_dtype)),
             lambda: inputs["decoder_state"]
         )
-        previous_token_embedding = tf.cond(
-            tf.equal(tf.size(inputs["previous_token_embedding"]), 0),
-            lambda: tf.zeros((batch_dim, self.embedding_layer.size)),
-            lambda: inputs["previous_token_embedding"]
-        )
+        if token_projections is None:
+            previous_token_embedding = tf.cond(
+                tf.equal(tf.size(inputs["previous_token_embedding"]), 0),
+                lambda: tf.zeros((batch_dim, self.embedding_layer.size), dtype=self.float_dtype),
+                lambda: inputs["previous_token_embedding"]
+            )
 
         # Compute question attention vectors
         base_question_attention_vector, base_question_attention_logits = self._compute_question_attention_vectors(
@@ -91,6 +110,22 @@ class Decoder(tf.keras.layers.Layer):
             facts_encodings, hidden_state, mask=facts_mask, training=training
         )
 
+        if token_projections is not None:
+            attention_input = tf.concat((facts_attention_vector, base_question_attention_vector), axis=1)
+            hidden_state, carry_state = self._precomputed_lstm_step(
+                token_projections, attention_input, (hidden_state, carry_state), training=training
+            )
+            readout_input = tf.nn.relu(token_projections["readout"] + tf.matmul(
+                self.U_r_dropout(attention_input, training=training), self.U_r.kernel[self.embedding_layer.size:]
+            ))
+            logits = self._output_layer(
+                hidden_state, None, base_question_attention_vector, training=training, readout_input=readout_input,
+                shortlist=shortlist
+            )
+            return logits, (hidden_state, carry_state), \
+                (base_question_attention_vector, base_question_attention_logits), \
+                (facts_attention_vector, facts_attention_logits)
+
         # Create the decoder's next input
         decoder_input = tf.concat(
             (previous_token_embedding, facts_attention_vector, base_question_attention_vector),
@@ -101,18 +136,113 @@ class Decoder(tf.keras.layers.Layer):
         )
 
         # Compute logits
-        logits = self._output_layer(hidden_state, decoder_input, base_question_attention_vector, training=training)
+        logits = self._output_layer(hidden_state, decoder_input, base_question_attention_vector, training=training,
+                                    shortlist=shortlist)
         return logits, (hidden_state, carry_state), (base_question_attention_vector, base_question_attention_logits), \
                (facts_attention_vector, facts_attention_logits)
 
-    def _output_layer(self, hidden_state, decoder_input, base_question_attention_vector, training=None):
+    def _output_layer(self, hidden_state, decoder_input, base_question_attention_vector, training=None,
+                      readout_input=None, shortlist=None):
+        if readout_input is None:
+            readout_input = self.U_r(self.U_r_dropout(decoder_input))
         r_t = self.W_r(self.W_r_dropout(hidden_state)) + \
-              self.U_r(self.U_r_dropout(decoder_input)) + \
+              readout_input + \
               self.V_r(self.V_r_dropout(base_question_attention_vector))
-        maxout = self.maxout(r_t)
-        logits = self.W_y(self.W_y_dropout(maxout, training=training))
+        maxout = self.W_y_dropout(self.maxout(r_t), training=training)
+        if self.tied_embeddings:
+            maxout = self.W_e(maxout)
+        if shortlist is not None:
+            # The shortlist weights are gathered outside of the layer, hence not cast to the compute dtype
+            return tf.matmul(maxout, tf.cast(shortlist.kernel, maxout.dtype)) + tf.cast(shortlist.bias, maxout.dtype)
+        if self.tied_embeddings:
+            return tf.matmul(
+                maxout, tf.cast(self.embedding_layer.embedding_matrix, maxout.dtype), transpose_b=True
+            ) + tf.cast(self.output_bias, maxout.dtype)
+        logits = self.W_y(maxout)
         return logits
 
+    def shortlist_output_weights(self, ids):
+        """
+        :param ids: Vocabulary ids of an output shortlist.
+        :return: The columns of W_y's kernel and bias for these words (the transposed embeddings of these words with
+        tied embeddings).
+        """
+        if self.tied_embeddings:
+            return tf.transpose(tf.gather(self.embedding_layer.embedding_matrix, ids)), tf.gather(self.output_bias, ids)
+        if not self.W_y.built:
+            self.W_y.build((None, int(self.readout_size / 2)))
+        return tf.gather(self.W_y.kernel, ids, axis=1), tf.gather(self.W_y.bias, ids)
+
+    def precompute_token_projections(self, previous_token_embeddings, attention_input_size, training=None):
+        """
+        Teacher forcing: as the previous token of every step is known beforehand, the parts of the LSTM input kernel
+        and of U_r which apply to the previous token embedding are computed for the whole sequence with one matmul
+        each. Same weights and math as the step by step computation: the LSTM input dropout mask is drawn once per
+        sequence (like a Keras RNN layer does) and U_r's dropout is applied elementwise.
+        :param previous_token_embeddings: Embeddings of the shifted target, [batch size, target length, embedding size].
+        :param attention_input_size: Size of the concatenated fact and question attention vectors.
+        :return: A dictionary of projections, [batch size, target length, ...], and of the dropout masks reused at each
+        step. Use `token_projections_at` to get the slice of a step.
+        """
+        embedding_size = self.embedding_layer.size
+        if not self.lstm_cell.built:
+            self.lstm_cell.build((None, embedding_size + attention_input_size))
+        if not self.U_r.built:
+            self.U_r.build((None, embedding_size + attention_input_size))
+        batch_size = tf.shape(previous_token_embeddings)[0]
+
+        def dropout_mask(rate, size):
+            if not training or not 0 < rate < 1:
+                return None
+            return tf.nn.dropout(tf.ones((batch_size, size), dtype=self.float_dtype), rate=rate)
+
+        input_mask = dropout_mask(self.lstm_cell.dropout, embedding_size + attention_input_size)
+        lstm_inputs = previous_token_embeddings
+        if input_mask is not None:
+            lstm_inputs = lstm_inputs * tf.expand_dims(input_mask[:, :embedding_size], axis=1)
+        # Called outside of the layer, so the variables aren't cast to the compute dtype automatically
+        lstm_projections = tf.matmul(lstm_inputs, tf.cast(self.lstm_cell.kernel[:embedding_size], self.float_dtype))
+        if self.lstm_cell.use_bias:
+            lstm_projections += tf.cast(self.lstm_cell.bias, self.float_dtype)
+        readout_projections = tf.matmul(
+            self.U_r_dropout(previous_token_embeddings, training=training),
+            tf.cast(self.U_r.kernel[:embedding_size], self.float_dtype)
+        ) + tf.cast(self.U_r.bias, self.float_dtype)
+        return {
+            "lstm": lstm_projections,
+            "readout": readout_projections,
+            "attention_dropout_mask": None if input_mask is None else input_mask[:, embedding_size:],
+            "recurrent_dropout_mask": dropout_mask(self.lstm_cell.recurrent_dropout, self.hidden_size)
+        }
+
+    @staticmethod
+    def token_projections_at(token_projections, step):
+        return {
+            "lstm": token_projections["lstm"][:, step],
+            "readout": token_projections["readout"][:, step],
+            "attention_dropout_mask": token_projections["attention_dropout_mask"],
+            "recurrent_dropout_mask": token_projections["recurrent_dropout_mask"]
+        }
+
+    def _precomputed_lstm_step(self, token_projections, attention_input, states, training=None):
+        # Same computation as Keras' LSTMCell (implementation 2) with the token part of the input already projected
+        hidden_state, carry_state = states
+        if training and token_projections["attention_dropout_mask"] is not None:
+            attention_input = attention_input * token_projections["attention_dropout_mask"]
+        recurrent_input = hidden_state
+        if training and token_projections["recurrent_dropout_mask"] is not None:
+            recurrent_input = recurrent_input * token_projections["recurrent_dropout_mask"]
+        z = token_projections["lstm"] + \
+            tf.matmul(attention_input, self.lstm_cell.kernel[self.embedding_layer.size:]) + \
+            tf.matmul(recurrent_input, self.lstm_cell.recurrent_kernel)
+        z_i, z_f, z_c, z_o = tf.split(z, num_or_size_splits=4, axis=1)
+        input_gate = self.lstm_cell.recurrent_activation(z_i)
+        forget_gate = self.lstm_cell.recurrent_activation(z_f)
+        carry_state = forget_gate * carry_state + input_gate * self.lstm_cell.activation(z_c)
+        output_gate = self.lstm_cell.recurrent_activation(z_o)
+        hidden_state = output_gate * self.lstm_cell.activation(carry_state)
+        return hidden_state, carry_state
+
     def _compute_question_attention_vectors(self, base_question_encodings, decoder_hidden_state, mask, training=None):
         base_question_attention_logits = self.base_question_attention(
             base_question_encodings,
@@ -121,7 +251,10 @@ class Decoder(tf.keras.layers.Layer):
             training=training,
             mask=mask
         )
-        base_question_attention_weights = tf.math.softmax(base_question_attention_logits, axis=-2, name="q_attention")
+        # Softmaxes are computed in float32
+        base_question_attention_weights = tf.cast(tf.math.softmax(
+            tf.cast(base_question_attention_logits, tf.float32), axis=-2, name="q_attention"
+        ), self.float_dtype)
         base_question_attention_vectors = tf.reduce_sum(
             tf.multiply(base_question_attention_weights, base_question_encodings),
             axis=1,
@@ -167,7 +300,9 @@ class Decoder(tf.keras.layers.Layer):
             name="max_fact_attention_scores"
         )
         max_attention_weights = tf.expand_dims(
-            tf.math.softmax(max_attention_scores), axis=-1, name="max_fact_attention_weights"
+            tf.cast(tf.math.softmax(tf.cast(max_attention_scores, tf.float32)), self.float_dtype),
+            axis=-1,
+            name="max_fact_attention_weights"
         )
         selected_facts_encodings = tf.gather(facts_encodings, max_indices, name="selected_facts_encodings",
                                              batch_dims=1)
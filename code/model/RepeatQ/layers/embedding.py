@@ -5,6 +5,8 @@ from typing import Dict
 import numpy as np
 import tensorflow as tf
 
+from model.RepeatQ.precision import compute_dtype
+
 
 class Embedding(tf.keras.layers.Layer):
 
@@ -14,6 +16,8 @@ class Embedding(tf.keras.layers.Layer):
         super(Embedding, self).__init__(*args, **kwargs)
         self.embedding_matrix = embedding_matrix
         self.supports_masking = True
+        # The embedding matrix is a plain variable, so lookups are cast to the compute dtype by hand
+        self.float_dtype = compute_dtype()
 
         self.bio_embedding_layer = tf.keras.layers.Embedding(nb_bio_tags, 3, mask_zero=True, name="bio_embeddings")
         self.pos_embedding_layer = tf.keras.layers.Embedding(nb_pos_tags, 16, mask_zero=True, name="pos_embeddings")
@@ -23,14 +27,14 @@ class Embedding(tf.keras.layers.Layer):
         features = inputs["features"]
         word_embeddings = self.embed_words(sentence)
         # Features are given in this order: (pos, bio)
-        pos_embds = self.pos_embedding_layer(features[..., 0])
-        bio_embds = self.bio_embedding_layer(features[..., 1])
+        pos_embds = tf.cast(self.pos_embedding_layer(features[..., 0]), self.float_dtype)
+        bio_embds = tf.cast(self.bio_embedding_layer(features[..., 1]), self.float_dtype)
         return tf.concat((word_embeddings, pos_embds, bio_embds), axis=-1)
 
     def embed_words(self, words):
-        return tf.nn.embedding_lookup(
+        return tf.cast(tf.nn.embedding_lookup(
             self.embedding_matrix, words, name="embedding_lookup"
-        )
+        ), self.float_dtype)
 
     def compute_mask(self, inputs, previous_mask=None):
         return tf.not_equal(inputs["sentence"], 0)
@@ -0,0 +1,69 @@
+import json
+from logging import info
+from typing import List, Tuple
+
+import numpy as np
+
+from data_processing.class_defs import RepeatQExample
+
+
+def example_lengths(examples: List[RepeatQExample]) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    :param examples: Examples as returned by `RepeatQDataset.get_dataset`.
+    :return: The base question lengths, the longest fact lengths and the target lengths (padding excluded).
+    """
+    question_lengths = np.array([np.count_nonzero(ex.base_question) for ex in examples], dtype=np.float32)
+    fact_lengths = np.array([np.max(np.count_nonzero(ex.facts, axis=-1)) for ex in examples], dtype=np.float32)
+    target_lengths = np.array([np.count_nonzero(ex.rephrased_question) for ex in examples], dtype=np.float32)
+    return question_lengths, fact_lengths, target_lengths
+
+
+def fit_length_budget(examples: List[RepeatQExample], mode="linear", coverage=0.99) -> Tuple[float, float, float]:
+    """
+    Fits a per-example decoding length budget of the form
+    `question_coefficient * base question length + fact_coefficient * longest fact length + intercept`.
+    :param mode: "heuristic" uses the base question length plus the longest fact length, "linear" fits both
+    coefficients with least squares. In both cases, the intercept is chosen so that the budget covers `coverage` of
+    the examples' targets.
+    :return: The (question_coefficient, fact_coefficient, intercept) triple.
+    """
+    question_lengths, fact_lengths, target_lengths = example_lengths(examples)
+    if mode == "heuristic":
+        question_coefficient, fact_coefficient = 1.0, 1.0
+    elif mode == "linear":
+        design = np.stack((question_lengths, fact_lengths, np.ones_like(question_lengths)), axis=-1)
+        (question_coefficient, fact_coefficient, _), *_ = np.linalg.lstsq(design, target_lengths, rcond=None)
+    else:
+        raise ValueError(f"Length budget mode \"{mode}\" not recognized.")
+    residuals = target_lengths - question_coefficient * question_lengths - fact_coefficient * fact_lengths
+    intercept = float(np.quantile(residuals, coverage))
+    return float(question_coefficient), float(fact_coefficient), intercept
+
+
+def compute_length_budgets(examples: List[RepeatQExample], coefficients, max_length) -> np.ndarray:
+    question_lengths, fact_lengths, _ = example_lengths(examples)
+    question_coefficient, fact_coefficient, intercept = coefficients
+    budgets = np.ceil(question_coefficient * question_lengths + fact_coefficient * fact_lengths + intercept)
+    return np.clip(budgets, 1, max_length)
+
+
+def length_budget_report(examples: List[RepeatQExample], coefficients, max_length):
+    """
+    :return: The share of examples whose target is longer than its budget and the average budget.
+    """
+    _, _, target_lengths = example_lengths(examples)
+    budgets = compute_length_budgets(examples, coefficients, max_length)
+    truncation_rate = float(np.mean(target_lengths > budgets))
+    return truncation_rate, float(np.mean(budgets))
+
+
+def save_length_budget(path, coefficients):
+    with open(path, mode='w') as f:
+        json.dump(dict(zip(("question_coefficient", "fact_coefficient", "intercept"), coefficients)), f)
+    info(f"Length budget saved to '{path}'.")
+
+
+def load_length_budget(path) -> Tuple[float, float, float]:
+    with open(path, mode='r') as f:
+        budget = json.load(f)
+    return budget["question_coefficient"], budget["fact_coefficient"], budget["intercept"]
@@ -0,0 +1,62 @@
+import asyncio
+import json
+import time
+
+import numpy as np
+
+from model.RepeatQ.server import http_message, read_http_message
+
+
+async def _client(requests, counter, latencies, errors, host, port, unix_socket):
+    """
+    Sends requests one after the other on a single kept-alive connection until `counter` is exhausted.
+    """
+    if unix_socket is not None:
+        reader, writer = await asyncio.open_unix_connection(path=unix_socket)
+    else:
+        reader, writer = await asyncio.open_connection(host=host, port=port)
+    try:
+        while True:
+            try:
+                i = next(counter)
+            except StopIteration:
+                break
+            start = time.perf_counter()
+            writer.write(http_message("POST /rewrite HTTP/1.1", requests[i % len(requests)], {"Host": host}))
+            await writer.drain()
+            status_line, _, body = await read_http_message(reader)
+            status = int(status_line.split(" ")[1])
+            if status == 200:
+                latencies.append(time.perf_counter() - start)
+            else:
+                errors[status] = errors.get(status, 0) + 1
+    finally:
+        writer.close()
+
+
+async def run_load_test(requests, nb_requests, concurrency, host="127.0.0.1", port=8080, unix_socket=None):
+    """
+    Sends `nb_requests` requests (cycling through `requests`) to a running `RewriteServer` from `concurrency`
+    concurrent clients.
+    :return: The throughput (successful requests per second), the p50 and p99 latencies in milliseconds and the
+    number of failed requests per HTTP status.
+    """
+    counter = iter(range(nb_requests))
+    latencies, errors = [], {}
+    start = time.perf_counter()
+    await asyncio.gather(*(
+        _client(requests, counter, latencies, errors, host, port, unix_socket) for _ in range(concurrency)
+    ))
+    elapsed = time.perf_counter() - start
+    if len(latencies) == 0:
+        return 0.0, float("nan"), float("nan"), errors
+    p50, p99 = np.percentile(np.array(latencies) * 1000, (50, 99))
+    return len(latencies) / elapsed, float(p50), float(p99), errors
+
+
+def load_requests(path):
+    """
+    :return: The examples of a dataset file, which are valid requests (their target is ignored by the server).
+    """
+    with open(path, mode='r') as f:
+        return [example for example in json.load(f) if example["target"] != ""]
@@ -1,19 +1,27 @@
-import functools
 from collections import namedtuple
+import numpy as np
 import tensorflow as tf
 from tensorflow import Tensor
 
 from defs import REPEAT_Q_EMBEDDINGS_FILENAME, PAD_TOKEN, REPEAT_Q_TRAIN_CHECKPOINTS_DIR
 from logging_mixin import LoggingMixin
+from model.RepeatQ.copy_drafts import propose_copy_drafts
+from model.RepeatQ.decoding_constraints import banned_tokens_mask, write_step
 from model.RepeatQ.layers.decoder import Decoder
 from model.RepeatQ.layers.embedding import Embedding
 from model.RepeatQ.layers.fact_encoder import FactEncoder
 from model.RepeatQ.layers.attention import Attention
 from model.RepeatQ.model_config import ModelConfiguration
+from model.RepeatQ.precision import set_mixed_precision, compute_dtype
+from model.RepeatQ.shortlist import OutputShortlist, batch_shortlist_ids, shortlist_positions, sampled_softmax_ids
+from model.RepeatQ.tracing import TRACES, input_signature, decoding_signature, DECODING_FEATURES
 
 
 class RepeatQ(LoggingMixin, tf.keras.models.Model):
 
+    # Log-probability given to impossible candidates (finite to avoid NaNs in arithmetic)
+    NEG_INF = -1e9
+
     NetworkState = namedtuple("NetworkState", (
         "base_question",
         "base_question_encodings",
@@ -31,9 +39,12 @@ class RepeatQ(LoggingMixin, tf.keras.models.Model):
                  *args,
                  **kwargs
                  ):
+        # The policy applies to every layer built from now on, including this model
+        set_mixed_precision(config.mixed_precision)
         super(RepeatQ, self).__init__(*args, **kwargs)
 
         self.config = config
+        self.float_dtype = compute_dtype()
         self.vocabulary_word_to_id = voc_word_to_id
         self.question_mark_id = voc_word_to_id["?"]
 
@@ -49,9 +60,22 @@ class RepeatQ(LoggingMixin, tf.keras.models.Model):
         self.U_copy_dropout = tf.keras.layers.Dropout(self.config.dropout_rate, name="U_copy_dropout")
         self.Z_copy = tf.keras.layers.Dense(units=64, name="Z_copy", activation="relu")
         self.Z_copy_dropout = tf.keras.layers.Dropout(self.config.dropout_rate, name="V_copy_dropout")
-        self.origin_probs_layer = tf.keras.layers.Dense(units=3, name="origin_probs_layer", activation="softmax")
+        # Softmax outputs are kept in float32
+        self.origin_probs_layer = tf.keras.layers.Dense(units=3, name="origin_probs_layer", activation="softmax",
+                                                        dtype=tf.float32)
         self.origin_probs_layer_dropout = tf.keras.layers.Dropout(self.config.dropout_rate, name="origin_probs_dropout")
 
+        self.shortlist_candidate_table = None
+        # Optional `EncoderCache` of the encoder outputs, used by the eager inference paths
+        self.encoder_cache = None
+        # Inference decoding functions by batch shape and beam size (see `decoding_function`), not tracked as
+        # dependencies of the model
+        self._setattr_tracking = False
+        self.decoding_functions = {}
+        self._setattr_tracking = True
+        if config.shortlist_size > 0 and config.shortlist_candidates:
+            self.shortlist_candidate_table = tf.constant(np.load(config.shortlist_candidates_path), dtype=tf.int32)
+
         if config.with_question_encodings:
             # Base question encoder
             self.base_question_encoder = tf.keras.layers.Bidirectional(tf.keras.layers.LSTM(
@@ -74,8 +98,12 @@ class RepeatQ(LoggingMixin, tf.keras.models.Model):
             self.load_weights(path)
             self.log.info(f"Model successfully restored from '{path}'.")
 
-    def call(self, inputs, constants=None, training=None, mask=None):
-
+    def call(self, inputs, constants=None, training=None, mask=None, token_projections=None, shortlist=None):
+        if token_projections is None:
+            previous_token_embedding = self.embedding_layer.embed_words(inputs.observation)
+        else:
+            # The previous tokens' projections are precomputed, so their embeddings aren't looked up at each step
+            previous_token_embedding = tf.zeros((0, self.embedding_layer.size), dtype=self.float_dtype)
         voc_logits, \
         (hidden_state, carry_state), \
         (question_att_vector, question_copy_logits), \
@@ -83,14 +111,16 @@ class RepeatQ(LoggingMixin, tf.keras.models.Model):
             inputs={
                 "base_question_encodings": inputs.base_question_encodings,
                 "facts_encodings": inputs.facts_encodings,
-                "previous_token_embedding": self.embedding_layer.embed_words(inputs.observation),
+                "previous_token_embedding": previous_token_embedding,
                 "decoder_state": inputs.decoder_states
             },
             mask={
                 "facts": tf.not_equal(inputs.facts, 0),
                 "base_question": tf.not_equal(inputs.base_question, 0)
             },
-            training=training
+            training=training,
+            token_projections=token_projections,
+            shortlist=shortlist
         )
 
         origin_probs = self.origin_probs_layer(self.origin_probs_layer_dropout(
@@ -110,60 +140,123 @@ class RepeatQ(LoggingMixin, tf.keras.models.Model):
 
         hidden_state = tf.where(mask, hidden_state, inputs.decoder_states[0])
         carry_state = tf.where(mask, carry_state, inputs.decoder_states[1])
+        # Output distributions and losses are computed in float32
+        voc_logits = tf.cast(voc_logits, tf.float32)
+        question_copy_logits = tf.cast(question_copy_logits, tf.float32)
+        facts_copy_logits = tf.cast(facts_copy_logits, tf.float32)
 
         return voc_logits, question_copy_logits, facts_copy_logits, origin_probs, (hidden_state, carry_state)
 
     def get_initial_state(self, base_question, base_question_features, facts, facts_features, batch_size,
                           training=None):
-        base_question_embeddings = self.embedding_layer({"sentence": base_question, "features": base_question_features})
-        if self.base_question_encoder is None:
-            base_question_encodings = base_question_embeddings
-            initial_hidden_state = tf.zeros((batch_size, self.config.decoder_hidden_size))
+        if self.encoder_cache is not None and not training and tf.executing_eagerly():
+            base_question_encodings, initial_hidden_state, facts_encodings = self.encoder_cache.encode(
+                self, base_question, base_question_features, facts, facts_features
+            )
         else:
-            base_question_encodings, forward_h, _, backward_h, _ = self.base_question_encoder(base_question_embeddings)
-            # Use the last hidden state of the question encoder as initial state
-            initial_hidden_state = backward_h
-        facts_embeddings = self.embedding_layer({"sentence": facts, "features": facts_features})
-        facts_encodings = self.fact_encoder(facts_embeddings, training=training)
+            base_question_encodings, initial_hidden_state = self.encode_question(
+                base_question, base_question_features, training=training
+            )
+            facts_encodings = self.encode_facts(facts, facts_features, training=training)
 
         network_state = RepeatQ.NetworkState(
             base_question=base_question,
             base_question_encodings=base_question_encodings,
             facts=facts,
             facts_encodings=facts_encodings,
-            decoder_states=(initial_hidden_state, tf.zeros(shape=(batch_size, self.config.decoder_hidden_size))),
+            decoder_states=(
+                initial_hidden_state,
+                tf.zeros(shape=(batch_size, self.config.decoder_hidden_size), dtype=self.float_dtype)
+            ),
             observation=tf.zeros(shape=(batch_size,), dtype=tf.int32),
             is_first_step=True
         )
         return network_state
 
+    def encode_question(self, base_question, base_question_features, training=None):
+        """
+        :return: The base question encodings and the initial hidden state of the decoder.
+        """
+        base_question_embeddings = self.embedding_layer({"sentence": base_question, "features": base_question_features})
+        if self.base_question_encoder is None:
+            batch_size = base_question.shape[0]
+            return base_question_embeddings, tf.zeros((batch_size, self.config.decoder_hidden_size),
+                                                      dtype=self.float_dtype)
+        base_question_encodings, forward_h, _, backward_h, _ = self.base_question_encoder(base_question_embeddings)
+        # Use the last hidden state of the question encoder as initial state
+        return base_question_encodings, backward_h
+
+    def encode_facts(self, facts, facts_features, training=None):
+        facts_embeddings = self.embedding_layer({"sentence": facts, "features": facts_features})
+        return self.fact_encoder(facts_embeddings, training=training)
+
     @tf.function
-    def get_actions(self, inputs, target, training):
+    def get_actions(self, inputs, target, training, compute_loss=False, dropout=True):
+        """
+        :param compute_loss: Only in training mode. If True, the masked cross-entropy of the target is computed at
+        each step and only the mean loss is returned instead of the output distributions of every step.
+        :param dropout: If False, dropout is disabled in training mode, which then only means teacher forcing (ex: to
+        get the output distributions of a distillation teacher).
+        :return: The actions and either the output distributions of every step (None when not training) or the loss.
+        """
+        TRACES.traced("RepeatQ.get_actions", training=training, compute_loss=compute_loss, dropout=dropout,
+                      **input_signature(inputs))
+        # Output distributions are only kept for the training losses computed outside of this function
+        store_logits = training and not compute_loss
+        layers_training = training and dropout
         if training:
             batch_size = target.get_shape()[0]
         else:
             batch_size = inputs["base_question"].get_shape()[0]
         finished = tf.fill(dims=(batch_size,), value=False)
+        base_question, facts = inputs["base_question"], inputs["facts"]
+        base_question_features, facts_features = inputs["base_question_features"], inputs["facts_features"]
 
+        budget = None
         if training:
-            size = target.shape[1]
+            # Beam search outputs used as targets (sequence-level distillation) have a dynamic length
+            size = target.shape[1] if target.shape[1] is not None else tf.shape(target)[1]
         else:
             size = self.config.max_generated_question_length
-
-        base_question, facts = inputs["base_question"], inputs["facts"]
-        base_question_features, facts_features = inputs["base_question_features"], inputs["facts_features"]
+            budget = self.decoding_budget(base_question, facts)
+            if budget is not None:
+                size = tf.reduce_max(budget)
         network_state = self.get_initial_state(
             base_question=base_question,
             base_question_features=base_question_features,
             facts=facts,
             facts_features=facts_features,
             batch_size=batch_size,
-            training=training
+            training=layers_training
         )
 
-        all_logits = tf.TensorArray(dtype=tf.float32, size=size, name="logits")
+        token_projections = None
+        if training and self.config.precomputed_teacher_forcing:
+            # The previous tokens are the target shifted right, starting with a padding token
+            previous_tokens = tf.pad(target[:, :-1], paddings=((0, 0), (1, 0)))
+            token_projections = self.decoder.precompute_token_projections(
+                self.embedding_layer.embed_words(previous_tokens),
+                attention_input_size=network_state.facts_encodings.get_shape()[-1] +
+                network_state.base_question_encodings.get_shape()[-1],
+                training=layers_training
+            )
+
+        shortlist = None
+        if not training:
+            shortlist = self.output_shortlist(base_question, facts)
+        elif compute_loss and self.config.sampled_softmax_size > 0:
+            shortlist = self.sampled_output_shortlist(base_question, facts, target)
+        elif compute_loss and self.config.shortlist_in_training:
+            # Target words must be in the shortlist for the loss to be defined
+            shortlist = self.output_shortlist(base_question, facts, target=target)
+
+        # Always created since it's a loop variable, but left empty when the distributions aren't stored
+        all_logits = tf.TensorArray(dtype=tf.float32, size=size if store_logits else 0, name="logits")
         actions = tf.TensorArray(dtype=tf.int32, size=size, name="agent_actions")
         ite = tf.constant(0, dtype=tf.int32)
+        loss_sum, loss_weights_sum = tf.constant(0.0), tf.constant(0.0)
+        # Generated tokens, used to enforce the decoding constraints
+        history = tf.zeros((batch_size, self.config.max_generated_question_length), dtype=tf.int32)
 
         def _continue_loop(it, beams_finished):
             if training:
@@ -173,17 +266,46 @@ class RepeatQ(LoggingMixin, tf.keras.models.Model):
 
         while _continue_loop(ite, finished):
             voc_logits, question_word_logits, facts_word_logits, origin_probs, decoder_states = self(
-                network_state, training=training
+                network_state,
+                training=layers_training,
+                token_projections=None if token_projections is None else
+                Decoder.token_projections_at(token_projections, ite),
+                shortlist=shortlist
             )
 
-            predicted_tokens = tf.squeeze(RepeatQ.get_output_tokens(
-                voc_logits=voc_logits,
-                base_question_logits=question_word_logits,
-                facts_logits=facts_word_logits,
-                facts=facts,
-                origin_probs=origin_probs,
-                base_question=base_question
-            ), axis=-1)
+            banned_tokens = None if training else self.banned_tokens(history, ite)
+            # Assigned at every step, so that autograph doesn't make it a loop variable undefined before the loop
+            output_distribution = None
+            if self.config.fused_output_head:
+                output_distribution = RepeatQ.fused_output_distribution(
+                    voc_logits=voc_logits,
+                    base_question_logits=question_word_logits,
+                    facts_logits=facts_word_logits,
+                    origin_probs=origin_probs,
+                    base_question=base_question,
+                    facts=facts,
+                    shortlist=shortlist
+                )
+                selection_distribution = output_distribution
+                if banned_tokens is not None:
+                    if shortlist is not None:
+                        banned_tokens = tf.gather(banned_tokens, shortlist.ids, axis=-1)
+                    selection_distribution = tf.where(banned_tokens, tf.zeros_like(output_distribution),
+                                                      output_distribution)
+                predicted_tokens = tf.argmax(selection_distribution, axis=-1, output_type=tf.int32)
+                if shortlist is not None:
+                    predicted_tokens = tf.gather(shortlist.ids, predicted_tokens)
+            else:
+                predicted_tokens = tf.squeeze(RepeatQ.get_output_tokens(
+                    voc_logits=voc_logits,
+                    base_question_logits=question_word_logits,
+                    facts_logits=facts_word_logits,
+                    facts=facts,
+                    origin_probs=origin_probs,
+                    base_question=base_question,
+                    banned_tokens=banned_tokens,
+                    shortlist=shortlist
+                ), axis=-1)
 
             if training:
                 predicted_tokens = \
@@ -195,13 +317,37 @@ class RepeatQ(LoggingMixin, tf.keras.models.Model):
                 predicted_tokens.set_shape(shape=(batch_size,))
 
             actions = actions.write(ite, predicted_tokens)
+            if self.has_decoding_constraints and not training:
+                history = write_step(history, ite, predicted_tokens)
 
-            pointer_softmax = tf.concat((
-                origin_probs[..., 0:1] * RepeatQ.stable_softmax(voc_logits),
-                origin_probs[..., 1:2] * RepeatQ.stable_softmax(question_word_logits),
-                origin_probs[..., 2:3] * RepeatQ.stable_softmax(facts_word_logits)
-            ), axis=-1, name="pointer_softmax")
-            all_logits = all_logits.write(ite, pointer_softmax)
+            if store_logits and self.config.fused_output_head:
+                # Copy mass is already merged onto the vocabulary ids, [batch size, vocabulary size]
+                all_logits = all_logits.write(ite, output_distribution)
+            elif store_logits:
+                pointer_softmax = tf.concat((
+                    origin_probs[..., 0:1] * RepeatQ.stable_softmax(voc_logits),
+                    origin_probs[..., 1:2] * RepeatQ.stable_softmax(question_word_logits),
+                    origin_probs[..., 2:3] * RepeatQ.stable_softmax(facts_word_logits)
+                ), axis=-1, name="pointer_softmax")
+                all_logits = all_logits.write(ite, pointer_softmax)
+
+            if training and compute_loss:
+                if self.config.fused_output_head:
+                    target_probs = RepeatQ.fused_target_probs(output_distribution, target[:, ite], shortlist=shortlist)
+                else:
+                    target_probs = RepeatQ.pointer_target_probs(
+                        voc_logits=voc_logits,
+                        base_question_logits=question_word_logits,
+                        facts_logits=facts_word_logits,
+                        origin_probs=origin_probs,
+                        target_words=target[:, ite],
+                        target_copy_indicator=inputs["target_copy_indicator"][:, ite],
+                        shortlist=shortlist
+                    )
+                # Padding tokens don't count in the loss
+                step_weights = tf.cast(tf.not_equal(target[:, ite], 0), tf.float32)
+                loss_sum += tf.reduce_sum(step_weights * RepeatQ.cross_entropy(target_probs))
+                loss_weights_sum += tf.reduce_sum(step_weights)
 
             if training:
                 # training mode, we use teacher forcing
@@ -229,14 +375,335 @@ class RepeatQ(LoggingMixin, tf.keras.models.Model):
                     finished,
                     tf.logical_or(tf.equal(predicted_tokens, 0), tf.equal(predicted_tokens, self.question_mark_id))
                 )
+                if budget is not None:
+                    finished = tf.logical_or(finished, tf.greater_equal(ite, budget))
             finished.set_shape(shape=(batch_size,))
         # Switch from time major to batch major
         actions = tf.transpose(actions.stack()[:ite])
+        if training and compute_loss:
+            return actions, loss_sum / loss_weights_sum
+        if not store_logits:
+            return actions, None
         all_logits = tf.transpose(all_logits.stack()[:ite], perm=[1, 0, 2])
         return actions, all_logits
 
+    def decoding_function(self, features, beam_search_size=1):
+        """
+        Inference decoding for the batch shape of `features` (bucketed lengths), as a function with an input signature:
+        it's traced once, and batches of other shapes are rejected instead of silently traced again. The decoding flags
+        are bound to inference (no teacher forcing, loss or dropout), the beam size sets the shapes of the search so
+        each beam size has its own function.
+        :param features: Features (or their specs) of a batch.
+        :param beam_search_size: Greedy decoding (`get_actions`) if 1, `beam_search` with this beam size otherwise.
+        :return: The function mapping the base question, its features, the facts and their features to the predicted
+        tokens.
+        """
+        signature = decoding_signature(features)
+        key = (tuple(tuple(spec.shape.as_list()) for spec in signature), beam_search_size)
+        if key not in self.decoding_functions:
+            def decode(base_question, base_question_features, facts, facts_features):
+                inputs = dict(zip(DECODING_FEATURES, (base_question, base_question_features, facts, facts_features)))
+                if beam_search_size > 1:
+                    return self.beam_search(inputs, beam_search_size=beam_search_size)
+                tokens, _ = self.get_actions(inputs, None, training=False)
+                return tokens
+
+            self.decoding_functions[key] = tf.function(decode, input_signature=signature)
+        return self.decoding_functions[key]
+
+    def decode(self, inputs, beam_search_size=1):
+        """
+        Decodes a batch with the `decoding_function` of its shape.
+        :return: The predicted tokens, [batch size, generated question length].
+        """
+        return self.decoding_function(inputs, beam_search_size)(*[inputs[name] for name in DECODING_FEATURES])
+
+    def greedy_decode(self, inputs):
+        """
+        Batched greedy decoding for inference. Rows are dropped from the decoded batch once they emitted a question
+        mark or a padding token, so that the remaining steps only run on unfinished rows. To bound the number of
+        traced step functions, the batch is only compacted when its unfinished rows fit in a smaller power of two.
+        :param inputs: Same features as the ones passed to `get_actions`.
+        :return: The predicted tokens, [batch size, max generated question length], in the original batch order.
+        """
+        batch_size = inputs["base_question"].get_shape()[0]
+        max_length = self.config.max_generated_question_length
+        network_state = self.get_initial_state(
+            base_question=inputs["base_question"],
+            base_question_features=inputs["base_question_features"],
+            facts=inputs["facts"],
+            facts_features=inputs["facts_features"],
+            batch_size=batch_size,
+            training=False
+        )
+        budget = self.decoding_budget(inputs["base_question"], inputs["facts"])
+        budget = np.full((batch_size,), max_length) if budget is None else budget.numpy()
+        predictions = np.zeros((batch_size, max_length), dtype=np.int32)
+        # Original batch position of each row of the decoded batch
+        rows = np.arange(batch_size)
+        finished = np.zeros((batch_size,), dtype=bool)
+        for step in range(np.max(budget)):
+            predicted_tokens, decoder_states = self.greedy_step(
+                network_state, tf.constant(predictions[rows]), tf.constant(step, dtype=tf.int32)
+            )
+            predicted_tokens = predicted_tokens.numpy()
+            predictions[rows[~finished], step] = predicted_tokens[~finished]
+            finished = np.logical_or(
+                finished, np.logical_or(predicted_tokens == 0, predicted_tokens == self.question_mark_id)
+            )
+            finished = np.logical_or(finished, step + 1 >= budget[rows])
+            nb_unfinished = np.sum(~finished)
+            if nb_unfinished == 0:
+                break
+            network_state = network_state._replace(
+                decoder_states=decoder_states, observation=tf.constant(predicted_tokens), is_first_step=False
+            )
+            kept = RepeatQ.compacted_rows(finished)
+            if kept is not None:
+                network_state = RepeatQ.gather_network_state(network_state, kept)
+                rows, finished = rows[kept], finished[kept]
+        return predictions
+
+    def speculative_decode(self, inputs, draft_length=4):
+        """
+        Greedy decoding which proposes multi-token drafts copied from the base question and the facts, and verifies
+        them with a single teacher-forced pass of the decoder. The longest draft prefix that agrees with greedy
+        decoding is accepted, along with the greedy token following it, so predictions are identical to
+        `greedy_decode` while taking fewer calls when the output copies long spans.
+        :param inputs: Same features as the ones passed to `get_actions`.
+        :param draft_length: Number of tokens in each draft (and number of decoder steps per verification pass).
+        :return: The predicted tokens, [batch size, max generated question length], in the original batch order.
+        """
+        batch_size = inputs["base_question"].get_shape()[0]
+        max_length = self.config.max_generated_question_length
+        network_state = self.get_initial_state(
+            base_question=inputs["base_question"],
+            base_question_features=inputs["base_question_features"],
+            facts=inputs["facts"],
+            facts_features=inputs["facts_features"],
+            batch_size=batch_size,
+            training=False
+        )
+        budget = self.decoding_budget(inputs["base_question"], inputs["facts"])
+        budget = np.full((batch_size,), max_length) if budget is None else budget.numpy()
+        predictions = np.zeros((batch_size, max_length), dtype=np.int32)
+        rows = np.arange(batch_size)
+        positions = np.zeros((batch_size,), dtype=np.int32)
+        finished = np.zeros((batch_size,), dtype=bool)
+        while not np.all(finished):
+            tokens, nb_emitted, decoder_states, observation, rows_finished = self.speculative_step(
+                network_state,
+                tf.constant(predictions[rows]),
+                tf.constant(positions[rows]),
+                tf.constant(budget[rows], dtype=tf.int32),
+                draft_length
+            )
+            tokens, nb_emitted = tokens.numpy(), nb_emitted.numpy()
+            # Writes the emitted tokens of the unfinished rows at their own positions
+            emitted_rows, emitted_steps = np.nonzero(
+                np.logical_and(np.arange(draft_length)[None, :] < nb_emitted[:, None], ~finished[:, None])
+            )
+            predictions[rows[emitted_rows], positions[rows[emitted_rows]] + emitted_steps] = \
+                tokens[emitted_rows, emitted_steps]
+            positions[rows[~finished]] += nb_emitted[~finished]
+            finished = np.logical_or(finished, rows_finished.numpy())
+            network_state = network_state._replace(
+                decoder_states=decoder_states, observation=observation, is_first_step=False
+            )
+            kept = RepeatQ.compacted_rows(finished)
+            if kept is not None:
+                network_state = RepeatQ.gather_network_state(network_state, kept)
+                rows, finished = rows[kept], finished[kept]
+        return predictions
+
+    @tf.function
+    def speculative_step(self, network_state, history, positions, budget, draft_length):
+        """
+        Runs `draft_length` teacher-forced decoder steps on copy drafts and keeps the part agreeing with greedy
+        decoding.
+        :return: The greedy tokens at each step ([rows, draft length]), the number of them that were accepted, the
+        decoder states and observation after the last accepted token, and whether each row finished.
+        """
+        drafts = propose_copy_drafts(
+            history, positions, network_state.base_question, network_state.facts, draft_length
+        )
+        shortlist = self.output_shortlist(network_state.base_question, network_state.facts)
+        decoder_states = network_state.decoder_states
+        observation = network_state.observation
+        predicted_tokens, hidden_states, carry_states = [], [], []
+        for j in range(draft_length):
+            step_network_state = network_state._replace(
+                decoder_states=decoder_states,
+                observation=observation,
+                is_first_step=network_state.is_first_step and j == 0
+            )
+            voc_logits, question_word_logits, facts_word_logits, origin_probs, decoder_states = self(
+                step_network_state, training=False, shortlist=shortlist
+            )
+            predicted_tokens.append(tf.squeeze(RepeatQ.get_output_tokens(
+                voc_logits=voc_logits,
+                base_question_logits=question_word_logits,
+                facts_logits=facts_word_logits,
+                facts=network_state.facts,
+                origin_probs=origin_probs,
+                base_question=network_state.base_question,
+                banned_tokens=self.banned_tokens(history, positions + j),
+                fused=self.config.fused_output_head,
+                shortlist=shortlist
+            ), axis=-1))
+            hidden_states.append(decoder_states[0])
+            carry_states.append(decoder_states[1])
+            # Teacher forcing on the draft, as long as the draft is accepted this is exactly greedy decoding
+            observation = drafts[:, j]
+            if self.has_decoding_constraints:
+                history = write_step(history, positions + j, observation)
+        # [rows, draft length]
+        predicted_tokens = tf.stack(predicted_tokens, axis=1)
+        nb_accepted = tf.reduce_sum(
+            tf.math.cumprod(tf.cast(tf.equal(predicted_tokens, drafts), tf.int32), axis=1), axis=1
+        )
+        # The greedy token right after the accepted draft prefix comes for free
+        nb_emitted = tf.minimum(nb_accepted + 1, draft_length)
+        is_end = tf.logical_or(tf.equal(predicted_tokens, 0), tf.equal(predicted_tokens, self.question_mark_id))
+        first_end = tf.argmax(tf.cast(is_end, tf.int32), axis=1, output_type=tf.int32)
+        ends = tf.logical_and(tf.reduce_any(is_end, axis=1), tf.less(first_end, nb_emitted))
+        nb_emitted = tf.where(ends, first_end + 1, nb_emitted)
+        nb_emitted = tf.minimum(nb_emitted, budget - positions)
+        finished = tf.logical_or(ends, tf.greater_equal(positions + nb_emitted, budget))
+
+        last_step = tf.maximum(nb_emitted - 1, 0)
+        decoder_states = (
+            tf.gather(tf.stack(hidden_states, axis=1), last_step, batch_dims=1),
+            tf.gather(tf.stack(carry_states, axis=1), last_step, batch_dims=1)
+        )
+        observation = tf.gather(predicted_tokens, last_step, batch_dims=1)
+        return predicted_tokens, nb_emitted, decoder_states, observation, finished
+
+    @staticmethod
+    def compacted_rows(finished):
+        """
+        :param finished: Whether each row of the decoded batch is finished.
+        :return: The rows to keep when the unfinished rows fit in a smaller power of two (every unfinished row plus
+        finished ones to fill up the bucket), None if the batch shouldn't be compacted.
+        """
+        nb_unfinished = np.sum(~finished)
+        bucket_size = 2 ** int(np.ceil(np.log2(max(nb_unfinished, 1))))
+        if bucket_size >= len(finished):
+            return None
+        return np.concatenate((np.where(~finished)[0], np.where(finished)[0]))[:bucket_size]
+
+    @tf.function
+    def greedy_step(self, network_state, history, step):
+        # Built from the rows still being decoded, inside the step so that its varying size doesn't cause retracing
+        shortlist = self.output_shortlist(network_state.base_question, network_state.facts)
+        voc_logits, question_word_logits, facts_word_logits, origin_probs, decoder_states = self(
+            network_state, training=False, shortlist=shortlist
+        )
+        predicted_tokens = tf.squeeze(RepeatQ.get_output_tokens(
+            voc_logits=voc_logits,
+            base_question_logits=question_word_logits,
+            facts_logits=facts_word_logits,
+            facts=network_state.facts,
+            origin_probs=origin_probs,
+            base_question=network_state.base_question,
+            banned_tokens=self.banned_tokens(history, step),
+            fused=self.config.fused_output_head,
+            shortlist=shortlist
+        ), axis=-1)
+        return predicted_tokens, decoder_states
+
+    @staticmethod
+    def gather_network_state(network_state, indices):
+        """
+        Selects the given rows of every batched tensor of a network state.
+        """
+        return RepeatQ.NetworkState(
+            base_question=tf.gather(network_state.base_question, indices),
+            base_question_encodings=tf.gather(network_state.base_question_encodings, indices),
+            facts=tf.gather(network_state.facts, indices),
+            facts_encodings=tf.gather(network_state.facts_encodings, indices),
+            decoder_states=tuple(tf.gather(s, indices) for s in network_state.decoder_states),
+            observation=tf.gather(network_state.observation, indices),
+            is_first_step=network_state.is_first_step
+        )
+
+    @property
+    def has_decoding_constraints(self):
+        return self.config.no_repeat_ngram_size > 0 or self.config.max_adjacent_duplicate_size > 0
+
+    def decoding_budget(self, base_question, facts):
+        """
+        Per-example maximum number of decoding steps, derived from the base question length and the longest fact.
+        :return: The budgets, [batch size], or None if no length budget is configured.
+        """
+        if self.config.length_budget is None:
+            return None
+        question_coefficient, fact_coefficient, intercept = self.config.length_budget
+        question_lengths = tf.reduce_sum(tf.cast(tf.not_equal(base_question, 0), tf.float32), axis=-1)
+        fact_lengths = tf.reduce_max(tf.reduce_sum(tf.cast(tf.not_equal(facts, 0), tf.float32), axis=-1), axis=-1)
+        budget = tf.math.ceil(question_coefficient * question_lengths + fact_coefficient * fact_lengths + intercept)
+        return tf.clip_by_value(tf.cast(budget, tf.int32), 1, self.config.max_generated_question_length)
+
+    def banned_tokens(self, history, step):
+        """
+        :return: The mask of tokens banned by the decoding constraints given the tokens generated so far, or None if
+        no constraint is enabled.
+        """
+        if not self.has_decoding_constraints:
+            return None
+        return banned_tokens_mask(
+            history=history,
+            step=step,
+            vocab_size=len(self.vocabulary_word_to_id),
+            no_repeat_ngram_size=self.config.no_repeat_ngram_size,
+            max_adjacent_duplicate_size=self.config.max_adjacent_duplicate_size
+        )
+
+    def output_shortlist(self, base_question, facts, target=None):
+        """
+        :param target: Target questions of the batch, only during training.
+        :return: The `OutputShortlist` of the batch, or None if no shortlist is configured.
+        """
+        if self.config.shortlist_size <= 0:
+            return None
+        vocab_size = len(self.vocabulary_word_to_id)
+        ids = batch_shortlist_ids(
+            nb_frequent_words=min(self.config.shortlist_size, vocab_size),
+            base_question=base_question,
+            facts=facts,
+            candidate_table=self.shortlist_candidate_table,
+            target=target
+        )
+        kernel, bias = self.decoder.shortlist_output_weights(ids)
+        return OutputShortlist(ids=ids, positions=shortlist_positions(ids, vocab_size), kernel=kernel, bias=bias)
+
+    def sampled_output_shortlist(self, base_question, facts, target):
+        """
+        Sampled softmax training: the vocabulary logits are only computed for the words of the batch and sampled
+        negative words, and corrected by the log of each word's expected count in the sample (see
+        `sampled_softmax_ids`). The copy distributions are left untouched.
+        :return: The `OutputShortlist` of the sampled words.
+        """
+        vocab_size = len(self.vocabulary_word_to_id)
+        ids, corrections = sampled_softmax_ids(
+            nb_sampled=min(self.config.sampled_softmax_size, vocab_size),
+            vocab_size=vocab_size,
+            base_question=base_question,
+            facts=facts,
+            target=target
+        )
+        kernel, bias = self.decoder.shortlist_output_weights(ids)
+        return OutputShortlist(
+            ids=ids,
+            positions=shortlist_positions(ids, vocab_size),
+            kernel=kernel,
+            bias=bias - corrections
+        )
+
     @tf.function
     def beam_search(self, inputs, beam_search_size=5, training=False, return_probs=False):
+        TRACES.traced("RepeatQ.beam_search", beam_search_size=beam_search_size, training=training,
+                      return_probs=return_probs, **input_signature(inputs))
         base_question, facts = inputs["base_question"], inputs["facts"]
         base_question_features, facts_features = inputs["base_question_features"], inputs["facts_features"]
 
@@ -249,12 +716,18 @@ class RepeatQ(LoggingMixin, tf.keras.models.Model):
             return tf.reshape(t, shape=(collapsed_dimension, *t.get_shape()[2:]))
 
         def recover_dims(t: Tensor):
-            return tf.reshape(t, shape=(batch_size, beam_search_size, *t.get_shape()[1:]))
+            # The last dimension of the logits is unknown with an output shortlist
+            inner_dims = (-1 if d is None else d for d in t.get_shape()[1:])
+            return tf.reshape(t, shape=(batch_size, beam_search_size, *inner_dims))
 
         def batchify(t: Tensor, name):
             t = tf.repeat(tf.expand_dims(t, axis=1), repeats=beam_search_size, axis=1, name=name)
             return collapse_dims(t)
 
+        def gather_beams(t: Tensor, indices):
+            # Reorders the beams of a collapsed [batch size * beam size, ...] tensor
+            return collapse_dims(tf.gather(recover_dims(t), indices, axis=1, batch_dims=1))
+
         initial_network_state = self.get_initial_state(
             base_question=base_question,
             base_question_features=base_question_features,
@@ -272,33 +745,31 @@ class RepeatQ(LoggingMixin, tf.keras.models.Model):
             batchify(initial_network_state.decoder_states[1], "decoder_carry_states")
         )
         observations = batchify(initial_network_state.observation, name="observations")
-        beams = tf.zeros(shape=(batch_size, beam_search_size, beam_length), dtype=tf.int32, name="beams")
-        beam_log_probs = tf.expand_dims(tf.repeat(
-            tf.expand_dims(tf.concat((tf.zeros(shape=(beam_search_size - 1,)), [-1.0]), axis=0), axis=0),
-            repeats=batch_size,
-            axis=0,
-            name="beam_probs"
-        ), axis=-1)
+        shortlist = None
+        if not training or self.config.shortlist_in_training:
+            shortlist = self.output_shortlist(initial_network_state.base_question, initial_network_state.facts)
+        budget = self.decoding_budget(initial_network_state.base_question, initial_network_state.facts)
+        # Only the first beam is alive at the beginning, otherwise the first expansion would yield k identical beams
+        beam_log_probs = tf.tile(
+            tf.expand_dims(tf.one_hot(0, beam_search_size, on_value=0.0, off_value=RepeatQ.NEG_INF), axis=0),
+            multiples=(batch_size, 1),
+            name="beam_log_probs"
+        )
+        # A finished beam is carried over through its first candidate only, with its score unchanged
+        finished_candidates_log_probs = tf.one_hot(0, beam_search_size, on_value=0.0, off_value=RepeatQ.NEG_INF)
+        finished = tf.fill((batch_size, beam_search_size), value=False, name="finished_beams")
+        lengths = tf.zeros((batch_size, beam_search_size), dtype=tf.int32, name="beam_lengths")
+        # Hypotheses are stored as the token chosen at each step and a back-pointer to the beam it extends
+        step_tokens = tf.TensorArray(dtype=tf.int32, size=beam_length, element_shape=(batch_size, beam_search_size),
+                                     name="beam_tokens")
+        step_parents = tf.TensorArray(dtype=tf.int32, size=beam_length, element_shape=(batch_size, beam_search_size),
+                                      name="beam_parents")
+        # Hypothesis of each beam so far, only used to enforce the decoding constraints
+        history = tf.zeros((collapsed_dimension, beam_length), dtype=tf.int32, name="beam_history")
         first_step = tf.constant(True)
-        best_beam = tf.zeros(shape=(batch_size, beam_length), dtype=tf.int32, name="best_beam")
-        best_beam_prob = tf.fill((batch_size,), value=tf.float32.min, name="best_beam_prob")
-
-        def beam_not_finished(_beam, _last_ind):
-            return tf.logical_or(
-                tf.less(_last_ind, 0),
-                tf.logical_and(tf.not_equal(_beam[_last_ind], self.question_mark_id), tf.not_equal(_beam[_last_ind], 0))
-            )
-
-        def beams_not_finished(_beam_batches, _last_ind):
-            res = tf.map_fn(
-                lambda _beams: tf.map_fn(functools.partial(beam_not_finished, _last_ind=_last_ind), _beams,
-                                         dtype=tf.bool),
-                _beam_batches,
-                dtype=tf.bool
-            )
-            return tf.expand_dims(res, axis=-1)
+        it = tf.constant(0, dtype=tf.int32)
 
-        for it in tf.range(beam_length):
+        while tf.logical_and(tf.less(it, beam_length), tf.logical_not(tf.reduce_all(finished))):
             beam_network_state = RepeatQ.NetworkState(
                 base_question=base_question,
                 base_question_encodings=base_question_encodings,
@@ -310,85 +781,121 @@ class RepeatQ(LoggingMixin, tf.keras.models.Model):
             )
             # Logits: [batch size * beam size, vocabulary size]
             voc_logits, q_copy_logits, f_copy_logits, origin_probs, decoder_states = self(
-                beam_network_state, training=False
+                beam_network_state, training=False, shortlist=shortlist
             )
-            # [batch size, beam size, vocabulary size]
-            voc_logits = recover_dims(voc_logits)
-            q_copy_logits = recover_dims(q_copy_logits)
-            f_copy_logits = recover_dims(f_copy_logits)
-            origin_probs = recover_dims(origin_probs)
+            banned_tokens = self.banned_tokens(history, it)
+            if banned_tokens is not None:
+                banned_tokens = recover_dims(banned_tokens)
             # top_probs: [batch size, beam size, beam size]
             top_probs, top_words = RepeatQ.get_output_tokens(
-                voc_logits=voc_logits,
-                base_question_logits=q_copy_logits,
+                voc_logits=recover_dims(voc_logits),
+                base_question_logits=recover_dims(q_copy_logits),
                 facts=recover_dims(facts),
-                facts_logits=f_copy_logits,
-                origin_probs=origin_probs,
+                facts_logits=recover_dims(f_copy_logits),
+                origin_probs=recover_dims(origin_probs),
                 base_question=recover_dims(base_question),
-                top_k=beam_search_size
+                top_k=beam_search_size,
+                banned_tokens=banned_tokens,
+                fused=self.config.fused_output_head,
+                shortlist=shortlist
+            )
+            candidates_log_probs = tf.where(
+                tf.expand_dims(finished, axis=-1),
+                tf.expand_dims(beam_log_probs, axis=-1) + finished_candidates_log_probs,
+                tf.expand_dims(beam_log_probs, axis=-1) + tf.math.log(top_probs)
             )
-            decoder_states = tuple(recover_dims(s) for s in decoder_states)
-            # [batch size, beam size, 1] -> [batch size, beam size, beam_size]
-            beam_log_probs = tf.repeat(beam_log_probs, repeats=beam_search_size, axis=-1)
-            top_probs = tf.math.add(tf.math.log(top_probs), beam_log_probs)
-            # Masks finished beams probs
-            beam_mask = beams_not_finished(beams, it - 1)
-            top_probs = tf.where(beam_mask, top_probs, tf.zeros_like(top_probs, dtype=tf.float32))
-            top_words = tf.where(beam_mask, top_words, tf.zeros_like(top_words, dtype=tf.int32))
-            # [batch size, beam size * beam size]
-            top_probs = tf.reshape(top_probs, shape=(batch_size, beam_search_size ** 2))
-            top_words = tf.reshape(top_words, shape=(batch_size, beam_search_size ** 2))
-            # beam_probs: [batch size, beam size]
-            beam_log_probs, top_beam_indices = tf.math.top_k(top_probs, k=beam_search_size)
-            # [batch size, beam size, seq length] -> [batch size, beam size * beam size, seq length]
-            beams = tf.repeat(beams, repeats=beam_search_size, axis=1)
-            decoder_states = tuple(tf.repeat(s, beam_search_size, axis=1) for s in decoder_states)
-            # [batch size, beam size * beam size, seq length] -> [batch size, beam size, seq length]
-            beams = tf.gather(beams, indices=top_beam_indices, axis=1, batch_dims=1)
-            top_words = tf.gather(top_words, indices=top_beam_indices, axis=1, batch_dims=1)
-            beams = tf.concat((
-                beams[:, :, :it], tf.expand_dims(top_words, axis=-1), beams[:, :, it + 1:]
-            ), axis=-1)
-            beams.set_shape((batch_size, beam_search_size, beam_length))
-
-            # Memorize best beam per batch so far
-            beam_idx = tf.argmax(beam_log_probs, axis=-1)
-            best_beam_per_batch = tf.gather(beams, tf.expand_dims(beam_idx, axis=-1), axis=1, batch_dims=1)
-            beam_finished = tf.reshape(tf.logical_not(beams_not_finished(best_beam_per_batch, it)), shape=(batch_size,))
-            best_beam_prob_per_batch = tf.reduce_max(beam_log_probs, axis=-1)
-            # Needs to both have a higher likelihood and be a finished beam
-            # We also divide by the beam length for normalization sake
-            better_beam = tf.logical_and(
-                tf.greater_equal(best_beam_prob_per_batch / tf.cast(it, tf.float32), best_beam_prob),
-                beam_finished
+            top_words = tf.where(tf.expand_dims(finished, axis=-1), tf.zeros_like(top_words), top_words)
+            # [batch size, beam size * beam size] -> [batch size, beam size]
+            beam_log_probs, top_indices = tf.math.top_k(
+                tf.reshape(candidates_log_probs, shape=(batch_size, beam_search_size ** 2)), k=beam_search_size
             )
-            best_beam = tf.where(
-                tf.expand_dims(better_beam, axis=1),
-                tf.squeeze(best_beam_per_batch, axis=1),
-                best_beam
+            parents = top_indices // beam_search_size
+            tokens = tf.gather(
+                tf.reshape(top_words, shape=(batch_size, beam_search_size ** 2)), top_indices, batch_dims=1
             )
-            best_beam_prob = tf.where(better_beam, best_beam_prob_per_batch / tf.cast(it, tf.float32), best_beam_prob)
+            parents_finished = tf.gather(finished, parents, batch_dims=1)
+            lengths = tf.gather(lengths, parents, batch_dims=1) + tf.cast(tf.logical_not(parents_finished), tf.int32)
+            finished = tf.logical_or(
+                parents_finished,
+                tf.logical_or(tf.equal(tokens, 0), tf.equal(tokens, self.question_mark_id))
+            )
+            if budget is not None:
+                finished = tf.logical_or(finished, tf.expand_dims(tf.greater_equal(it + 1, budget), axis=-1))
 
-            decoder_states = tuple(tf.gather(s, top_beam_indices, axis=1, batch_dims=1) for s in decoder_states)
-            decoder_states = tuple(collapse_dims(s) for s in decoder_states)
-            observations = collapse_dims(top_words)
-            beam_log_probs = tf.expand_dims(beam_log_probs, axis=-1)
+            step_tokens = step_tokens.write(it, tokens)
+            step_parents = step_parents.write(it, parents)
+            decoder_states = tuple(gather_beams(s, parents) for s in decoder_states)
+            observations = collapse_dims(tokens)
+            if self.has_decoding_constraints:
+                history = write_step(gather_beams(history, parents), it, observations)
             first_step = tf.constant(False)
-
             it += 1
-        beam_log_probs = tf.squeeze(beam_log_probs, axis=-1)
-        beam_indices = tf.argmax(beam_log_probs, axis=1)
-        beam_log_probs = tf.reduce_max(beam_log_probs, axis=1)
-        beams = tf.gather(beams, beam_indices, axis=1, batch_dims=1)
-        cond = tf.expand_dims(tf.greater(best_beam_prob, beam_log_probs / tf.cast(beam_length, tf.float32)), axis=-1)
-        best_beams = tf.where(cond, best_beam, beams)
-        best_beam_probs = tf.where(tf.squeeze(cond, axis=1), best_beam_prob, beam_log_probs)
+
+        # Length normalized scores, the best hypothesis of each batch element is then recovered from its back-pointers
+        normalized_log_probs = beam_log_probs / tf.cast(tf.maximum(lengths, 1), tf.float32)
+        best_beam_indices = tf.argmax(normalized_log_probs, axis=-1, output_type=tf.int32)
+        best_beam_probs = tf.gather(normalized_log_probs, best_beam_indices, batch_dims=1)
+        best_beams = RepeatQ.backtrack_beams(step_tokens.stack()[:it], step_parents.stack()[:it], best_beam_indices)
+        best_beams = tf.pad(best_beams, paddings=((0, 0), (0, beam_length - it)))
         if return_probs:
             return best_beams, best_beam_probs
         return best_beams
 
     @staticmethod
-    def get_output_tokens(voc_logits, base_question_logits, facts_logits, origin_probs, base_question, facts, top_k=1):
+    def backtrack_beams(step_tokens, step_parents, beam_indices):
+        """
+        Rebuilds hypotheses by following back-pointers from the last decoding step to the first.
+        :param step_tokens: Token chosen for each beam at each step, [steps, batch size, beam size].
+        :param step_parents: Index of the beam each beam was extended from, [steps, batch size, beam size].
+        :param beam_indices: Index of the beam to recover for each batch element, [batch size].
+        :return: The recovered hypotheses, [batch size, steps].
+        """
+        nb_steps = tf.shape(step_tokens)[0]
+        hypotheses = tf.TensorArray(dtype=tf.int32, size=nb_steps, element_shape=beam_indices.get_shape(),
+                                    name="hypotheses")
+        t = nb_steps - 1
+        while t >= 0:
+            hypotheses = hypotheses.write(t, tf.gather(step_tokens[t], beam_indices, batch_dims=1))
+            beam_indices = tf.gather(step_parents[t], beam_indices, batch_dims=1)
+            t -= 1
+        return tf.transpose(hypotheses.stack())
+
+    @staticmethod
+    def get_output_tokens(voc_logits, base_question_logits, facts_logits, origin_probs, base_question, facts, top_k=1,
+                          banned_tokens=None, fused=False, shortlist=None):
+        """
+        :param banned_tokens: Optional boolean mask of the vocabulary words which can't be generated nor copied,
+        [..., vocabulary size].
+        :param fused: Selects the tokens from the fused pointer-generator distribution (see `fused_output_distribution`)
+        instead of comparing the best generated word with the best copied word.
+        :param shortlist: `OutputShortlist` the vocabulary logits were computed for, if any. Predicted tokens are
+        always vocabulary ids.
+        """
+        # Banned generated words, over the same words as the vocabulary logits
+        banned_generations = banned_tokens
+        if banned_tokens is not None and shortlist is not None:
+            banned_generations = tf.gather(banned_tokens, shortlist.ids, axis=-1)
+
+        if fused:
+            output_distribution = RepeatQ.fused_output_distribution(
+                voc_logits=voc_logits,
+                base_question_logits=base_question_logits,
+                facts_logits=facts_logits,
+                origin_probs=origin_probs,
+                base_question=base_question,
+                facts=facts,
+                shortlist=shortlist
+            )
+            if banned_tokens is not None:
+                output_distribution = tf.where(banned_generations, tf.zeros_like(output_distribution),
+                                               output_distribution)
+            token_probs, predicted_tokens = tf.math.top_k(output_distribution, k=top_k)
+            if shortlist is not None:
+                predicted_tokens = tf.gather(shortlist.ids, predicted_tokens)
+            if top_k == 1:
+                return predicted_tokens
+            return token_probs, predicted_tokens
+
         flattened_facts = tf.concat(tf.unstack(facts, axis=-2), axis=-1)
 
         voc_generated_prob = origin_probs[..., 0:1]
@@ -411,11 +918,19 @@ class RepeatQ(LoggingMixin, tf.keras.models.Model):
 
         voc_words_distribution = RepeatQ.stable_softmax(voc_logits)
 
+        q_batch_dims = len(base_question.get_shape()) - 1
+        copy_words = tf.concat((base_question, flattened_facts), axis=-1, name="copy_words")
+        if banned_tokens is not None:
+            voc_words_distribution = tf.where(banned_generations, tf.zeros_like(voc_words_distribution),
+                                              voc_words_distribution)
+            banned_copies = tf.gather(banned_tokens, copy_words, batch_dims=q_batch_dims)
+            copy_distribution = tf.where(banned_copies, tf.zeros_like(copy_distribution), copy_distribution)
+
         copied_words_probs, indices_to_copy = tf.math.top_k(copy_distribution, k=top_k)
         voc_words_probs, voc_words = tf.math.top_k(voc_words_distribution, k=top_k)
+        if shortlist is not None:
+            voc_words = tf.gather(shortlist.ids, voc_words)
 
-        q_batch_dims = len(base_question.get_shape()) - 1
-        copy_words = tf.concat((base_question, flattened_facts), axis=-1, name="copy_words")
         words_to_copy = tf.gather(copy_words, indices_to_copy, batch_dims=q_batch_dims)
         voc_words_probs = voc_generated_prob * voc_words_probs
         cond = copied_words_probs > voc_words_probs
@@ -425,6 +940,83 @@ class RepeatQ(LoggingMixin, tf.keras.models.Model):
         token_probs = tf.where(cond, copied_words_probs, voc_words_probs)
         return token_probs, predicted_tokens
 
+    @staticmethod
+    def fused_output_distribution(voc_logits, base_question_logits, facts_logits, origin_probs, base_question, facts,
+                                  shortlist=None):
+        """
+        Computes the pointer-generator distribution over the vocabulary in one go: the copy probability of every base
+        question and fact position is scatter-added onto the vocabulary id of the word at that position. Padding
+        positions can't be copied.
+        :param shortlist: `OutputShortlist` the vocabulary logits were computed for, if any. As it contains every word
+        of the base questions and facts, the copy mass is scattered onto shortlist positions instead.
+        :return: The output distribution, [..., vocabulary size] or [..., shortlist size].
+        """
+        flattened_facts = tf.concat(tf.unstack(facts, axis=-2), axis=-1)
+        copy_words = tf.concat((base_question, flattened_facts), axis=-1, name="copy_words")
+        copy_distribution = tf.concat((
+            origin_probs[..., 1:2] * RepeatQ.stable_softmax(base_question_logits),
+            origin_probs[..., 2:3] * RepeatQ.stable_softmax(facts_logits)
+        ), axis=-1, name="copy_distribution")
+        copy_distribution = tf.where(tf.equal(copy_words, 0), tf.zeros_like(copy_distribution), copy_distribution)
+        output_distribution = origin_probs[..., 0:1] * RepeatQ.stable_softmax(voc_logits)
+        if shortlist is not None:
+            copy_words = tf.gather(shortlist.positions, copy_words)
+
+        # Collapses the leading dimensions (batch, and beam if any) to scatter the copy mass row by row
+        nb_rows = tf.reduce_prod(tf.shape(copy_words)[:-1])
+        copy_words = tf.reshape(copy_words, (nb_rows, -1))
+        row_indices = tf.broadcast_to(tf.range(nb_rows)[:, None], tf.shape(copy_words))
+        # scatter_nd (which sums duplicate indices) rather than tensor_scatter_nd_add, which has no TFLite kernel
+        flat_distribution = tf.reshape(output_distribution, (nb_rows, -1))
+        fused_distribution = flat_distribution + tf.scatter_nd(
+            indices=tf.stack((row_indices, copy_words), axis=-1),
+            updates=tf.reshape(copy_distribution, (nb_rows, -1)),
+            shape=tf.shape(flat_distribution),
+            name="fused_output_distribution"
+        )
+        fused_distribution = tf.reshape(fused_distribution, tf.shape(output_distribution))
+        fused_distribution.set_shape(output_distribution.get_shape())
+        return fused_distribution
+
+    @staticmethod
+    def pointer_target_probs(voc_logits, base_question_logits, facts_logits, origin_probs, target_words,
+                             target_copy_indicator, shortlist=None):
+        """
+        Probability of the target under the pointer softmax (the concatenation of the generation distribution and the
+        copy distributions) without building it. As in the training targets, a word which can be copied is only
+        counted through the position given by its copy indicator.
+        :param target_words: Target word at the current step, [batch size].
+        :param target_copy_indicator: Position of the target word in [base question, fact 1, ..., fact l], -1 if it
+        can't be copied, [batch size].
+        :param shortlist: `OutputShortlist` the vocabulary logits were computed for, if any. It must contain the target.
+        :return: [batch size]
+        """
+        if shortlist is not None:
+            target_words = tf.gather(shortlist.positions, target_words)
+        target_voc_logits = tf.gather(voc_logits, target_words, batch_dims=1)
+        generated_probs = origin_probs[..., 0] * tf.exp(target_voc_logits - tf.reduce_logsumexp(voc_logits, axis=-1))
+        copy_distribution = tf.concat((
+            origin_probs[..., 1:2] * RepeatQ.stable_softmax(base_question_logits),
+            origin_probs[..., 2:3] * RepeatQ.stable_softmax(facts_logits)
+        ), axis=-1, name="copy_distribution")
+        copied_probs = tf.gather(copy_distribution, tf.maximum(target_copy_indicator, 0), batch_dims=1)
+        return tf.where(tf.not_equal(target_copy_indicator, -1), copied_probs, generated_probs)
+
+    @staticmethod
+    def fused_target_probs(output_distribution, target_words, shortlist=None):
+        """
+        Probability of the target under the fused output distribution, renormalized as copy mass on padding positions
+        is dropped.
+        """
+        if shortlist is not None:
+            target_words = tf.gather(shortlist.positions, target_words)
+        return tf.gather(output_distribution, target_words, batch_dims=1) / tf.reduce_sum(output_distribution, axis=-1)
+
+    @staticmethod
+    def cross_entropy(target_probs, epsilon=1e-7):
+        # Same clipping as Keras' cross-entropy losses on probabilities
+        return -tf.math.log(tf.clip_by_value(target_probs, epsilon, 1.0 - epsilon))
+
     @staticmethod
     def stable_softmax(x, axis=-1):
         z = x - tf.reduce_max(x, axis=axis, keepdims=True)
@@ -449,6 +1041,7 @@ class RepeatQ(LoggingMixin, tf.keras.models.Model):
             vocab_size=len(self.vocabulary_word_to_id),
             readout_size=self.config.decoder_readout_size,
             bos_token=self.vocabulary_word_to_id[PAD_TOKEN],
+            tied_embeddings=self.config.tied_output_embedding,
             name="decoder"
         )
 
@@ -1,4 +1,30 @@
-from defs import REPEAT_Q_SQUAD_DATA_DIR, REPEAT_Q_VOCABULARY_FILENAME, REPEAT_Q_FEATURE_VOCABULARY_FILENAME
+import json
+
+from defs import REPEAT_Q_SQUAD_DATA_DIR, REPEAT_Q_VOCABULARY_FILENAME, REPEAT_Q_FEATURE_VOCABULARY_FILENAME, \
+    REPEAT_Q_LENGTH_BUDGET_FILENAME, REPEAT_Q_SHORTLIST_CANDIDATES_FILENAME
+
+# Configuration attributes which determine the variables of a checkpoint and how they are used, saved along with it
+ARCHITECTURE_SETTINGS = (
+    "fact_encoder_hidden_size",
+    "attention_depth",
+    "embedding_size",
+    "decoder_hidden_size",
+    "decoder_readout_size",
+    "question_attention",
+    "facts_attention",
+    "embeddings_pretrained",
+    "use_ner_features",
+    "use_pos_features",
+    "reduced_ner_indicators",
+    "use_question_encodings",
+    "fused_output_head",
+    "mixed_precision",
+    "tied_output_embedding"
+)
+
+
+def architecture_path(checkpoint_path):
+    return f"{checkpoint_path}.config.json"
 
 
 class ModelConfiguration:
@@ -31,7 +57,25 @@ class ModelConfiguration:
                  mixed_data=False,
                  reduced_ner_indicators=False,
                  use_question_encodings=True,
-                 use_glove_embeddings=True):
+                 use_glove_embeddings=True,
+                 no_repeat_ngram_size=0,
+                 max_adjacent_duplicate_size=0,
+                 length_budget=None,
+                 fused_output_head=False,
+                 per_step_loss=False,
+                 precomputed_teacher_forcing=False,
+                 shortlist_size=0,
+                 shortlist_in_training=False,
+                 shortlist_candidates=False,
+                 sampled_softmax_size=0,
+                 mixed_precision=False,
+                 distillation_soft_weight=0.5,
+                 distillation_beam_weight=0.5,
+                 pruning_epochs=0,
+                 pruning_sparsity=0.5,
+                 pruning_block_size=4,
+                 tied_output_embedding=False,
+                 shape_buckets=()):
         super(ModelConfiguration, self).__init__()
         self.recurrent_dropout = recurrent_dropout
         self.dropout_rate = dropout_rate
@@ -62,6 +106,24 @@ class ModelConfiguration:
         self.reduced_ner_indicators = reduced_ner_indicators
         self.use_question_encodings = use_question_encodings
         self.save_directory_name = None
+        self.no_repeat_ngram_size = no_repeat_ngram_size
+        self.max_adjacent_duplicate_size = max_adjacent_duplicate_size
+        self.length_budget = length_budget
+        self.fused_output_head = fused_output_head
+        self.per_step_loss = per_step_loss
+        self.precomputed_teacher_forcing = precomputed_teacher_forcing
+        self.shortlist_size = shortlist_size
+        self.shortlist_in_training = shortlist_in_training
+        self.shortlist_candidates = shortlist_candidates
+        self.sampled_softmax_size = sampled_softmax_size
+        self.mixed_precision = mixed_precision
+        self.distillation_soft_weight = distillation_soft_weight
+        self.distillation_beam_weight = distillation_beam_weight
+        self.pruning_epochs = pruning_epochs
+        self.pruning_sparsity = pruning_sparsity
+        self.pruning_block_size = pruning_block_size
+        self.tied_output_embedding = tied_output_embedding
+        self.shape_buckets = shape_buckets
 
     @staticmethod
     def new() -> 'ModelConfiguration':
@@ -76,6 +138,14 @@ class ModelConfiguration:
     def feature_vocabulary_path(self):
         return f"{self.data_dir}/{REPEAT_Q_FEATURE_VOCABULARY_FILENAME}"
 
+    @property
+    def length_budget_path(self):
+        return f"{self.data_dir}/{REPEAT_Q_LENGTH_BUDGET_FILENAME}"
+
+    @property
+    def shortlist_candidates_path(self):
+        return f"{self.data_dir}/{REPEAT_Q_SHORTLIST_CANDIDATES_FILENAME}"
+
     def with_data_dir(self, data_dir):
         self.data_dir = data_dir
         return self
@@ -156,10 +226,192 @@ class ModelConfiguration:
         self.synth_supervised_epochs = nb_epochs
         return self
 
+    def with_no_repeat_ngram_size(self, ngram_size):
+        """
+        :param ngram_size: When decoding, tokens which would complete an n-gram of this size that was already
+        generated are banned. 0 disables the constraint.
+        """
+        self.no_repeat_ngram_size = ngram_size
+        return self
+
+    def with_max_adjacent_duplicate_size(self, max_size):
+        """
+        :param max_size: When decoding, tokens which would duplicate the n-gram right before them are banned, for
+        every n up to this size. 0 disables the constraint.
+        """
+        self.max_adjacent_duplicate_size = max_size
+        return self
+
+    def with_length_budget(self, coefficients):
+        """
+        :param coefficients: (question coefficient, fact coefficient, intercept) of the per-example decoding length
+        budget, computed from the base question length and the longest fact length. None means every example is
+        decoded for up to `max_generated_question_length` steps.
+        """
+        self.length_budget = coefficients
+        return self
+
+    def with_fused_output_head(self, fused_output_head):
+        """
+        :param fused_output_head: If True, generation and copy probabilities are merged onto vocabulary ids once per
+        step. Tokens are selected from this distribution and the training loss is its negative log-likelihood of the
+        target word (summing over every way of producing it).
+        """
+        self.fused_output_head = fused_output_head
+        return self
+
+    def with_per_step_loss(self, per_step_loss):
+        """
+        :param per_step_loss: If True, the supervised loss is accumulated step by step while decoding instead of being
+        computed on the stored output distributions of every step (lower peak memory, same loss).
+        """
+        self.per_step_loss = per_step_loss
+        return self
+
+    def with_precomputed_teacher_forcing(self, precomputed_teacher_forcing):
+        """
+        :param precomputed_teacher_forcing: If True, the decoder's projections of the previous token embeddings are
+        computed for the whole target at once during teacher-forced training instead of step by step.
+        """
+        self.precomputed_teacher_forcing = precomputed_teacher_forcing
+        return self
+
+    def with_shortlist_size(self, shortlist_size):
+        """
+        :param shortlist_size: If positive, the generation vocabulary of each batch is restricted to this many most
+        frequent words plus every word of the batch's base questions and facts (and their candidates, see
+        `with_shortlist_candidates`). 0 generates over the whole vocabulary.
+        """
+        self.shortlist_size = shortlist_size
+        return self
+
+    def with_shortlist_in_training(self, shortlist_in_training):
+        """
+        :param shortlist_in_training: If True, the shortlist is also used during supervised training, extended with the
+        batch's target words. The loss is then computed step by step.
+        """
+        self.shortlist_in_training = shortlist_in_training
+        return self
+
+    def with_shortlist_candidates(self, shortlist_candidates):
+        """
+        :param shortlist_candidates: If True, the shortlist also contains the candidates of the base question words,
+        learned on the training set by the shortlist action.
+        """
+        self.shortlist_candidates = shortlist_candidates
+        return self
+
+    def with_sampled_softmax_size(self, sampled_softmax_size):
+        """
+        :param sampled_softmax_size: If positive, supervised training computes the generation softmax over the batch's
+        words and this many negative words sampled by frequency instead of the whole vocabulary (the copy terms are
+        exact). Decoding and evaluation still use the full softmax. 0 disables sampling.
+        """
+        self.sampled_softmax_size = sampled_softmax_size
+        return self
+
+    def with_mixed_precision(self, mixed_precision):
+        """
+        :param mixed_precision: If True, the model computes in bfloat16 with float32 variables. Softmaxes, output
+        distributions and losses stay in float32.
+        """
+        self.mixed_precision = mixed_precision
+        return self
+
+    def with_model_sizes(self, fact_encoder_hidden_size=None, decoder_hidden_size=None, attention_depth=None,
+                         decoder_readout_size=None, embedding_size=None):
+        """
+        Sets the sizes of the model's layers, the ones left to None keep their current value. The embedding size is
+        only used when the embeddings aren't pretrained.
+        """
+        if fact_encoder_hidden_size is not None:
+            self.fact_encoder_hidden_size = fact_encoder_hidden_size
+        if decoder_hidden_size is not None:
+            self.decoder_hidden_size = decoder_hidden_size
+        if attention_depth is not None:
+            self.attention_depth = attention_depth
+        if decoder_readout_size is not None:
+            self.decoder_readout_size = decoder_readout_size
+        if embedding_size is not None:
+            self.embedding_size = embedding_size
+        return self
+
+    def with_distillation_soft_weight(self, soft_weight):
+        """
+        :param soft_weight: When training a student, weight of the cross-entropy with the teacher's output
+        distributions, the cross-entropy with the labels getting the rest.
+        """
+        self.distillation_soft_weight = soft_weight
+        return self
+
+    def with_distillation_beam_weight(self, beam_weight):
+        """
+        :param beam_weight: When training a student, weight of the cross-entropy of the teacher's beam search outputs.
+        """
+        self.distillation_beam_weight = beam_weight
+        return self
+
+    def with_pruning_epochs(self, nb_epochs):
+        """
+        :param nb_epochs: Number of pruning-aware fine-tuning epochs after the supervised ones. 0 disables pruning.
+        """
+        self.pruning_epochs = nb_epochs
+        return self
+
+    def with_pruning_sparsity(self, sparsity):
+        """
+        :param sparsity: Share of the readout units, attention units and LSTM kernel blocks pruned at the end of the
+        pruning epochs.
+        """
+        self.pruning_sparsity = sparsity
+        return self
+
+    def with_pruning_block_size(self, block_size):
+        """
+        :param block_size: Number of consecutive input rows of an LSTM kernel column pruned together.
+        """
+        self.pruning_block_size = block_size
+        return self
+
+    def with_tied_output_embedding(self, tied_output_embedding):
+        """
+        :param tied_output_embedding: If True, the decoder's output layer scores its readout, projected into the
+        embedding space, against the embedding matrix instead of using a separate vocabulary projection. Works with
+        both pretrained (frozen) and trainable embeddings.
+        """
+        self.tied_output_embedding = tied_output_embedding
+        return self
+
+    def with_shape_buckets(self, shape_buckets):
+        """
+        :param shape_buckets: Lengths the base questions, facts and targets of a dataset are padded up to (the
+        smallest one holding them), so that datasets share a small set of shapes and traced functions.
+        """
+        self.shape_buckets = tuple(shape_buckets)
+        return self
+
     def with_dev_step_size(self, dev_step_size):
         self.dev_step_size = dev_step_size
         return self
 
+    def with_architecture_of(self, checkpoint_path):
+        """
+        Sets the architecture settings to the ones saved along with a checkpoint (see `save_architecture`).
+        """
+        try:
+            with open(architecture_path(checkpoint_path), mode='r') as f:
+                architecture = json.load(f)
+        except FileNotFoundError:
+            raise ValueError(f"No configuration saved along with the checkpoint '{checkpoint_path}', write its "
+                             f"{', '.join(ARCHITECTURE_SETTINGS)} to '{architecture_path(checkpoint_path)}'.")
+        for name in ARCHITECTURE_SETTINGS:
+            setattr(self, name, architecture[name])
+        return self
+
+    def save_architecture(self, checkpoint_path):
+        with open(architecture_path(checkpoint_path), mode='w') as f:
+            json.dump({name: getattr(self, name) for name in ARCHITECTURE_SETTINGS}, f, indent=2)
+
     def __str__(self):
         str_builder = ""
         for param_name, default_value in self.__dict__.items():
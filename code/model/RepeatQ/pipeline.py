@@ -0,0 +1,129 @@
+import time
+from bisect import bisect_right
+from logging import info
+
+import stanza
+
+from data_processing.annotation import annotated_example
+from model.RepeatQ.caching import LRUCache
+from model.RepeatQ.prediction_cache import input_key
+from model.RepeatQ.server import RequestEncoder, decode_requests, DEFAULT_LENGTH_BUCKETS
+
+
+class SentencesDocument:
+    """
+    The sentences of one text annotated along with others, exposing the attributes of a Stanza document that
+    `annotated_example` uses for the question.
+    """
+
+    def __init__(self, sentences):
+        self.sentences = sentences
+
+    @property
+    def entities(self):
+        return [entity for sentence in self.sentences for entity in sentence.entities]
+
+    @property
+    def num_words(self):
+        return sum(len(sentence.words) for sentence in self.sentences)
+
+    def iter_words(self):
+        for sentence in self.sentences:
+            yield from sentence.words
+
+
+class RawTextPipeline:
+    """
+    Rewrites raw questions: annotates them and their facts with Stanza, builds their features as the dataset
+    generation does (see `data_processing.annotation`), converts them to ids as `RepeatQDataset` does and decodes
+    them in batches. Fact sentences are annotated independently of the question, so their annotations are kept in an
+    LRU cache, facts recurring across questions being annotated once. The questions and the new facts of a call are
+    annotated in a single Stanza call.
+    """
+
+    def __init__(self, model, encoder: RequestEncoder, nlp=None, fact_cache_size=10000, beam_search_size=1,
+                 batch_size=32, length_buckets=DEFAULT_LENGTH_BUCKETS, prediction_cache=None):
+        """
+        :param prediction_cache: Optional `PredictionCache`, only the requests missing from it are decoded.
+        """
+        self.model = model
+        self.encoder = encoder
+        self.nlp = stanza.Pipeline(lang='en', processors='tokenize,pos,ner') if nlp is None else nlp
+        self.fact_cache = LRUCache(fact_cache_size)
+        self.beam_search_size = beam_search_size
+        self.batch_size = batch_size
+        self.length_buckets = length_buckets
+        self.prediction_cache = prediction_cache
+        self.timings = {"annotation": 0.0, "decoding": 0.0}
+
+    def annotate(self, questions, answers, facts):
+        """
+        :param questions: Raw base questions.
+        :param answers: The answers of each question.
+        :param facts: The raw fact sentences of each question.
+        :return: The examples, with the fields of the dataset files.
+        """
+        new_facts = list({fact: None for question_facts in facts for fact in question_facts
+                          if fact not in self.fact_cache})
+        annotations = self.annotate_sentences(new_facts + list(questions))
+        for fact, sentences in zip(new_facts, annotations):
+            self.fact_cache.put(fact, sentences)
+        examples = []
+        for question_sentences, question_answers, question_facts in zip(annotations[len(new_facts):], answers, facts):
+            fact_sentences = [sentence for fact in question_facts for sentence in self._fact_sentences(fact)]
+            examples.append(annotated_example(SentencesDocument(question_sentences), fact_sentences, question_answers))
+        return examples
+
+    def annotate_sentences(self, texts):
+        """
+        Annotates texts in a single Stanza call, as paragraphs of one document.
+        :return: The sentences of each text.
+        """
+        if len(texts) == 0:
+            return []
+        starts, offset = [], 0
+        for text in texts:
+            starts.append(offset)
+            offset += len(text) + 2
+        sentences = [[] for _ in texts]
+        for sentence in self.nlp("\n\n".join(texts)).sentences:
+            sentences[bisect_right(starts, sentence.tokens[0].start_char) - 1].append(sentence)
+        return sentences
+
+    def rewrite(self, questions, answers, facts):
+        """
+        :return: The rewritten questions.
+        """
+        start = time.perf_counter()
+        requests = [self.encoder.encode(example) for example in self.annotate(questions, answers, facts)]
+        annotated = time.perf_counter()
+        keys = [input_key(*request) for request in requests]
+        cached = {} if self.prediction_cache is None else self.prediction_cache.get_many(keys)
+        missing = {key: request for key, request in zip(keys, requests) if key not in cached}
+        missing_keys, missing_requests = list(missing), list(missing.values())
+        rewrites = []
+        for i in range(0, len(missing_requests), self.batch_size):
+            rewrites += decode_requests(
+                self.model, self.encoder, missing_requests[i:i + self.batch_size], self.beam_search_size,
+                self.length_buckets
+            )
+        decoded = dict(zip(missing_keys, rewrites))
+        if self.prediction_cache is not None:
+            self.prediction_cache.put_many(decoded)
+        self.timings["annotation"] += annotated - start
+        self.timings["decoding"] += time.perf_counter() - annotated
+        return [cached[key] if key in cached else decoded[key] for key in keys]
+
+    def log_stats(self):
+        info(f"Annotation: {self.timings['annotation']:.2f} s, decoding: {self.timings['decoding']:.2f} s, fact cache "
+             f"hit rate: {100 * self.fact_cache.hit_rate:.1f}% ({len(self.fact_cache)} facts cached).")
+        if self.prediction_cache is not None:
+            self.prediction_cache.log_stats()
+
+    def _fact_sentences(self, fact):
+        sentences = self.fact_cache.get(fact)
+        if sentences is None:
+            # Evicted by the facts of the same call
+            sentences = self.nlp(fact).sentences
+            self.fact_cache.put(fact, sentences)
+        return sentences
@@ -0,0 +1,18 @@
+import tensorflow as tf
+
+MIXED_PRECISION_POLICY = "mixed_bfloat16"
+
+
+def set_mixed_precision(enabled):
+    """
+    Sets the global Keras dtype policy. Layers built afterwards compute in bfloat16 while keeping float32 variables if
+    enabled, and in float32 otherwise.
+    """
+    tf.keras.mixed_precision.experimental.set_policy(MIXED_PRECISION_POLICY if enabled else "float32")
+
+
+def compute_dtype():
+    """
+    :return: The compute dtype of the layers built under the current global policy.
+    """
+    return tf.as_dtype(tf.keras.mixed_precision.experimental.global_policy().compute_dtype)
@@ -0,0 +1,170 @@
+import glob
+import hashlib
+import json
+import os
+import sqlite3
+import time
+from logging import info
+
+import numpy as np
+
+# Configuration attributes which change the predictions of a checkpoint
+DECODING_SETTINGS = (
+    "max_generated_question_length",
+    "no_repeat_ngram_size",
+    "max_adjacent_duplicate_size",
+    "length_budget",
+    "fused_output_head",
+    "shortlist_size",
+    "shortlist_candidates",
+    "mixed_precision",
+    "tied_output_embedding"
+)
+
+
+def checkpoint_hash(model_dir, int8=False):
+    """
+    :return: The SHA-256 of the checkpoint's files (of its int8 TFLite models if `int8`).
+    """
+    paths = sorted(glob.glob(f"{model_dir}_int8/*.tflite")) if int8 else \
+        sorted(glob.glob(f"{model_dir}.index") + glob.glob(f"{model_dir}.data-*"))
+    if len(paths) == 0:
+        raise ValueError(f"No checkpoint files found for '{model_dir}'.")
+    sha = hashlib.sha256()
+    for path in paths:
+        with open(path, mode='rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                sha.update(chunk)
+    return sha.hexdigest()
+
+
+def decoding_settings(config, beam_search_size, **settings):
+    return {**{name: getattr(config, name) for name in DECODING_SETTINGS}, "beam_search_size": beam_search_size,
+            **settings}
+
+
+def feature_matrix(features, length, nb_features):
+    """
+    :param features: Ids of each feature kind of a sentence, as built by `RepeatQDataset.features_to_ids`.
+    :return: The features as a [length, nb features] matrix, like the ones of the server's requests.
+    """
+    matrix = np.zeros((length, nb_features), dtype=np.float32)
+    for i, ids in enumerate(features[:nb_features]):
+        ids = list(ids)[:length]
+        matrix[:len(ids), i] = ids
+    return matrix
+
+
+def input_key(base_question, base_question_features, facts, facts_features):
+    """
+    Hashes a model input, padding excluded, so that the key doesn't depend on the dataset it was padded in.
+    :param base_question_features: [question length, nb features] matrix.
+    :param facts_features: [fact length, nb features] matrix of each fact.
+    """
+    sha = hashlib.sha256()
+    question_length = len(np.trim_zeros(np.asarray(base_question, dtype=np.int32), 'b'))
+    sha.update(np.asarray(base_question[:question_length], dtype=np.int32).tobytes())
+    sha.update(np.asarray(base_question_features, dtype=np.float32)[:question_length].tobytes())
+    facts = [np.trim_zeros(np.asarray(fact, dtype=np.int32), 'b') for fact in facts]
+    while len(facts) > 0 and len(facts[-1]) == 0:
+        facts.pop()
+    for fact, fact_features in zip(facts, facts_features):
+        sha.update(b"|")
+        sha.update(fact.tobytes())
+        sha.update(np.asarray(fact_features, dtype=np.float32)[:len(fact)].tobytes())
+    return sha.hexdigest()
+
+
+def example_input_key(example, nb_features):
+    """
+    :param example: A `RepeatQExample` as returned by `RepeatQDataset.get_dataset`.
+    """
+    facts = np.asarray(example.facts)
+    return input_key(
+        example.base_question,
+        feature_matrix(example.base_question_features, len(example.base_question), nb_features),
+        facts,
+        [feature_matrix(features, facts.shape[-1], nb_features) for features in example.facts_features]
+    )
+
+
+class PredictionCache:
+    """
+    On-disk cache of predictions (SQLite). Entries are keyed by the checkpoint's content hash, the decoding settings
+    and the input's hash, so that a cache can be shared across checkpoints and settings. The least recently used
+    entries are evicted beyond `max_entries`.
+    """
+
+    def __init__(self, path, checkpoint, settings, max_entries=1000000):
+        """
+        :param checkpoint: Content hash of the checkpoint (see `checkpoint_hash`).
+        :param settings: Decoding settings (see `decoding_settings`).
+        """
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.path = path
+        self.max_entries = max_entries
+        self.namespace = hashlib.sha256(
+            f"{checkpoint}|{json.dumps(settings, sort_keys=True, default=str)}".encode("utf-8")
+        ).hexdigest()
+        # The server queries the cache from a worker thread
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS predictions (key TEXT PRIMARY KEY, prediction TEXT, last_access REAL)"
+        )
+        self.connection.execute("CREATE INDEX IF NOT EXISTS last_access_index ON predictions (last_access)")
+        self.hits, self.misses = 0, 0
+
+    def _key(self, key):
+        return hashlib.sha256(f"{self.namespace}|{key}".encode("utf-8")).hexdigest()
+
+    def get_many(self, keys):
+        """
+        :param keys: Input keys (see `input_key`).
+        :return: The cached predictions of the keys found in the cache.
+        """
+        keys = list(keys)
+        found = {}
+        with self.connection:
+            for key in keys:
+                row = self.connection.execute(
+                    "SELECT prediction FROM predictions WHERE key = ?", (self._key(key),)
+                ).fetchone()
+                if row is not None:
+                    found[key] = row[0]
+            self.connection.executemany(
+                "UPDATE predictions SET last_access = ? WHERE key = ?",
+                [(time.time(), self._key(key)) for key in found]
+            )
+        self.hits += len(found)
+        self.misses += len(keys) - len(found)
+        return found
+
+    def put_many(self, predictions):
+        """
+        :param predictions: Mapping from input keys to predictions.
+        """
+        with self.connection:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO predictions (key, prediction, last_access) VALUES (?, ?, ?)",
+                [(self._key(key), prediction, time.time()) for key, prediction in predictions.items()]
+            )
+            nb_entries = self.connection.execute("SELECT COUNT(*) FROM predictions").fetchone()[0]
+            if nb_entries > self.max_entries:
+                self.connection.execute(
+                    "DELETE FROM predictions WHERE key IN "
+                    "(SELECT key FROM predictions ORDER BY last_access LIMIT ?)",
+                    (nb_entries - self.max_entries,)
+                )
+
+    def get(self, key):
+        return self.get_many([key]).get(key)
+
+    def put(self, key, prediction):
+        self.put_many({key: prediction})
+
+    def log_stats(self):
+        nb_entries = self.connection.execute("SELECT COUNT(*) FROM predictions").fetchone()[0]
+        info(f"Prediction cache: {self.hits} hits, {self.misses} misses "
+             f"({100 * self.hits / max(self.hits + self.misses, 1):.1f}% hit rate), {nb_entries} entries, "
+             f"{os.path.getsize(self.path) / 2 ** 20:.1f} MB.")
@@ -0,0 +1,152 @@
+import copy
+from logging import info
+
+import numpy as np
+import tensorflow as tf
+
+from model.RepeatQ.quantization import build_model
+
+
+def polynomial_sparsity(final_sparsity, step, nb_steps):
+    """
+    Gradual pruning schedule: the sparsity grows quickly at first and then slowly up to `final_sparsity` at the last
+    step.
+    """
+    return final_sparsity * (1.0 - (1.0 - min(step, nb_steps) / nb_steps) ** 3)
+
+
+def kept_units(scores, sparsity):
+    """
+    :return: The sorted indices of the units with the highest scores, keeping a (1 - sparsity) share of them (at least
+    one).
+    """
+    nb_kept = max(1, int(round(len(scores) * (1.0 - sparsity))))
+    return np.sort(np.argsort(-scores)[:nb_kept])
+
+
+def block_mask(weights, sparsity, block_size):
+    """
+    Mask zeroing the blocks of `block_size` consecutive input rows of each column with the smallest L2 norms.
+    """
+    nb_rows = weights.shape[0]
+    nb_blocks = -(-nb_rows // block_size)
+    padded = np.pad(weights, ((0, nb_blocks * block_size - nb_rows), (0, 0)))
+    norms = np.sqrt(np.sum(np.square(padded.reshape((nb_blocks, block_size, -1))), axis=1)).reshape(-1)
+    keep = np.ones_like(norms)
+    keep[np.argsort(norms)[:int(sparsity * len(norms))]] = 0.0
+    return np.repeat(keep.reshape((nb_blocks, -1)), block_size, axis=0)[:nb_rows].astype(np.float32)
+
+
+class StructuredPruner:
+    """
+    Magnitude pruning of a RepeatQ model in structures that can be removed from the model afterwards:
+    - readout units: a row of W_y (W_e with tied embeddings) and the two columns of W_r, U_r and V_r feeding the
+    maxout unit it reads,
+    - attention units: a column of the attention matrix and the matching weight of the attention vector.
+    The LSTM kernels are pruned by blocks of `block_size` consecutive input rows of each column, which are only zeroed.
+    """
+
+    def __init__(self, model, block_size=4):
+        self.model = model
+        self.block_size = block_size
+        decoder = model.decoder
+        self.readout_layers = (decoder.W_r, decoder.U_r, decoder.V_r)
+        # Layer reading the maxout units
+        self.output_layer = decoder.W_e if decoder.tied_embeddings else decoder.W_y
+        self.attention_layers = (decoder.base_question_attention, decoder.facts_attention_mechanism)
+        self.lstm_kernels = [decoder.lstm_cell.kernel, decoder.lstm_cell.recurrent_kernel]
+        encoders = [model.fact_encoder.encoder]
+        if model.base_question_encoder is not None:
+            encoders.append(model.base_question_encoder)
+        for encoder in encoders:
+            for layer in (encoder.forward_layer, encoder.backward_layer):
+                self.lstm_kernels += [layer.cell.kernel, layer.cell.recurrent_kernel]
+
+    def structures(self, sparsity):
+        """
+        :return: The kept readout units and the kept units of each attention layer at the given sparsity.
+        """
+        readout_scores = np.sum(np.square(self.output_layer.kernel.numpy()), axis=1)
+        for layer in self.readout_layers:
+            # Maxout unit j reads the readout features 2j and 2j + 1
+            readout_scores += np.sum(np.square(layer.kernel.numpy()), axis=0).reshape((-1, 2)).sum(axis=1)
+        attention_units = []
+        for attention in self.attention_layers:
+            scores = np.sum(np.square(attention.attention_matrix.kernel.numpy()), axis=0) + \
+                np.square(attention.attention_vector.kernel.numpy()[:, 0])
+            attention_units.append(kept_units(scores, sparsity))
+        return kept_units(readout_scores, sparsity), attention_units
+
+    def masks(self, sparsity):
+        """
+        :return: The (variable, mask) pairs of every pruned variable at the given sparsity.
+        """
+        readout_units, attention_units = self.structures(sparsity)
+        readout_rows = np.zeros((self.output_layer.kernel.shape[0], 1), dtype=np.float32)
+        readout_rows[readout_units] = 1.0
+        readout_columns = np.repeat(readout_rows[:, 0], 2)
+        masks = [(self.output_layer.kernel, readout_rows)]
+        for layer in self.readout_layers:
+            masks += [(layer.kernel, readout_columns[None, :]), (layer.bias, readout_columns)]
+        for attention, units in zip(self.attention_layers, attention_units):
+            attention_columns = np.zeros((attention.attention_matrix.kernel.shape[1],), dtype=np.float32)
+            attention_columns[units] = 1.0
+            masks += [
+                (attention.attention_matrix.kernel, attention_columns[None, :]),
+                (attention.attention_matrix.bias, attention_columns),
+                (attention.attention_vector.kernel, attention_columns[:, None])
+            ]
+        for kernel in self.lstm_kernels:
+            masks.append((kernel, block_mask(kernel.numpy(), sparsity, self.block_size)))
+        return masks
+
+    @staticmethod
+    def apply(masks):
+        for variable, mask in masks:
+            variable.assign(variable * mask)
+
+    def compacted_model(self, sparsity, features):
+        """
+        Builds a smaller model without the pruned readout and attention units, with the (masked) weights of the
+        pruned model.
+        :param features: A batch of features, used to build the new model.
+        """
+        readout_units, attention_units = self.structures(sparsity)
+        if len(attention_units[0]) != len(attention_units[1]):
+            raise ValueError("Both attention layers must keep the same number of units.")
+        readout_features = np.stack((2 * readout_units, 2 * readout_units + 1), axis=-1).reshape(-1)
+        # Indices kept along each axis of the variables that shrink
+        slices = {self.output_layer.kernel.ref(): {0: readout_units}}
+        for layer in self.readout_layers:
+            slices[layer.kernel.ref()] = {1: readout_features}
+            slices[layer.bias.ref()] = {0: readout_features}
+        for attention, units in zip(self.attention_layers, attention_units):
+            slices[attention.attention_matrix.kernel.ref()] = {1: units}
+            slices[attention.attention_matrix.bias.ref()] = {0: units}
+            slices[attention.attention_vector.kernel.ref()] = {0: units}
+
+        config = copy.copy(self.model.config)
+        config.restore_supervised_checkpoint = False
+        config = config.with_model_sizes(decoder_readout_size=2 * len(readout_units),
+                                         attention_depth=len(attention_units[0]))
+        embedding_layer = self.model.embedding_layer
+        compacted = self.model.__class__(
+            self.model.vocabulary_word_to_id, config,
+            nb_bio_tags=embedding_layer.bio_embedding_layer.input_dim,
+            nb_pos_tags=embedding_layer.pos_embedding_layer.input_dim
+        )
+        build_model(compacted, features)
+        if len(compacted.variables) != len(self.model.variables):
+            raise ValueError("The compacted model doesn't have the same variables as the pruned one.")
+        for variable, compacted_variable in zip(self.model.variables, compacted.variables):
+            weights = variable.numpy()
+            for axis, indices in slices.get(variable.ref(), {}).items():
+                weights = np.take(weights, indices, axis=axis)
+            compacted_variable.assign(weights)
+        info(f"Compacted model at sparsity {sparsity:.2f}: readout size {config.decoder_readout_size}, attention depth "
+             f"{config.attention_depth}.")
+        return compacted
+
+    def lstm_sparsity(self):
+        nb_zeros = sum(int(tf.math.count_nonzero(tf.equal(k, 0.0))) for k in self.lstm_kernels)
+        return nb_zeros / sum(k.shape.num_elements() for k in self.lstm_kernels)
@@ -0,0 +1,227 @@
+import os
+from logging import info
+
+import numpy as np
+import tensorflow as tf
+
+FEATURE_NAMES = ("base_question", "base_question_features", "facts", "facts_features")
+
+
+def quantized_model_path(model_dir):
+    return f"{model_dir}_int8"
+
+
+def build_model(model, features):
+    """
+    Runs one decoding step on a batch so that every variable used for inference is created.
+    """
+    network_state = model.get_initial_state(
+        base_question=features["base_question"],
+        base_question_features=features["base_question_features"],
+        facts=features["facts"],
+        facts_features=features["facts_features"],
+        batch_size=features["base_question"].get_shape()[0],
+        training=False
+    )
+    model(network_state, training=False)
+
+
+def encoder_function(model, features_shape):
+    """
+    :param features_shape: Shapes of the base question, base question features, facts and facts features of a batch.
+    :return: The concrete function computing the encoder outputs and the decoding budget of a batch.
+    """
+    question_shape, question_features_shape, facts_shape, facts_features_shape = features_shape
+    batch_size = question_shape[0]
+
+    @tf.function(input_signature=[
+        tf.TensorSpec(question_shape, dtype=tf.int32, name="base_question"),
+        tf.TensorSpec(question_features_shape, dtype=tf.float32, name="base_question_features"),
+        tf.TensorSpec(facts_shape, dtype=tf.int32, name="facts"),
+        tf.TensorSpec(facts_features_shape, dtype=tf.float32, name="facts_features")
+    ])
+    def encode(base_question, base_question_features, facts, facts_features):
+        network_state = model.get_initial_state(base_question, base_question_features, facts, facts_features,
+                                                batch_size, training=False)
+        budget = model.decoding_budget(base_question, facts)
+        if budget is None:
+            budget = tf.fill((batch_size,), model.config.max_generated_question_length)
+        return network_state.base_question_encodings, network_state.decoder_states[0], \
+            network_state.facts_encodings, budget
+
+    return encode.get_concrete_function()
+
+
+def step_function(model, encoder):
+    """
+    :param encoder: The concrete function of `encoder_function`.
+    :return: The concrete function running one greedy decoding step (see `RepeatQ.greedy_step`) on a batch.
+    """
+    base_question_encodings, hidden_state, facts_encodings, _ = encoder.structured_outputs
+    batch_size, hidden_size = hidden_state.get_shape()
+    question_shape = base_question_encodings.get_shape()[:2]
+    facts_shape = facts_encodings.get_shape()[:3]
+
+    @tf.function(input_signature=[
+        tf.TensorSpec(question_shape, dtype=tf.int32, name="base_question"),
+        tf.TensorSpec(base_question_encodings.get_shape(), dtype=tf.float32, name="base_question_encodings"),
+        tf.TensorSpec(facts_shape, dtype=tf.int32, name="facts"),
+        tf.TensorSpec(facts_encodings.get_shape(), dtype=tf.float32, name="facts_encodings"),
+        tf.TensorSpec((batch_size, hidden_size), dtype=tf.float32, name="hidden_state"),
+        tf.TensorSpec((batch_size, hidden_size), dtype=tf.float32, name="carry_state"),
+        tf.TensorSpec((batch_size,), dtype=tf.int32, name="observation"),
+        tf.TensorSpec((), dtype=tf.bool, name="is_first_step"),
+        tf.TensorSpec((batch_size, model.config.max_generated_question_length), dtype=tf.int32, name="history"),
+        tf.TensorSpec((), dtype=tf.int32, name="step")
+    ])
+    def step(base_question, base_question_encodings, facts, facts_encodings, hidden_state, carry_state, observation,
+             is_first_step, history, step):
+        network_state = model.NetworkState(
+            base_question=base_question,
+            base_question_encodings=base_question_encodings,
+            facts=facts,
+            facts_encodings=facts_encodings,
+            decoder_states=(hidden_state, carry_state),
+            observation=observation,
+            is_first_step=is_first_step
+        )
+        # The step is traced inline: the converter can't freeze the variables captured by a nested tf.function call
+        predicted_tokens, (hidden_state, carry_state) = type(model).greedy_step.python_function(
+            model, network_state, history, step
+        )
+        return predicted_tokens, hidden_state, carry_state
+
+    return step.get_concrete_function()
+
+
+def convert(concrete_function):
+    """
+    Dynamic-range quantization: the weights of the large matrices (embeddings, output projection, LSTM kernels,
+    attention and readout layers) are stored in int8 and multiplied by int8 kernels, the activations being quantized on
+    the fly. Ops without a TFLite kernel run through the TensorFlow ones.
+    :return: The TFLite flatbuffer.
+    """
+    converter = tf.lite.TFLiteConverter.from_concrete_functions([concrete_function])
+    converter.optimizations = [tf.lite.Optimize.DEFAULT]
+    converter.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS, tf.lite.OpsSet.SELECT_TF_OPS]
+    return converter.convert()
+
+
+def export_quantized(model, features, path):
+    """
+    Converts the encoder and the greedy decoding step of the model to int8 TFLite models, for batches of the
+    configured batch size with the lengths of `features`.
+    :return: The size of the export in bytes.
+    """
+    if model.config.mixed_precision:
+        raise ValueError("Only float32 models can be quantized.")
+    features_shape = [(model.config.batch_size, *features[name].get_shape()[1:]) for name in FEATURE_NAMES]
+    os.makedirs(path, exist_ok=True)
+    encoder = encoder_function(model, features_shape)
+    size = 0
+    for filename, function in ((QuantizedDecoder.ENCODER_FILENAME, encoder),
+                               (QuantizedDecoder.STEP_FILENAME, step_function(model, encoder))):
+        flatbuffer = convert(function)
+        with open(f"{path}/{filename}", mode='wb') as f:
+            f.write(flatbuffer)
+        size += len(flatbuffer)
+    info(f"Quantized model saved to '{path}'.")
+    return size
+
+
+def load_quantized(path, question_mark_id, num_threads=None):
+    """
+    :return: The `QuantizedDecoder` of a model exported with `export_quantized`.
+    """
+    models = []
+    for filename in (QuantizedDecoder.ENCODER_FILENAME, QuantizedDecoder.STEP_FILENAME):
+        with open(f"{path}/{filename}", mode='rb') as f:
+            models.append(f.read())
+    return QuantizedDecoder(*models, question_mark_id=question_mark_id, num_threads=num_threads)
+
+
+def float_model_size(model):
+    return sum(v.shape.num_elements() * v.dtype.size for v in model.variables)
+
+
+class QuantizedDecoder:
+    """
+    Greedy decoding with the TFLite models of `export_quantized`. Their input shapes are static: smaller batches are
+    padded to the exported batch size, other lengths are rejected. Predictions match `RepeatQ.greedy_decode` up to the
+    quantization error.
+    """
+
+    ENCODER_FILENAME = "encoder.tflite"
+    STEP_FILENAME = "step.tflite"
+
+    def __init__(self, encoder_model, step_model, question_mark_id, num_threads=None):
+        self.size = len(encoder_model) + len(step_model)
+        self.question_mark_id = question_mark_id
+        self.encoder = tf.lite.Interpreter(model_content=encoder_model, num_threads=num_threads)
+        self.step = tf.lite.Interpreter(model_content=step_model, num_threads=num_threads)
+        self.encoder.allocate_tensors()
+        self.step.allocate_tensors()
+        self.input_shapes = {
+            details["name"]: tuple(details["shape"]) for details in self.encoder.get_input_details()
+        }
+        self.max_length = self._input_details(self.step)["history"]["shape"][1]
+
+    @property
+    def batch_size(self):
+        return self.input_shapes["base_question"][0]
+
+    def decode(self, inputs):
+        """
+        :param inputs: Same features as the ones passed to `RepeatQ.greedy_decode`.
+        :return: The predicted tokens, [batch size, max generated question length].
+        """
+        features = {name: np.asarray(inputs[name]) for name in FEATURE_NAMES}
+        batch_size = len(features["base_question"])
+        for name, feature in features.items():
+            if batch_size > self.batch_size or feature.shape[1:] != self.input_shapes[name][1:]:
+                raise ValueError(f"The '{name}' input has shape {feature.shape}, the quantized model takes batches of "
+                                 f"shape {self.input_shapes[name]}.")
+            # Padded with copies of the first example, so that padding rows are valid inputs
+            features[name] = np.concatenate((feature, np.repeat(feature[:1], self.batch_size - batch_size, axis=0)))
+
+        base_question_encodings, hidden_state, facts_encodings, budget = self._invoke(self.encoder, features)
+        carry_state = np.zeros_like(hidden_state)
+        observation = np.zeros((self.batch_size,), dtype=np.int32)
+        predictions = np.zeros((self.batch_size, self.max_length), dtype=np.int32)
+        finished = np.zeros((self.batch_size,), dtype=bool)
+        for step in range(np.max(budget)):
+            predicted_tokens, hidden_state, carry_state = self._invoke(self.step, {
+                "base_question": features["base_question"],
+                "base_question_encodings": base_question_encodings,
+                "facts": features["facts"],
+                "facts_encodings": facts_encodings,
+                "hidden_state": hidden_state,
+                "carry_state": carry_state,
+                "observation": observation,
+                "is_first_step": np.array(step == 0),
+                "history": predictions,
+                "step": np.array(step, dtype=np.int32)
+            })
+            predictions[~finished, step] = predicted_tokens[~finished]
+            finished = np.logical_or(
+                finished, np.logical_or(predicted_tokens == 0, predicted_tokens == self.question_mark_id)
+            )
+            finished = np.logical_or(finished, step + 1 >= budget)
+            if np.all(finished[:batch_size]):
+                break
+            observation = predicted_tokens
+        return predictions[:batch_size]
+
+    @staticmethod
+    def _input_details(interpreter):
+        return {details["name"]: details for details in interpreter.get_input_details()}
+
+    @staticmethod
+    def _invoke(interpreter, inputs):
+        for name, details in QuantizedDecoder._input_details(interpreter).items():
+            interpreter.set_tensor(details["index"], inputs[name].astype(details["dtype"]))
+        interpreter.invoke()
+        # Outputs are named after their position in the function's outputs (Identity, Identity_1...)
+        outputs = sorted(interpreter.get_output_details(),
+                         key=lambda details: int(details["name"].partition("_")[2] or 0))
+        return [interpreter.get_tensor(details["index"]) for details in outputs]
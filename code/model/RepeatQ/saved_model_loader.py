@@ -0,0 +1,61 @@
+import numpy as np
+import tensorflow as tf
+
+
+class ExportedRepeatQ:
+    """
+    Serves a RepeatQ SavedModel exported by the export action. Only requires TensorFlow: neither the model's code
+    nor tensorflow_addons are needed, and nothing is traced when loading.
+    """
+
+    def __init__(self, export_dir):
+        self.module = tf.saved_model.load(export_dir)
+        self.signatures = self.module.signatures
+        with open(self.module.vocabulary.asset_path.numpy().decode("utf-8"), mode='r') as vocabulary_file:
+            self.vocabulary = [token.strip() for token in vocabulary_file.readlines()]
+        # Static input shapes of the decoding signatures, batches are padded to them
+        self.input_shapes = {
+            name: spec.shape.as_list() for name, spec in self.signatures["greedy"].structured_input_signature[1].items()
+        }
+
+    @property
+    def batch_size(self):
+        return self.input_shapes["base_question"][0]
+
+    @property
+    def beam_sizes(self):
+        return sorted(int(name[len("beam_"):]) for name in self.signatures if name.startswith("beam_"))
+
+    def greedy(self, base_question, base_question_features, facts, facts_features):
+        return self._decode(self.signatures["greedy"], base_question, base_question_features, facts, facts_features)
+
+    def beam(self, beam_size, base_question, base_question_features, facts, facts_features):
+        return self._decode(self.signatures[f"beam_{beam_size}"], base_question, base_question_features, facts,
+                            facts_features)
+
+    def to_string(self, tokens):
+        return " ".join(self.vocabulary[t] for t in tokens if t != 0)
+
+    def _decode(self, signature, *inputs):
+        """
+        Decodes inputs of any batch size, each input being padded to the signature's shape.
+        :raise ValueError: If an input is longer than the signature's shape along a non-batch dimension.
+        """
+        names = ("base_question", "base_question_features", "facts", "facts_features")
+        inputs = [np.asarray(x) for x in inputs]
+        for name, x in zip(names, inputs):
+            shape = self.input_shapes[name]
+            if x.ndim != len(shape) or any(s > d for s, d in zip(x.shape[1:], shape[1:])):
+                raise ValueError(f"The '{name}' input has shape {x.shape}, it can't be padded to the exported shape "
+                                 f"{shape} (except for the batch size).")
+        nb_rows = len(inputs[0])
+        predictions = []
+        for start in range(0, nb_rows, self.batch_size):
+            batch = {}
+            for name, x in zip(names, inputs):
+                shape = self.input_shapes[name]
+                x = x[start:start + self.batch_size]
+                batch[name] = tf.constant(np.pad(x, [(0, d - s) for d, s in zip(shape, x.shape)]),
+                                          dtype=tf.float32 if name.endswith("features") else tf.int32)
+            predictions.append(signature(**batch)["tokens"].numpy()[:min(self.batch_size, nb_rows - start)])
+        return np.concatenate(predictions, axis=0)
@@ -0,0 +1,70 @@
+import numpy as np
+import tensorflow as tf
+
+from model.RepeatQ.distillation import copy_indicators
+from model.RepeatQ.model import RepeatQ
+from model.RepeatQ.server import RequestEncoder, DEFAULT_LENGTH_BUCKETS
+from model.RepeatQ.tracing import bucket_length
+
+
+def score_batch(model: RepeatQ, features, target):
+    """
+    Log-probabilities of given questions under the pointer-generator distribution, computed with a single
+    teacher-forced pass of `get_actions` without dropout instead of decoding. As in the training loss, a word which can
+    be copied is only counted through the position given by its copy indicator (see `copy_indicators`).
+    :param target: The questions to score, [batch size, target length], padded with 0.
+    :return: The log-probability of each target token, [batch size, target length] (0 on padding), and of each
+    target, [batch size].
+    """
+    _, distributions = model.get_actions(features, target=target, training=True, dropout=False)
+    if model.config.fused_output_head:
+        # Copy mass is already merged onto the vocabulary ids
+        target_probs = tf.gather(distributions, target, batch_dims=2) / tf.reduce_sum(distributions, axis=-1)
+    else:
+        copy_indicator = copy_indicators(target, features["base_question"], features["facts"])
+        output_ids = tf.where(
+            tf.not_equal(copy_indicator, -1), len(model.vocabulary_word_to_id) + copy_indicator, target
+        )
+        target_probs = tf.gather(distributions, output_ids, batch_dims=2)
+    token_log_probs = tf.where(tf.not_equal(target, 0), -RepeatQ.cross_entropy(target_probs), 0.0)
+    return token_log_probs, tf.reduce_sum(token_log_probs, axis=-1)
+
+
+def loss_parity(model: RepeatQ, features, target):
+    """
+    Checks `score_batch` against the training loss: the mean negative log-probability of the target tokens must be
+    the loss of `get_actions` without dropout, up to float rounding, as both gather the same probabilities and clip
+    them the same way. This doesn't hold with a training shortlist or sampled softmax, whose loss isn't computed over
+    the full vocabulary.
+    :param features: Features of a dataset batch, the training loss using their "target_copy_indicator".
+    :return: The mean negative log-probability of the target tokens and the training loss.
+    """
+    token_log_probs, _ = score_batch(model, features, target)
+    _, loss = model.get_actions(features, target=target, training=True, compute_loss=True, dropout=False)
+    nb_tokens = tf.reduce_sum(tf.cast(tf.not_equal(target, 0), tf.float32))
+    return float(-tf.reduce_sum(token_log_probs) / nb_tokens), float(loss)
+
+
+def score_candidates(model: RepeatQ, encoder: RequestEncoder, requests, candidates, batch_size=32,
+                     length_buckets=DEFAULT_LENGTH_BUCKETS):
+    """
+    Scores candidate rewrites of encoded requests, the (request, candidate) pairs being scored in batches.
+    :param candidates: The candidate rewrites of each request (tokenized, tokens separated by spaces).
+    :return: For each request, the (per-token log-probabilities, total log-probability) of each of its candidates.
+    """
+    pairs = [(i, request, encoder.words_to_ids(candidate.split()))
+             for i, (request, request_candidates) in enumerate(zip(requests, candidates))
+             for candidate in request_candidates]
+    scores = [[] for _ in requests]
+    for start in range(0, len(pairs), batch_size):
+        batch = pairs[start:start + batch_size]
+        features = encoder.batch([request for _, request, _ in batch], length_buckets)
+        target = np.zeros((features["base_question"].shape[0],
+                           bucket_length(max(max(len(ids) for _, _, ids in batch), 1), length_buckets)), dtype=np.int32)
+        for row, (_, _, ids) in enumerate(batch):
+            target[row, :len(ids)] = ids
+        token_log_probs, log_probs = score_batch(model, features, tf.constant(target))
+        token_log_probs, log_probs = token_log_probs.numpy(), log_probs.numpy()
+        for row, (i, _, ids) in enumerate(batch):
+            scores[i].append((token_log_probs[row, :len(ids)].tolist(), float(log_probs[row])))
+    return scores
@@ -0,0 +1,442 @@
+import asyncio
+import json
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from logging import info, warning
+
+import numpy as np
+import tensorflow as tf
+
+from defs import UNKNOWN_TOKEN, PAD_TOKEN
+from model.RepeatQ.prediction_cache import input_key
+from model.RepeatQ.tracing import bucket_length
+
+# A request converted to ids, base question [question length], its features [question length, nb features], facts
+# [nb facts, fact length] and their features [nb facts, fact length, nb features]
+EncodedRequest = namedtuple("EncodedRequest", ("base_question", "base_question_features", "facts", "facts_features"))
+
+# Lengths requests are padded up to when no shape buckets are configured, to bound the number of traced shapes
+DEFAULT_LENGTH_BUCKETS = (16, 32, 64)
+
+HTTP_STATUS = {200: "200 OK", 400: "400 Bad Request", 404: "404 Not Found", 500: "500 Internal Server Error",
+               504: "504 Gateway Timeout"}
+
+
+class RequestEncoder:
+    """
+    Converts rewrite requests to model inputs. Requests use the fields of the dataset files: "base_question" and
+    "facts" (tokenized, tokens separated by spaces) and, if the model uses POS or NER features, their
+    "base_question_pos_tags", "base_question_entity_tags", "facts_pos_tags" and "facts_entity_tags".
+    """
+
+    def __init__(self, vocabulary, feature_vocabulary, use_pos_features, use_ner_features,
+                 reduced_ner_indicators=False):
+        self.vocabulary = vocabulary
+        self.reverse_vocabulary = {i: word for word, i in vocabulary.items()}
+        self.feature_vocabulary = feature_vocabulary
+        self.use_pos_features = use_pos_features
+        self.use_ner_features = use_ner_features
+        self.reduced_ner_indicators = reduced_ner_indicators
+
+    @property
+    def nb_features(self):
+        return 2 if self.use_pos_features or self.use_ner_features else 0
+
+    def encode(self, request) -> EncodedRequest:
+        if not isinstance(request, dict) or not isinstance(request.get("base_question"), str) or \
+                not isinstance(request.get("facts"), list):
+            raise ValueError("A request needs a \"base_question\" string and a \"facts\" list.")
+        base_question = self.words_to_ids(request["base_question"].split())
+        facts = [self.words_to_ids(fact.split(' ')) for fact in request["facts"]]
+        base_question_features = self.features(len(base_question), request.get("base_question_pos_tags"),
+                                               request.get("base_question_entity_tags"))
+        facts_features = [self.features(len(fact), pos_tags, entity_tags) for fact, pos_tags, entity_tags in zip(
+            facts,
+            request.get("facts_pos_tags", [None] * len(facts)),
+            request.get("facts_entity_tags", [None] * len(facts))
+        )]
+        if len(facts_features) != len(facts):
+            raise ValueError("Requests must provide the tags of every fact.")
+        return EncodedRequest(base_question, base_question_features, facts, facts_features)
+
+    def words_to_ids(self, words):
+        return [self.vocabulary.get(word.lower(), self.vocabulary[UNKNOWN_TOKEN]) for word in words]
+
+    def features(self, length, pos_tags, entity_tags):
+        """
+        :return: The POS and entity tag ids of a sentence, [length, nb features] (missing tags are padded with 0).
+        """
+        features = np.zeros((length, self.nb_features), dtype=np.float32)
+        for i, (used, tags) in enumerate(((self.use_pos_features, pos_tags), (self.use_ner_features, entity_tags))):
+            if not used:
+                continue
+            if tags is None:
+                raise ValueError("This model uses POS and NER features, requests must provide their tags.")
+            if self.reduced_ner_indicators and i == 1:
+                tags = tags.replace("BA", "BN").replace("IA", "IN")
+            ids = [self.feature_vocabulary[tag] for tag in tags.split()][:length]
+            features[:len(ids), i] = ids
+        return features
+
+    @staticmethod
+    def shape(request: EncodedRequest):
+        """
+        :return: The base question length, number of facts and longest fact length of a request.
+        """
+        return len(request.base_question), len(request.facts), max((len(f) for f in request.facts), default=1)
+
+    def batch(self, requests, length_buckets=DEFAULT_LENGTH_BUCKETS, shape=None):
+        """
+        Pads encoded requests into a batch whose lengths are rounded up to the length buckets, and whose number of
+        facts and of rows are rounded up to powers of two, bounding the number of shapes the decoding functions are
+        traced for. Padding rows are all zeros.
+        :param shape: If given, (batch size, question length, nb facts, fact length) of the batch instead.
+        """
+        def power_of_two(n):
+            return 1 << max(n - 1, 0).bit_length()
+
+        if shape is not None:
+            nb_rows, question_length, nb_facts, fact_length = shape
+        else:
+            question_lengths, nbs_facts, fact_lengths = zip(*(RequestEncoder.shape(r) for r in requests))
+            nb_rows = power_of_two(len(requests))
+            question_length = bucket_length(max(question_lengths), length_buckets)
+            nb_facts = power_of_two(max(max(nbs_facts), 1))
+            fact_length = bucket_length(max(fact_lengths), length_buckets)
+
+        base_question = np.zeros((nb_rows, question_length), dtype=np.int32)
+        base_question_features = np.zeros((nb_rows, question_length, self.nb_features), dtype=np.float32)
+        facts = np.zeros((nb_rows, nb_facts, fact_length), dtype=np.int32)
+        facts_features = np.zeros((nb_rows, nb_facts, fact_length, self.nb_features), dtype=np.float32)
+        for i, request in enumerate(requests):
+            # Inputs longer than the largest bucket are rounded up to a multiple of it, so nothing is truncated
+            base_question[i, :len(request.base_question)] = request.base_question
+            base_question_features[i, :len(request.base_question)] = request.base_question_features
+            for j, (fact, fact_features) in enumerate(zip(request.facts, request.facts_features)):
+                facts[i, j, :len(fact)] = fact
+                facts_features[i, j, :len(fact)] = fact_features
+        return {
+            "base_question": tf.constant(base_question),
+            "base_question_features": tf.constant(base_question_features),
+            "facts": tf.constant(facts),
+            "facts_features": tf.constant(facts_features)
+        }
+
+    def to_string(self, tokens):
+        return " ".join(self.reverse_vocabulary[t] for t in tokens if self.reverse_vocabulary[t] != PAD_TOKEN)
+
+
+def decode_requests(model, encoder: RequestEncoder, requests, beam_search_size=1,
+                    length_buckets=DEFAULT_LENGTH_BUCKETS):
+    """
+    Decodes encoded requests as one batch.
+    :return: The rewritten questions.
+    """
+    features = encoder.batch(requests, length_buckets)
+    if beam_search_size == 1 and model.encoder_cache is not None:
+        # The encoder cache only applies to the eager decoding loop, which is slower than the traced decoding
+        # function unless most encoder outputs are cached
+        tokens = model.greedy_decode(features)
+    else:
+        tokens = model.decode(features, beam_search_size=beam_search_size).numpy()
+    return [encoder.to_string(t) for t in tokens[:len(requests)]]
+
+
+class MicroBatcher:
+    """
+    Groups the requests submitted concurrently into batches of at most `max_batch_size` requests, waiting at most
+    `max_wait` seconds after the first request of a batch for more requests. Batches are processed one at a time in
+    a worker thread so that the event loop keeps accepting requests meanwhile.
+    """
+
+    def __init__(self, decode, max_batch_size, max_wait):
+        """
+        :param decode: Function processing a list of requests (decoding or annotating them), returning one result per
+        request.
+        """
+        self.decode = decode
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.queue = asyncio.Queue()
+        self.executor = ThreadPoolExecutor(max_workers=1)
+
+    async def submit(self, request, deadline):
+        """
+        :param deadline: Event loop time after which the request is abandoned, raising `asyncio.TimeoutError`.
+        """
+        loop = asyncio.get_event_loop()
+        future = loop.create_future()
+        await self.queue.put((request, deadline, future))
+        return await asyncio.wait_for(future, timeout=max(deadline - loop.time(), 0.0))
+
+    async def run(self):
+        loop = asyncio.get_event_loop()
+        while True:
+            batch = [await self.queue.get()]
+            batch_deadline = loop.time() + self.max_wait
+            while len(batch) < self.max_batch_size:
+                timeout = batch_deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), timeout=timeout))
+                except asyncio.TimeoutError:
+                    break
+            # Requests whose deadline passed while waiting were already answered
+            batch = [(request, future) for request, deadline, future in batch if not future.done()]
+            if len(batch) == 0:
+                continue
+            try:
+                results = await loop.run_in_executor(self.executor, self.decode, [request for request, _ in batch])
+            except Exception as e:
+                warning(f"Processing a batch of {len(batch)} requests failed: {e}")
+                results = [e] * len(batch)
+            for (_, future), result in zip(batch, results):
+                if future.done():
+                    continue
+                if isinstance(result, Exception):
+                    future.set_exception(result)
+                else:
+                    future.set_result(result)
+
+
+class ContinuousBatcher:
+    """
+    Feeds the requests submitted concurrently to a `ContinuousBatchingScheduler`: between two decoder steps, waiting
+    requests are admitted into the free slots, and each request is answered as soon as its sequence finishes.
+    Requests whose deadline passes are evicted from their slot.
+    """
+
+    def __init__(self, scheduler, encoder: RequestEncoder):
+        self.scheduler = scheduler
+        self.encoder = encoder
+        self.queue = asyncio.Queue()
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.futures = {}
+        self.next_key = 0
+
+    async def submit(self, request, deadline):
+        if not self.scheduler.fits(*RequestEncoder.shape(request)):
+            raise ValueError(f"Requests are limited to (question length, nb facts, fact length) of "
+                             f"{self.scheduler.shape}.")
+        loop = asyncio.get_event_loop()
+        future = loop.create_future()
+        await self.queue.put((request, future))
+        return await asyncio.wait_for(future, timeout=max(deadline - loop.time(), 0.0))
+
+    def advance(self, requests):
+        """
+        Admits the new requests, then runs one decoder step.
+        :return: The keys and predicted questions of the finished requests.
+        """
+        if len(requests) > 0:
+            keys = [key for key, _ in requests]
+            features = self.encoder.batch(
+                [request for _, request in requests], shape=(len(requests), *self.scheduler.shape)
+            )
+            self.scheduler.admit(keys, features)
+        return [(key, self.encoder.to_string(tokens)) for key, tokens in self.scheduler.step()]
+
+    async def run(self):
+        loop = asyncio.get_event_loop()
+        while True:
+            if self.scheduler.nb_active == 0 and self.queue.empty():
+                request, future = await self.queue.get()
+                self.queue.put_nowait((request, future))
+            # Requests whose deadline passed are evicted, as they were already answered
+            for key, future in list(self.futures.items()):
+                if future.done():
+                    self.scheduler.evict(key)
+                    del self.futures[key]
+            admitted = []
+            while len(admitted) < len(self.scheduler.free_slots) and not self.queue.empty():
+                request, future = self.queue.get_nowait()
+                if future.done():
+                    continue
+                self.futures[self.next_key] = future
+                admitted.append((self.next_key, request))
+                self.next_key += 1
+            if self.scheduler.nb_active == 0 and len(admitted) == 0:
+                continue
+            try:
+                results = await loop.run_in_executor(self.executor, self.advance, admitted)
+            except Exception as e:
+                warning(f"Decoding step failed: {e}")
+                for key, future in self.futures.items():
+                    self.scheduler.evict(key)
+                    if not future.done():
+                        future.set_exception(e)
+                self.futures = {}
+                continue
+            for key, question in results:
+                future = self.futures.pop(key)
+                if not future.done():
+                    future.set_result(question)
+
+
+class RewriteServer:
+    """
+    Long-lived HTTP server rewriting questions with a loaded model. `POST /rewrite` takes a JSON request (see
+    `RequestEncoder`), optionally with a "timeout_ms" deadline, and answers {"question": <rewritten question>}.
+    With a raw text pipeline, `POST /rewrite_text` takes {"question": ..., "answers": [...], "facts": [...]} in raw
+    text, which is annotated with the raw text requests received meanwhile, then decoded with the other requests.
+    `GET /health` answers {"status": "ok"}.
+    Connections are kept alive until the client closes them.
+    """
+
+    def __init__(self, model, encoder: RequestEncoder, beam_search_size=1, max_batch_size=32, max_wait_ms=5,
+                 timeout_ms=1000, length_buckets=DEFAULT_LENGTH_BUCKETS, scheduler=None, pipeline=None,
+                 prediction_cache=None):
+        """
+        :param scheduler: Optional `ContinuousBatchingScheduler` (greedy decoding only), requests are then decoded with
+        continuous batching instead of micro-batches.
+        :param pipeline: Optional `RawTextPipeline` annotating the raw text requests.
+        :param prediction_cache: Optional `PredictionCache`, cached requests are answered without being decoded.
+        """
+        self.model = model
+        self.encoder = encoder
+        self.beam_search_size = beam_search_size
+        self.timeout = timeout_ms / 1000
+        self.length_buckets = length_buckets
+        self.pipeline = pipeline
+        self.prediction_cache = prediction_cache
+        # SQLite queries block, so the cache is queried in its own thread rather than on the event loop
+        self.cache_executor = ThreadPoolExecutor(max_workers=1)
+        # Raw text requests are annotated in micro-batches too, in their own thread so that annotation overlaps with
+        # decoding
+        self.annotation_batcher = MicroBatcher(self.annotate, max_batch_size, max_wait_ms / 1000)
+        if scheduler is not None:
+            if beam_search_size > 1:
+                raise ValueError("Continuous batching only supports greedy decoding.")
+            self.batcher = ContinuousBatcher(scheduler, encoder)
+        else:
+            self.batcher = MicroBatcher(self.decode, max_batch_size, max_wait_ms / 1000)
+
+    def decode(self, requests):
+        return decode_requests(self.model, self.encoder, requests, self.beam_search_size, self.length_buckets)
+
+    def annotate(self, raw_requests):
+        """
+        :param raw_requests: (question, answers, facts) of each raw text request.
+        :return: The annotated requests, with the fields of the dataset files.
+        """
+        return self.pipeline.annotate(*(list(field) for field in zip(*raw_requests)))
+
+    @staticmethod
+    def raw_request(request):
+        """
+        :return: The (question, answers, facts) of a raw text request.
+        """
+        raw_request = (request["question"], request.get("answers", []), request["facts"])
+        if not isinstance(raw_request[0], str) or any(
+                not isinstance(texts, list) or not all(isinstance(t, str) for t in texts) for texts in raw_request[1:]):
+            raise TypeError("A raw text request needs a \"question\" string, and \"answers\" and \"facts\" lists "
+                            "of strings.")
+        return raw_request
+
+    async def rewrite(self, body, raw_text=False):
+        loop = asyncio.get_event_loop()
+        start = loop.time()
+        try:
+            request = json.loads(body)
+            timeout = float(request.get("timeout_ms", self.timeout * 1000)) / 1000
+            if raw_text:
+                raw_request = self.raw_request(request)
+        except (ValueError, KeyError, TypeError, AttributeError) as e:
+            return 400, {"error": str(e)}
+        if raw_text:
+            try:
+                request = await self.annotation_batcher.submit(raw_request, start + timeout)
+            except asyncio.TimeoutError:
+                return 504, {"error": f"Deadline of {timeout * 1000:.0f} ms exceeded."}
+            except Exception as e:
+                # Annotation failures (ex: the annotator running out of memory) are answered like decoding ones
+                return 500, {"error": str(e)}
+        try:
+            encoded = self.encoder.encode(request)
+        except ValueError as e:
+            return 400, {"error": str(e)}
+        key = None
+        if self.prediction_cache is not None:
+            key = input_key(*encoded)
+            question = await loop.run_in_executor(self.cache_executor, self.prediction_cache.get, key)
+            if question is not None:
+                return 200, {"question": question}
+        try:
+            question = await self.batcher.submit(encoded, start + timeout)
+        except ValueError as e:
+            return 400, {"error": str(e)}
+        except asyncio.TimeoutError:
+            return 504, {"error": f"Deadline of {timeout * 1000:.0f} ms exceeded."}
+        except Exception as e:
+            return 500, {"error": str(e)}
+        if key is not None:
+            await loop.run_in_executor(self.cache_executor, self.prediction_cache.put, key, question)
+        return 200, {"question": question}
+
+    async def handle_connection(self, reader, writer):
+        try:
+            while True:
+                request_line, headers, body = await read_http_message(reader)
+                method, path, _ = request_line.split(" ", 2)
+                if method == "POST" and path == "/rewrite":
+                    status, response = await self.rewrite(body)
+                elif method == "POST" and path == "/rewrite_text" and self.pipeline is not None:
+                    status, response = await self.rewrite(body, raw_text=True)
+                elif method == "GET" and path == "/health":
+                    status, response = 200, {"status": "ok"}
+                else:
+                    status, response = 404, {"error": f"No route for {method} {path}."}
+                writer.write(http_message(f"HTTP/1.1 {HTTP_STATUS[status]}", response))
+                await writer.drain()
+                if headers.get("connection", "").lower() == "close":
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, host="127.0.0.1", port=8080, unix_socket=None):
+        batcher = asyncio.ensure_future(self.batcher.run())
+        annotation_batcher = asyncio.ensure_future(self.annotation_batcher.run()) if self.pipeline is not None else None
+        if unix_socket is not None:
+            server = await asyncio.start_unix_server(self.handle_connection, path=unix_socket)
+            info(f"Serving on unix socket '{unix_socket}'.")
+        else:
+            server = await asyncio.start_server(self.handle_connection, host=host, port=port)
+            info(f"Serving on http://{host}:{port}.")
+        try:
+            await server.serve_forever()
+        finally:
+            batcher.cancel()
+            if annotation_batcher is not None:
+                annotation_batcher.cancel()
+            if self.prediction_cache is not None:
+                self.prediction_cache.log_stats()
+            if self.model.encoder_cache is not None:
+                self.model.encoder_cache.log_stats()
+
+
+def http_message(first_line, payload, headers=None):
+    body = json.dumps(payload).encode("utf-8")
+    header_lines = [first_line, "Content-Type: application/json", f"Content-Length: {len(body)}"]
+    header_lines += [f"{name}: {value}" for name, value in (headers or {}).items()]
+    return ("\r\n".join(header_lines) + "\r\n\r\n").encode("latin-1") + body
+
+
+async def read_http_message(reader):
+    """
+    :return: The first line, the headers and the body of an HTTP message.
+    """
+    first_line = (await reader.readline()).decode("latin-1").strip()
+    if not first_line:
+        raise ConnectionError("Connection closed.")
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b"\n", b""):
+            break
+        name, value = line.decode("latin-1").split(":", 1)
+        headers[name.strip().lower()] = value.strip()
+    body = await reader.readexactly(int(headers.get("content-length", 0)))
+    return first_line, headers, body
@@ -0,0 +1,110 @@
+from collections import namedtuple
+from logging import info
+from typing import List
+
+import numpy as np
+import tensorflow as tf
+
+from data_processing.class_defs import RepeatQExample
+
+# Vocabulary ids of the shortlist, [shortlist size], position of every vocabulary id in the shortlist (-1 if absent),
+# [vocabulary size], and the matching columns of the output projection
+OutputShortlist = namedtuple("OutputShortlist", ("ids", "positions", "kernel", "bias"))
+
+
+def batch_shortlist_ids(nb_frequent_words, base_question, facts, candidate_table=None, target=None):
+    """
+    Builds the generation vocabulary of a batch: the most frequent words (the vocabulary is sorted by frequency), every
+    token of the batch's base questions and facts, the candidates of the base question tokens if a candidate table is
+    given and the target tokens if given (training).
+    :return: The sorted vocabulary ids of the shortlist, [shortlist size].
+    """
+    tokens = [tf.range(nb_frequent_words), tf.reshape(base_question, (-1,)), tf.reshape(facts, (-1,))]
+    if candidate_table is not None:
+        tokens.append(tf.reshape(tf.gather(candidate_table, base_question), (-1,)))
+    if target is not None:
+        tokens.append(tf.reshape(target, (-1,)))
+    ids, _ = tf.unique(tf.concat(tokens, axis=0))
+    return tf.sort(ids)
+
+
+def sampled_softmax_ids(nb_sampled, vocab_size, base_question, facts, target):
+    """
+    Builds the vocabulary of a sampled softmax training step: the batch's target words, base question and fact words
+    (so that the copy mass of the fused head can be merged onto them) and `nb_sampled` negative words drawn without
+    replacement from a log-uniform distribution, which matches the frequency-sorted vocabulary ids.
+    The logits are corrected by the log of each word's expected count in the sample. For the sampled negatives, it is
+    the expected count given by the sampler, which accounts for the sampling without replacement. The batch words are
+    in the sample whatever is drawn, their expected count is 1 and their logits are left as they are.
+    :return: The sorted vocabulary ids, [sample size], and the correction subtracted from their logits, [sample size].
+    """
+    sampled_ids, _, sampled_expected_count = tf.random.log_uniform_candidate_sampler(
+        true_classes=tf.zeros((1, 1), dtype=tf.int64),
+        num_true=1,
+        num_sampled=nb_sampled,
+        unique=True,
+        range_max=vocab_size
+    )
+    sampled_ids = tf.cast(sampled_ids, tf.int32)
+    batch_ids = batch_shortlist_ids(0, base_question, facts, target=target)
+    ids, _ = tf.unique(tf.concat((batch_ids, sampled_ids), axis=0))
+    ids = tf.sort(ids)
+    corrections = tf.tensor_scatter_nd_update(
+        tf.zeros((vocab_size,)), tf.expand_dims(sampled_ids, axis=-1), tf.math.log(sampled_expected_count)
+    )
+    corrections = tf.tensor_scatter_nd_update(
+        corrections, tf.expand_dims(batch_ids, axis=-1), tf.zeros_like(batch_ids, dtype=tf.float32)
+    )
+    return ids, tf.gather(corrections, ids)
+
+
+def shortlist_positions(ids, vocab_size):
+    return tf.tensor_scatter_nd_update(
+        -tf.ones((vocab_size,), dtype=tf.int32), tf.expand_dims(ids, axis=-1), tf.range(tf.size(ids))
+    )
+
+
+def fit_candidate_table(examples: List[RepeatQExample], vocab_size, nb_candidates) -> np.ndarray:
+    """
+    Learns a candidate set for each word from the training data: the words that appear the most often in the targets
+    of examples whose base question contains the word, while being neither in that base question nor in its facts
+    (those are always in the shortlist anyway).
+    :return: The candidates of each vocabulary word, [vocabulary size, nb_candidates], padded with 0.
+    """
+    co_occurrences = {}
+    for example in examples:
+        inputs = set(np.unique(example.base_question)) | set(np.unique(example.facts))
+        generated = set(np.unique(example.rephrased_question)) - inputs
+        for word in set(np.unique(example.base_question)) - {0}:
+            counts = co_occurrences.setdefault(word, {})
+            for target_word in generated:
+                counts[target_word] = counts.get(target_word, 0) + 1
+    table = np.zeros((vocab_size, nb_candidates), dtype=np.int32)
+    for word, counts in co_occurrences.items():
+        candidates = sorted(counts, key=counts.get, reverse=True)[:nb_candidates]
+        table[word, :len(candidates)] = candidates
+    return table
+
+
+def shortlist_coverage(examples: List[RepeatQExample], nb_frequent_words, candidate_table=None):
+    """
+    Share of the target tokens which can be generated or copied when restricting each example's generation
+    vocabulary to its own shortlist (a lower bound of the coverage of batch shortlists).
+    :return: The token coverage and the share of examples whose target is entirely covered.
+    """
+    nb_tokens, nb_covered, nb_fully_covered = 0, 0, 0
+    for example in examples:
+        covered = set(np.unique(example.base_question)) | set(np.unique(example.facts))
+        if candidate_table is not None:
+            covered |= set(np.unique(candidate_table[example.base_question]))
+        target = [t for t in example.rephrased_question if t != 0]
+        example_covered = sum(1 for t in target if t < nb_frequent_words or t in covered)
+        nb_tokens += len(target)
+        nb_covered += example_covered
+        nb_fully_covered += int(example_covered == len(target))
+    return nb_covered / max(nb_tokens, 1), nb_fully_covered / max(len(examples), 1)
+
+
+def save_candidate_table(path, candidate_table: np.ndarray):
+    np.save(path, candidate_table)
+    info(f"Shortlist candidates saved to '{path}'.")
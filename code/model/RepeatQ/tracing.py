@@ -0,0 +1,114 @@
+from logging import info, warning
+
+import numpy as np
+import tensorflow as tf
+
+
+def bucket_length(length, buckets):
+    """
+    :return: The smallest bucket holding `length`, lengths above the largest bucket being rounded up to a multiple of
+    it (or `length` itself without buckets).
+    """
+    if len(buckets) == 0:
+        return length
+    for bucket in sorted(buckets):
+        if length <= bucket:
+            return bucket
+    largest = max(buckets)
+    return -(-length // largest) * largest
+
+
+def pad_to_length(sequence, length, value=0, axis=-1):
+    sequence = np.asarray(sequence)
+    paddings = [(0, 0)] * sequence.ndim
+    paddings[axis] = (0, length - sequence.shape[axis])
+    return np.pad(sequence, paddings, constant_values=value)
+
+
+def remap_copy_indicators(copy_indicators, question_length, fact_length, bucketed_question_length,
+                          bucketed_fact_length):
+    """
+    Copy indicators index the concatenation [base question, fact 1, ..., fact l], so they move when the base question
+    and the facts are padded to longer lengths.
+    """
+    copy_indicators = np.asarray(copy_indicators)
+    from_facts = copy_indicators >= question_length
+    fact_offsets = copy_indicators - question_length
+    remapped = bucketed_question_length + (fact_offsets // fact_length) * bucketed_fact_length + \
+        fact_offsets % fact_length
+    return np.where(from_facts, remapped, copy_indicators)
+
+
+def batch_sizes(nb_examples, batch_size, drop_remainder):
+    """
+    :return: The distinct batch sizes of a dataset of `nb_examples` examples.
+    """
+    sizes = [batch_size] if nb_examples >= batch_size else []
+    if not drop_remainder and nb_examples % batch_size != 0:
+        sizes.append(nb_examples % batch_size)
+    return sizes
+
+
+def with_batch_size(specs, batch_size):
+    return tf.nest.map_structure(lambda s: tf.TensorSpec((batch_size, *s.shape[1:]), dtype=s.dtype), specs)
+
+
+DECODING_FEATURES = ("base_question", "base_question_features", "facts", "facts_features")
+
+
+def decoding_signature(features):
+    """
+    :param features: Features (or their specs) of a batch, only the decoding features are used.
+    :return: The input signature of the decoding functions for the shape of this batch.
+    """
+    return [tf.TensorSpec(features[name].shape, dtype=features[name].dtype, name=name) for name in DECODING_FEATURES]
+
+
+class TraceMonitor:
+    """
+    Counts the traces of the decoding and training functions. Tracing runs the Python body of a `tf.function`, so
+    `traced` is called once per trace only. Once the functions are warmed up, every new trace is logged as a warning
+    with the call signature which caused it.
+    """
+
+    def __init__(self):
+        self.counts = {}
+        self.warmed_up = False
+
+    def traced(self, name, **signature):
+        self.counts[name] = self.counts.get(name, 0) + 1
+        if self.warmed_up:
+            warning(f"Unexpected retrace of {name} (trace #{self.counts[name]}): {signature}")
+
+    def warm_up(self, concrete_functions):
+        """
+        :param concrete_functions: Callables tracing one concrete function each (ex: calls of `get_concrete_function`).
+        """
+        self.warmed_up = False
+        for concrete_function in concrete_functions:
+            concrete_function()
+        self.warmed_up = True
+        info(f"Warmed up {len(concrete_functions)} concrete functions: {self.counts}.")
+
+
+TRACES = TraceMonitor()
+
+
+def input_signature(inputs):
+    return {name: (t.shape.as_list(), t.dtype.name) for name, t in inputs.items() if isinstance(t, tf.Tensor)}
+
+
+def decoding_warm_up(model, feature_specs, greedy=True, beam_search_size=1):
+    """
+    :param feature_specs: Specs of every batch shape the model will decode.
+    :param greedy: If True, traces the greedy decoding function (see `RepeatQ.decoding_function`).
+    :param beam_search_size: If above 1, traces the beam search decoding function with this beam size.
+    :return: The concrete function tracers of inference decoding for these shapes.
+    """
+    tracers = []
+    for specs in feature_specs:
+        if greedy:
+            tracers.append(model.decoding_function(specs).get_concrete_function)
+        if beam_search_size > 1:
+            tracers.append(model.decoding_function(specs, beam_search_size=beam_search_size).get_concrete_function)
+    return tracers
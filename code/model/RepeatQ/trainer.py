@@ -6,7 +6,11 @@ import nltk
 import tensorflow as tf
 from tqdm import tqdm
 from defs import PAD_TOKEN, TRAINED_MODELS_DIR, EOS_TOKEN
+from model.RepeatQ.benchmark import decode_dataset, corpus_scores, format_report
+from model.RepeatQ.distillation import copy_indicators, soft_cross_entropy
 from model.RepeatQ.model_config import ModelConfiguration
+from model.RepeatQ.pruning import StructuredPruner, polynomial_sparsity
+from model.RepeatQ.tracing import TRACES, input_signature, decoding_warm_up
 
 
 class RepeatQTrainer:
@@ -17,7 +21,12 @@ class RepeatQTrainer:
                  training_data,
                  dev_data,
                  vocabulary,
-                 optimizer=None):
+                 optimizer=None,
+                 teacher=None):
+        """
+        :param teacher: Optional trained RepeatQ model with the same vocabulary and output head. When given, the model
+        is trained as its student by distillation (see `_distillation_step`).
+        """
         super(RepeatQTrainer, self).__init__()
         self.training_data = training_data
         self.dev_data = dev_data
@@ -33,6 +42,24 @@ class RepeatQTrainer:
         else:
             self.optimizer = optimizer
         self.model = model
+        self.teacher = teacher
+        # Synthetic and organic training batches share their shapes, and the epoch and dataset type are passed as
+        # tensors, so training steps are traced once
+        features_specs, labels_specs = self._training_batches().element_spec
+        self.train_step = tf.function(self._train_step, input_signature=(
+            features_specs, labels_specs, tf.TensorSpec((), dtype=tf.int32), tf.TensorSpec((), dtype=tf.string)
+        ))
+
+    def _training_batches(self):
+        return self.training_data if self.config.mixed_data else self.training_data["organic"]
+
+    def warm_up(self):
+        """
+        Traces the training step and the dev set decoding before training, any later trace being logged.
+        """
+        dev_data = [self.dev_data] if self.config.mixed_data else list(self.dev_data.values())
+        dev_specs = {str(data.element_spec[0]): data.element_spec[0] for data in dev_data}
+        TRACES.warm_up([self.train_step.get_concrete_function, *decoding_warm_up(self.model, dev_specs.values())])
 
     def train(self):
         model_save_dir = self._prepare_model_save_dir()
@@ -41,13 +68,14 @@ class RepeatQTrainer:
             tf.print("About to start training for ", nb_epochs, " epochs with ", ds_type, " dataset.")
             for epoch in range(nb_epochs):
                 for features, label in tqdm(data):
-                    self.train_step(features, label, epoch=epoch, ds_type=ds_type)
+                    self.train_step(features, label, tf.constant(epoch), tf.constant(ds_type))
 
                 dev_score = self.dev_step(dev_data)
                 tf.print("Score on dev set:", dev_score)
                 if self.config.saving_model:
                     checkpoint_filename = f"{model_save_dir}/{ds_type}_epoch_{epoch + 1}_bleu_{'%.2f' % dev_score}"
                     self.model.save_weights(filepath=checkpoint_filename)
+                    self.config.save_architecture(checkpoint_filename)
 
         nb_epochs_config = {
             "synthetic": self.config.synth_supervised_epochs, "organic": self.config.org_supervised_epochs
@@ -62,9 +90,49 @@ class RepeatQTrainer:
                 data = self.training_data[ds_type]
                 dev_data = self.dev_data[ds_type]
                 train(nb_epochs=nb_epochs, data=data, dev_data=dev_data, ds_type=ds_type)
+        nb_trainable = sum(v.shape.num_elements() for v in self.model.trainable_variables)
+        info(f"Model parameters: {self.model.count_params()} ({nb_trainable} trainable).")
+
+        if self.config.pruning_epochs > 0:
+            self.prune(model_save_dir)
+
+    def prune(self, model_save_dir):
+        """
+        Pruning-aware fine-tuning on the organic data: the sparsity grows gradually up to `pruning_sparsity` over
+        `pruning_epochs` epochs, the pruned weights being zeroed again after every update. After each epoch, the
+        compacted model is evaluated on the dev set against the dense model (and saved if saving models).
+        """
+        data = self._training_batches()
+        dev_data = self.dev_data if self.config.mixed_data else self.dev_data["organic"]
+        pruner = StructuredPruner(self.model, block_size=self.config.pruning_block_size)
+        predictions, references, dense_throughput = decode_dataset(self.model.greedy_decode, dev_data)
+        report = {"dense": {**corpus_scores(predictions, references), "examples/s": dense_throughput, "speed-up": 1.0}}
+        for epoch in range(self.config.pruning_epochs):
+            sparsity = polynomial_sparsity(self.config.pruning_sparsity, epoch + 1, self.config.pruning_epochs)
+            masks = pruner.masks(sparsity)
+            pruner.apply(masks)
+            for features, label in tqdm(data):
+                self.train_step(features, label, tf.constant(epoch), tf.constant("pruning"))
+                pruner.apply(masks)
 
-    @tf.function
-    def train_step(self, features, labels, epoch, ds_type):
+            compacted = pruner.compacted_model(sparsity, features)
+            predictions, references, throughput = decode_dataset(compacted.greedy_decode, dev_data)
+            report[f"sparsity {sparsity:.2f}"] = {
+                **corpus_scores(predictions, references),
+                "examples/s": throughput,
+                "speed-up": throughput / dense_throughput
+            }
+            info(f"Pruning on the dev set (LSTM kernels sparsity: {pruner.lstm_sparsity():.2f}):\n"
+                 f"{format_report(report)}")
+            if self.config.saving_model:
+                checkpoint_filename = f"{model_save_dir}/pruned_{sparsity:.2f}_readout_" \
+                                      f"{compacted.config.decoder_readout_size}_attention_" \
+                                      f"{compacted.config.attention_depth}"
+                compacted.save_weights(filepath=checkpoint_filename)
+                compacted.config.save_architecture(checkpoint_filename)
+
+    def _train_step(self, features, labels, epoch, ds_type):
+        TRACES.traced("RepeatQTrainer.train_step", **input_signature(features))
         loss, tape = self._supervised_step(features, labels)
         tf.print("Dataset:", ds_type, "/ Epoch:", epoch + 1, "/ Perplexity:", tf.pow(loss, 2), "\n")
         gradients = tape.gradient(loss, self.model.trainable_variables)
@@ -86,7 +154,7 @@ class RepeatQTrainer:
             size=dev_step_size, dtype=tf.int32, name="dev_labels", dynamic_size=True
         )
         for i, (features, label) in tqdm(enumerate(dev_data)):
-            predictions, _ = self.model.get_actions(features, target=label, training=False)
+            predictions = self.model.decode(features)
             paddings = (
                 (0, 0), (0, tf.math.maximum(0, self.config.max_generated_question_length - tf.shape(predictions)[1]))
             )
@@ -116,6 +184,13 @@ class RepeatQTrainer:
         return bleu_score
 
     def _supervised_step(self, features, target, loss_fc=tf.keras.losses.SparseCategoricalCrossentropy(reduction=tf.keras.losses.Reduction.NONE)):
+        if self.teacher is not None:
+            return self._distillation_step(features, target)
+        # The output distributions over a shortlist or sampled words can't be stored for the loss below, as their
+        # size varies
+        if self.config.per_step_loss or self.config.sampled_softmax_size > 0 or \
+                (self.config.shortlist_size > 0 and self.config.shortlist_in_training):
+            return self._per_step_supervised_step(features, target)
         with tf.GradientTape() as tape:
             predictions, pointer_softmax = self.model.get_actions(features, target=target, training=True)
             tf.py_function(self._debug_output, inp=(
@@ -124,27 +199,79 @@ class RepeatQTrainer:
                 target[0],
                 features["facts"][0]
             ), Tout=tf.int32)
-            # Sets loss weights to 0 for padding tokens
-            is_not_padding = tf.not_equal(target, 0)
-            weights = tf.cast(is_not_padding, dtype=tf.float32, name="seq_loss_mask")
-            # Sets loss weights to 0.25 for base question tokens (to hopefully encourage diversification)
-            # weights = tf.where(
-            #     tf.logical_and(features["from_base_question"], is_not_padding),
-            #     0.25 * tf.ones_like(weights),
-            #     weights
-            # )
-            # We need to slightly modify the targets so that the words that come from the base question are offset
-            # by voc_size, as the logits are the concatenation of the vocabulary logits with the logits for the
-            # base question (if words are being copied from there)
+            loss = self._pointer_loss(features, target, pointer_softmax, loss_fc)
+
+        return loss, tape
+
+    def _pointer_loss(self, features, target, pointer_softmax, loss_fc):
+        # Sets loss weights to 0 for padding tokens
+        is_not_padding = tf.not_equal(target, 0)
+        weights = tf.cast(is_not_padding, dtype=tf.float32, name="seq_loss_mask")
+        # Sets loss weights to 0.25 for base question tokens (to hopefully encourage diversification)
+        # weights = tf.where(
+        #     tf.logical_and(features["from_base_question"], is_not_padding),
+        #     0.25 * tf.ones_like(weights),
+        #     weights
+        # )
+        # We need to slightly modify the targets so that the words that come from the base question are offset
+        # by voc_size, as the logits are the concatenation of the vocabulary logits with the logits for the
+        # base question (if words are being copied from there)
+        if self.config.fused_output_head:
+            # Copy probabilities are already merged onto the vocabulary ids
+            modified_targets = target
+        else:
             copied = tf.not_equal(features["target_copy_indicator"], -1, name="copied_tokens")
             modified_targets = tf.where(copied, len(self.vocabulary) + features["target_copy_indicator"], target)
-            num_classes = pointer_softmax.get_shape()[-1]
-            flattened_targets = tf.reshape(modified_targets, (-1,))
-            flattened_probs = tf.reshape(pointer_softmax, (-1, num_classes))
-            flattened_weights = tf.reshape(weights, (-1,))
-            losses = loss_fc(flattened_targets, flattened_probs)
-            loss = tf.reduce_sum(flattened_weights * losses, axis=-1) / tf.reduce_sum(flattened_weights)
+        num_classes = pointer_softmax.get_shape()[-1]
+        flattened_targets = tf.reshape(modified_targets, (-1,))
+        flattened_probs = tf.reshape(pointer_softmax, (-1, num_classes))
+        flattened_weights = tf.reshape(weights, (-1,))
+        losses = loss_fc(flattened_targets, flattened_probs)
+        return tf.reduce_sum(flattened_weights * losses, axis=-1) / tf.reduce_sum(flattened_weights)
 
+    def _per_step_supervised_step(self, features, target):
+        """
+        Same loss as `_supervised_step`, but computed step by step inside the decoding loop so that the output
+        distributions of every step are never stored.
+        """
+        with tf.GradientTape() as tape:
+            predictions, loss = self.model.get_actions(features, target=target, training=True, compute_loss=True)
+            tf.py_function(self._debug_output, inp=(
+                predictions[0],
+                features["base_question"][0],
+                target[0],
+                features["facts"][0]
+            ), Tout=tf.int32)
+        return loss, tape
+
+    def _distillation_step(self, features, target, loss_fc=tf.keras.losses.SparseCategoricalCrossentropy(reduction=tf.keras.losses.Reduction.NONE)):
+        """
+        Distillation loss of the student (this trainer's model): a mix of the cross-entropy with the labels and with
+        the teacher's output distributions on the teacher-forced labels, plus the cross-entropy of the teacher's beam
+        search outputs (sequence-level distillation).
+        """
+        _, teacher_distributions = self.teacher.get_actions(features, target=target, training=True, dropout=False)
+        teacher_beams = self.teacher.beam_search(features, beam_search_size=self.config.training_beam_search_size)
+        beam_features = {
+            **features,
+            "target_copy_indicator": copy_indicators(teacher_beams, features["base_question"], features["facts"])
+        }
+        soft_weight, beam_weight = self.config.distillation_soft_weight, self.config.distillation_beam_weight
+        with tf.GradientTape() as tape:
+            predictions, pointer_softmax = self.model.get_actions(features, target=target, training=True)
+            loss = (1.0 - soft_weight) * self._pointer_loss(features, target, pointer_softmax, loss_fc) + \
+                soft_weight * soft_cross_entropy(teacher_distributions, pointer_softmax, target)
+            if beam_weight > 0:
+                _, beam_loss = self.model.get_actions(
+                    beam_features, target=teacher_beams, training=True, compute_loss=True
+                )
+                loss += beam_weight * beam_loss
+            tf.py_function(self._debug_output, inp=(
+                predictions[0],
+                features["base_question"][0],
+                target[0],
+                features["facts"][0]
+            ), Tout=tf.int32)
         return loss, tape
 
     def _reinforce_step(self, features, targets, environment):
@@ -1,8 +1,9 @@
 import argparse
+import asyncio
 import json
 import logging
 import os
-from logging import info
+from logging import info, warning
 from typing import Dict, List
 import tensorflow as tf
 import numpy as np
@@ -10,17 +11,54 @@ from tqdm import tqdm
 
 from data_processing.class_defs import RepeatQExample
 from data_processing.repeat_q_dataset import RepeatQDataset
-from data_processing.utils import remove_adjacent_duplicate_grams
 from defs import UNKNOWN_TOKEN, REPEAT_Q_RAW_DATASETS, GLOVE_PATH, PAD_TOKEN, \
     REPEAT_Q_EMBEDDINGS_FILENAME, REPEAT_Q_VOCABULARY_FILENAME, REPEAT_Q_DATA_DIR, EOS_TOKEN, \
     REPEAT_Q_TRAIN_CHECKPOINTS_DIR, REPEAT_Q_FEATURE_VOCABULARY_FILENAME, \
     REPEAT_Q_PREDS_OUTPUT_DIR, REPEAT_Q_SQUAD_DATA_DIR
+from model.RepeatQ.length_budget import fit_length_budget, length_budget_report, save_length_budget, \
+    load_length_budget
+from model.RepeatQ.shortlist import fit_candidate_table, shortlist_coverage, save_candidate_table
+from model.RepeatQ.continuous_batching import ContinuousBatchingScheduler
+from model.RepeatQ.benchmark import decode_dataset, corpus_scores, format_report, resident_memory
+from model.RepeatQ.quantization import export_quantized, load_quantized, quantized_model_path, float_model_size
+from model.RepeatQ.encoder_cache import EncoderCache
+from model.RepeatQ.export import RepeatQServingModule
+from model.RepeatQ.fact_store import FactEncodingStore
+from model.RepeatQ.load_test import run_load_test, load_requests
 from model.RepeatQ.model import RepeatQ
 from model.RepeatQ.model_config import ModelConfiguration
+from model.RepeatQ.pipeline import RawTextPipeline
+from model.RepeatQ.prediction_cache import PredictionCache, checkpoint_hash, decoding_settings, example_input_key, \
+    feature_matrix
+from model.RepeatQ.scoring import score_candidates, loss_parity
+from model.RepeatQ.server import RequestEncoder, RewriteServer, DEFAULT_LENGTH_BUCKETS
 from model.RepeatQ.trainer import RepeatQTrainer
+from model.RepeatQ.tracing import bucket_length, pad_to_length, remap_copy_indicators, batch_sizes, with_batch_size, \
+    decoding_warm_up, TRACES
 
 
 def make_tf_dataset(examples: List[RepeatQExample], config, shuffle=True, drop_remainder=True, is_training=True):
+    # Examples are padded to the lengths of the dataset, which are rounded up to the shape buckets if any so that
+    # datasets share the shapes of the traced functions
+    question_length, target_length = len(examples[0].base_question), len(examples[0].rephrased_question)
+    fact_length = np.shape(examples[0].facts)[1]
+    bucketed_question_length = bucket_length(question_length, config.shape_buckets)
+    bucketed_fact_length = bucket_length(fact_length, config.shape_buckets)
+    bucketed_target_length = bucket_length(target_length, config.shape_buckets)
+
+    def _bucketed_example(example: RepeatQExample):
+        if len(config.shape_buckets) == 0:
+            return example.facts, example.base_question, example.target_question_copy_indicator, \
+                   example.rephrased_question
+        copy_indicators = remap_copy_indicators(
+            example.target_question_copy_indicator, question_length, fact_length, bucketed_question_length,
+            bucketed_fact_length
+        )
+        return pad_to_length(example.facts, bucketed_fact_length), \
+            pad_to_length(example.base_question, bucketed_question_length), \
+            pad_to_length(copy_indicators, bucketed_target_length, value=-1), \
+            pad_to_length(example.rephrased_question, bucketed_target_length)
+
     def _gen(synth_dataset):
         def _gen_ds():
             for example in examples:
@@ -32,9 +70,8 @@ def make_tf_dataset(examples: List[RepeatQExample], config, shuffle=True, drop_r
                 # For performance assessment, we only use organic data
                 if not is_training and example.is_synthetic_data:
                     continue
-                facts = example.facts
+                facts, base_question, copy_indicators, target = _bucketed_example(example)
                 f_features = example.facts_features
-                base_question = example.base_question
                 q_features = example.base_question_features
                 if use_pos or use_ner:
                     f_features = [[tf.cast(feature[:tf.shape(facts)[1]], dtype=tf.float32)
@@ -64,10 +101,10 @@ def make_tf_dataset(examples: List[RepeatQExample], config, shuffle=True, drop_r
                           "facts_features": tf.cast(f_features, dtype=tf.float32),
                           "base_question": base_question,
                           "base_question_features": tf.cast(q_features, dtype=tf.float32),
-                          "target_copy_indicator": example.target_question_copy_indicator,
+                          "target_copy_indicator": copy_indicators,
                           "from_base_question": example.is_from_base_question,
                           "is_synthetic": example.is_synthetic_data
-                }, example.rephrased_question
+                }, target
 
         return _gen_ds
 
@@ -83,8 +120,22 @@ def make_tf_dataset(examples: List[RepeatQExample], config, shuffle=True, drop_r
         }, tf.int32
     )
 
-    ds_synth = tf.data.Dataset.from_generator(_gen(True), output_types=output_types)
-    ds_org = tf.data.Dataset.from_generator(_gen(False), output_types=output_types)
+    # Static shapes let the batches' specs be used as input signatures
+    nb_facts, nb_features = np.shape(examples[0].facts)[0], 2 if use_pos or use_ner else 0
+    output_shapes = (
+        {
+            "facts": (nb_facts, bucketed_fact_length),
+            "facts_features": (nb_facts, bucketed_fact_length, nb_features),
+            "base_question": (bucketed_question_length,),
+            "base_question_features": (bucketed_question_length, nb_features),
+            "target_copy_indicator": (bucketed_target_length,),
+            "from_base_question": np.shape(examples[0].is_from_base_question),
+            "is_synthetic": ()
+        }, (bucketed_target_length,)
+    )
+
+    ds_synth = tf.data.Dataset.from_generator(_gen(True), output_types=output_types, output_shapes=output_shapes)
+    ds_org = tf.data.Dataset.from_generator(_gen(False), output_types=output_types, output_shapes=output_shapes)
 
     # For mixed data, we simply mix the synthetic and organic datasets together
     if config.mixed_data:
@@ -111,15 +162,7 @@ def get_data(data_dir, vocabulary, feature_vocabulary, data_limit, config: Model
     info("Preparing dataset...")
     datasets = {}
     for mode in data_modes:
-        dataset = RepeatQDataset(
-            f"{data_dir}/{mode}.data.json",
-            vocabulary=vocabulary,
-            feature_vocab=feature_vocabulary,
-            data_limit=data_limit,
-            use_ner_features=use_ner,
-            use_pos_features=use_pos,
-            reduced_ner_indicators=config.reduced_ner_indicators
-        ).get_dataset()
+        dataset = get_examples(data_dir, vocabulary, feature_vocabulary, data_limit, config, mode)
         datasets[mode] = make_tf_dataset(
             examples=dataset,
             shuffle=mode != "test",
@@ -131,6 +174,40 @@ def get_data(data_dir, vocabulary, feature_vocabulary, data_limit, config: Model
     return datasets
 
 
+def get_examples(data_dir, vocabulary, feature_vocabulary, data_limit, config: ModelConfiguration, mode):
+    return RepeatQDataset(
+        f"{data_dir}/{mode}.data.json",
+        vocabulary=vocabulary,
+        feature_vocab=feature_vocabulary,
+        data_limit=data_limit,
+        use_ner_features=use_ner,
+        use_pos_features=use_pos,
+        reduced_ner_indicators=config.reduced_ner_indicators
+    ).get_dataset()
+
+
+def deduplicate_examples(examples: List[RepeatQExample]):
+    """
+    Examples sharing their inputs (base question, facts and their features) only differ by their target, so they get
+    the same prediction.
+    :return: The examples with distinct inputs, in order of first occurrence, and the index of each example's inputs
+    among them.
+    """
+    unique_examples, unique_indices, inverse = [], {}, []
+    for example in examples:
+        key = (
+            np.asarray(example.base_question).tobytes(),
+            np.asarray(example.facts).tobytes(),
+            repr(example.base_question_features),
+            repr(example.facts_features)
+        )
+        if key not in unique_indices:
+            unique_indices[key] = len(unique_examples)
+            unique_examples.append(example)
+        inverse.append(unique_indices[key])
+    return unique_examples, inverse
+
+
 def build_vocabulary(vocabulary_path):
     token_to_id = {}
     with open(vocabulary_path, mode='r') as vocab_file:
@@ -155,7 +232,23 @@ def train(args):
         .with_mixed_data(args.mixed_data) \
         .with_reduced_ner_indicators(args.reduced_ner_indicators)\
         .with_question_encodings(not args.no_base_question_encodings)\
-        .with_glove_embeddings(not args.no_glove)
+        .with_glove_embeddings(not args.no_glove)\
+        .with_fused_output_head(args.fused_output_head)\
+        .with_per_step_loss(args.per_step_loss)\
+        .with_precomputed_teacher_forcing(args.precomputed_teacher_forcing)\
+        .with_shortlist_size(args.shortlist_size)\
+        .with_shortlist_in_training(args.shortlist_in_training)\
+        .with_shortlist_candidates(args.shortlist_candidates)\
+        .with_sampled_softmax_size(args.sampled_softmax_size)\
+        .with_mixed_precision(args.mixed_precision)\
+        .with_model_sizes(**model_sizes(args))\
+        .with_distillation_soft_weight(args.distillation_soft_weight)\
+        .with_distillation_beam_weight(args.distillation_beam_weight)\
+        .with_pruning_epochs(args.pruning_epochs)\
+        .with_pruning_sparsity(args.pruning_sparsity)\
+        .with_pruning_block_size(args.pruning_block_size)\
+        .with_tied_output_embedding(args.tied_output_embedding)\
+        .with_shape_buckets(args.shape_buckets)
 
     tf.print(str(config))
     if args.learning_rate is not None:
@@ -166,21 +259,416 @@ def train(args):
     feature_vocabulary = build_vocabulary(config.feature_vocabulary_path)
     data = get_data(config.data_dir, vocabulary, feature_vocabulary, args.data_limit, config)
     training_data, dev_data, test_data = data["train"], data["dev"], data["test"]
+    teacher = None
+    if args.teacher_checkpoint_name is not None:
+        # The teacher's sizes and layers are the ones it was trained with, not the student's
+        teacher_config = ModelConfiguration.new() \
+            .with_data_dir(config.data_dir) \
+            .with_architecture_of(f"{REPEAT_Q_TRAIN_CHECKPOINTS_DIR}/{args.teacher_checkpoint_name}") \
+            .with_restore_supervised_checkpoint() \
+            .with_supervised_model_checkpoint_path(args.teacher_checkpoint_name)
+        teacher = RepeatQ(vocabulary, teacher_config, nb_pos_tags=len(feature_vocabulary),
+                          nb_bio_tags=len(feature_vocabulary))
     # Overshooting pos and bio tags for simplicity
     model = RepeatQ(vocabulary, config, nb_pos_tags=len(feature_vocabulary), nb_bio_tags=len(feature_vocabulary))
-    trainer = RepeatQTrainer(config, model, training_data, dev_data, vocabulary)
+    trainer = RepeatQTrainer(config, model, training_data, dev_data, vocabulary, teacher=teacher)
+    trainer.warm_up()
     trainer.train()
 
 
-def translate(model_dir, args, prediction_file_name, with_stats=False):
+def model_sizes(args):
+    return {
+        "fact_encoder_hidden_size": args.fact_encoder_hidden_size,
+        "decoder_hidden_size": args.decoder_hidden_size,
+        "attention_depth": args.attention_depth,
+        "decoder_readout_size": args.decoder_readout_size,
+        "embedding_size": args.embedding_size
+    }
+
+
+def length_budget(args):
+    """
+    Fits the per-example decoding length budget on the training set, saves it next to the vocabulary and reports
+    how often it would truncate the dev set's targets.
+    """
+    config = ModelConfiguration.new() \
+        .with_data_dir(f"{REPEAT_Q_DATA_DIR}/{args.ds_name}") \
+        .with_pos_features(use_pos) \
+        .with_ner_features(use_ner) \
+        .with_reduced_ner_indicators(args.reduced_ner_indicators)
+    vocabulary = build_vocabulary(config.vocabulary_path)
+    feature_vocabulary = build_vocabulary(config.feature_vocabulary_path)
+    train_examples = get_examples(config.data_dir, vocabulary, feature_vocabulary, args.data_limit, config, "train")
+    dev_examples = get_examples(config.data_dir, vocabulary, feature_vocabulary, -1, config, "dev")
+    # Only organic data is used for performance assessment
+    dev_examples = [ex for ex in dev_examples if not ex.is_synthetic_data]
+
+    coefficients = fit_length_budget(train_examples, mode=args.length_budget_mode,
+                                     coverage=args.length_budget_coverage)
+    truncation_rate, mean_budget = length_budget_report(
+        dev_examples, coefficients, config.max_generated_question_length
+    )
+    info(f"Length budget ({args.length_budget_mode}): question coefficient {coefficients[0]:.3f}, fact coefficient "
+         f"{coefficients[1]:.3f}, intercept {coefficients[2]:.3f}")
+    info(f"Dev set: {100 * truncation_rate:.2f}% of the targets are truncated by the budget, average budget of "
+         f"{mean_budget:.1f} steps (instead of {config.max_generated_question_length}).")
+    save_length_budget(config.length_budget_path, coefficients)
+
+
+def shortlist(args):
+    """
+    Learns the shortlist candidates of every word on the training set, saves them next to the vocabulary and reports
+    the share of the dev set's target tokens the shortlist can't generate, with and without candidates.
+    """
+    config = ModelConfiguration.new() \
+        .with_data_dir(f"{REPEAT_Q_DATA_DIR}/{args.ds_name}") \
+        .with_pos_features(use_pos) \
+        .with_ner_features(use_ner) \
+        .with_reduced_ner_indicators(args.reduced_ner_indicators)
+    vocabulary = build_vocabulary(config.vocabulary_path)
+    feature_vocabulary = build_vocabulary(config.feature_vocabulary_path)
+    train_examples = get_examples(config.data_dir, vocabulary, feature_vocabulary, args.data_limit, config, "train")
+    dev_examples = get_examples(config.data_dir, vocabulary, feature_vocabulary, -1, config, "dev")
+    # Only organic data is used for performance assessment
+    dev_examples = [ex for ex in dev_examples if not ex.is_synthetic_data]
+
+    candidate_table = fit_candidate_table(train_examples, len(vocabulary), args.shortlist_nb_candidates)
+    for name, table in (("without candidates", None), ("with candidates", candidate_table)):
+        token_coverage, example_coverage = shortlist_coverage(dev_examples, args.shortlist_size, table)
+        info(f"Shortlist of the {args.shortlist_size} most frequent words {name}: {100 * (1 - token_coverage):.2f}% "
+             f"of the dev target tokens are lost, {100 * example_coverage:.2f}% of the targets are fully covered.")
+    save_candidate_table(config.shortlist_candidates_path, candidate_table)
+
+
+def translation_config(args, batch_size=32, with_model_sizes=True) -> ModelConfiguration:
     config = ModelConfiguration\
         .new()\
         .with_data_dir(f"{REPEAT_Q_DATA_DIR}/{args.ds_name}") \
-        .with_batch_size(32 if args.beam_search_size > 1 and not with_stats else 1)\
+        .with_batch_size(batch_size)\
         .with_pos_features(use_pos)\
         .with_ner_features(use_ner)\
         .with_reduced_ner_indicators(args.reduced_ner_indicators)\
-        .with_question_encodings(not args.no_base_question_encodings)
+        .with_question_encodings(not args.no_base_question_encodings)\
+        .with_no_repeat_ngram_size(args.no_repeat_ngram_size)\
+        .with_max_adjacent_duplicate_size(args.max_adjacent_duplicate_size)\
+        .with_fused_output_head(args.fused_output_head)\
+        .with_shortlist_size(args.shortlist_size)\
+        .with_shortlist_candidates(args.shortlist_candidates)\
+        .with_mixed_precision(args.mixed_precision)\
+        .with_tied_output_embedding(args.tied_output_embedding)\
+        .with_shape_buckets(args.shape_buckets)
+    if with_model_sizes:
+        config = config.with_model_sizes(**model_sizes(args))
+    if args.length_budget:
+        config = config.with_length_budget(load_length_budget(config.length_budget_path))
+    return config
+
+
+def precision_report(model_dir, args):
+    """
+    Builds the float32 and the mixed bfloat16 models from the same checkpoint, greedily decodes the organic dev set
+    with both and reports their BLEU, ROUGE-L and throughput.
+    """
+    rows = {}
+    for name, mixed_precision in (("float32", False), ("mixed_bfloat16", True)):
+        config = translation_config(args).with_mixed_precision(mixed_precision)
+        vocabulary = build_vocabulary(config.vocabulary_path)
+        feature_voc = build_vocabulary(config.feature_vocabulary_path)
+        data = get_data(config.data_dir, vocabulary, feature_voc, -1, config, data_modes=["dev"])["dev"]
+        model = RepeatQ(vocabulary, config, nb_bio_tags=len(feature_voc), nb_pos_tags=len(feature_voc))
+        model.load_weights(model_dir)
+        predictions, references, throughput = decode_dataset(model.greedy_decode, data["organic"])
+        rows[name] = {**corpus_scores(predictions, references), "examples/s": throughput}
+    info(f"Precision parity on the dev set (greedy decoding):\n{format_report(rows)}")
+
+
+def quantization_report(model_dir, args):
+    """
+    Exports the checkpoint as int8 TFLite models next to it, then greedily decodes the organic test set with the float
+    model and with the TFLite interpreters running the int8 weights. Reports their BLEU, ROUGE-L, latency, size of the
+    weights and growth of the resident memory from loading the model to the end of decoding.
+    """
+    config = translation_config(args)
+    vocabulary = build_vocabulary(config.vocabulary_path)
+    feature_voc = build_vocabulary(config.feature_vocabulary_path)
+    data = get_data(config.data_dir, vocabulary, feature_voc, -1, config, data_modes=["test"])["test"]["organic"]
+    features, _ = next(iter(data))
+
+    rows = {}
+    memory = resident_memory()
+    float_model = RepeatQ(vocabulary, config, nb_bio_tags=len(feature_voc), nb_pos_tags=len(feature_voc))
+    float_model.load_weights(model_dir)
+    predictions, references, throughput = decode_dataset(float_model.greedy_decode, data)
+    rows["float32"] = {
+        **corpus_scores(predictions, references),
+        "ms/batch": 1000 * config.batch_size / throughput,
+        "size (MB)": float_model_size(float_model) / 2 ** 20,
+        "RSS (MB)": (resident_memory() - memory) / 2 ** 20
+    }
+
+    quantized_size = export_quantized(float_model, features, quantized_model_path(model_dir))
+    memory = resident_memory()
+    quantized_decoder = load_quantized(quantized_model_path(model_dir), vocabulary["?"])
+    predictions, references, throughput = decode_dataset(quantized_decoder.decode, data)
+    rows["int8 (TFLite)"] = {
+        **corpus_scores(predictions, references),
+        "ms/batch": 1000 * config.batch_size / throughput,
+        "size (MB)": quantized_size / 2 ** 20,
+        "RSS (MB)": (resident_memory() - memory) / 2 ** 20
+    }
+    info(f"Float32 and int8 greedy decoding on the test set:\n{format_report(rows)}")
+
+
+def distillation_report(teacher_dir, student_dir, args):
+    """
+    Decodes the organic test set with the teacher (configuration saved along with it) and the student (sizes given as
+    arguments) models, greedily and with beam search if -beam_search_size is above 1, and reports their quality and
+    latency.
+    """
+    rows = {}
+    for name, model_dir, is_student in (("teacher", teacher_dir, False), ("student", student_dir, True)):
+        config = translation_config(args, with_model_sizes=is_student)
+        if not is_student:
+            config = config.with_architecture_of(model_dir)
+        vocabulary = build_vocabulary(config.vocabulary_path)
+        feature_voc = build_vocabulary(config.feature_vocabulary_path)
+        data = get_data(config.data_dir, vocabulary, feature_voc, -1, config, data_modes=["test"])["test"]["organic"]
+        model = RepeatQ(vocabulary, config, nb_bio_tags=len(feature_voc), nb_pos_tags=len(feature_voc))
+        model.load_weights(model_dir)
+        decoders = {"greedy": model.greedy_decode}
+        if args.beam_search_size > 1:
+            decoders[f"beam {args.beam_search_size}"] = \
+                lambda f, _model=model: _model.decode(f, beam_search_size=args.beam_search_size)
+        for decoding, decode in decoders.items():
+            predictions, references, throughput = decode_dataset(decode, data)
+            rows[f"{name} {decoding}"] = {
+                **corpus_scores(predictions, references),
+                "ms/example": 1000 / throughput,
+                "params (M)": model.count_params() / 1e6
+            }
+    info(f"Teacher and student on the test set:\n{format_report(rows)}")
+
+
+def export(model_dir, args):
+    """
+    Exports the checkpoint as a SavedModel with a greedy and a beam search signature for each -export_beam_sizes, the
+    vocabularies being saved as assets.
+    The signatures' input shapes are the ones of the organic test set batches.
+    """
+    export_dir = args.export_dir or f"{model_dir}_saved_model"
+    config = translation_config(args)
+    vocabulary = build_vocabulary(config.vocabulary_path)
+    feature_voc = build_vocabulary(config.feature_vocabulary_path)
+    data = get_data(config.data_dir, vocabulary, feature_voc, -1, config, data_modes=["test"])["test"]["organic"]
+    features, _ = next(iter(data))
+    model = RepeatQ(vocabulary, config, nb_bio_tags=len(feature_voc), nb_pos_tags=len(feature_voc))
+    model.load_weights(model_dir)
+    features_shape = [
+        (config.batch_size, *features[name].get_shape()[1:])
+        for name in ("base_question", "base_question_features", "facts", "facts_features")
+    ]
+    module = RepeatQServingModule(model, config, features_shape, beam_sizes=args.export_beam_sizes)
+    signatures = module.signatures()
+    tf.saved_model.save(module, export_dir, signatures=signatures)
+    info(f"Model exported to '{export_dir}' with signatures {sorted(signatures)}.")
+
+
+def prediction_cache(model_dir, config, args, int8=False):
+    """
+    :return: The on-disk prediction cache of -prediction_cache for this checkpoint and decoding settings, None without
+    this argument.
+    """
+    if args.prediction_cache is None:
+        return None
+    return PredictionCache(
+        args.prediction_cache,
+        checkpoint_hash(model_dir, int8=int8),
+        decoding_settings(config, args.beam_search_size, int8=int8,
+                          speculative_draft_length=args.speculative_draft_length),
+        max_entries=args.prediction_cache_size
+    )
+
+
+def use_encoder_cache(model, model_dir, args):
+    """
+    Caches the encoder outputs of greedy inference if -encoder_cache_size is set, and gathers the fact encodings from
+    the store of -fact_store if set. Both only apply to the decoding functions running eagerly (greedy, speculative and
+    continuous batching decoding): beam search is traced as a whole, so neither is used with -beam_search_size above 1.
+    """
+    if args.beam_search_size > 1:
+        if args.encoder_cache_size > 0 or args.fact_store is not None:
+            warning("The encoder cache and the fact encoding store are only used by greedy decoding, not by beam "
+                    "search.")
+        return
+    fact_store = None if args.fact_store is None else FactEncodingStore(args.fact_store, model_dir)
+    if args.encoder_cache_size > 0 or fact_store is not None:
+        model.encoder_cache = EncoderCache(args.encoder_cache_size, args.encoder_cache_size, fact_store=fact_store)
+
+
+def encode_facts(model_dir, args):
+    """
+    Encodes the distinct facts of every split of the dataset once and writes their encodings to the store of
+    -fact_store, used by inference instead of running the fact encoder.
+    """
+    config = translation_config(args)
+    vocabulary = build_vocabulary(config.vocabulary_path)
+    feature_voc = build_vocabulary(config.feature_vocabulary_path)
+    model = RepeatQ(vocabulary, config, nb_bio_tags=len(feature_voc), nb_pos_tags=len(feature_voc))
+    model.load_weights(model_dir)
+    nb_features = 2 if use_pos or use_ner else 0
+    facts, facts_features = [], []
+    for mode in ("train", "dev", "test"):
+        for example in get_examples(f"{REPEAT_Q_DATA_DIR}/{args.ds_name}", vocabulary, feature_voc, -1, config, mode):
+            for fact, features in zip(example.facts, example.facts_features):
+                facts.append(fact)
+                facts_features.append(feature_matrix(features, len(fact), nb_features))
+    FactEncodingStore.write(args.fact_store, model, model_dir, facts, facts_features,
+                            float16=args.fact_store_float16)
+
+
+def serve(model_dir, args):
+    """
+    Loads the checkpoint once and serves rewrite requests over HTTP (or a unix socket) until interrupted, decoding
+    the requests received together in micro-batches.
+    """
+    config = translation_config(args, batch_size=args.max_batch_size)
+    vocabulary = build_vocabulary(config.vocabulary_path)
+    feature_voc = build_vocabulary(config.feature_vocabulary_path)
+    model = RepeatQ(vocabulary, config, nb_bio_tags=len(feature_voc), nb_pos_tags=len(feature_voc))
+    model.load_weights(model_dir)
+    use_encoder_cache(model, model_dir, args)
+    encoder = RequestEncoder(vocabulary, feature_voc, use_pos, use_ner, args.reduced_ner_indicators)
+    scheduler = None
+    if args.continuous_batching:
+        scheduler = ContinuousBatchingScheduler(
+            model, args.max_batch_size, args.slot_question_length, args.slot_nb_facts, args.slot_fact_length
+        )
+    pipeline = None
+    if args.raw_text:
+        pipeline = RawTextPipeline(model, encoder, fact_cache_size=args.fact_cache_size)
+    server = RewriteServer(
+        model,
+        encoder,
+        beam_search_size=args.beam_search_size,
+        max_batch_size=args.max_batch_size,
+        max_wait_ms=args.max_batch_wait_ms,
+        timeout_ms=args.request_timeout_ms,
+        length_buckets=config.shape_buckets or DEFAULT_LENGTH_BUCKETS,
+        scheduler=scheduler,
+        pipeline=pipeline,
+        prediction_cache=prediction_cache(model_dir, config, args)
+    )
+    loop = asyncio.get_event_loop()
+    serving = asyncio.ensure_future(server.serve(args.host, args.port, args.unix_socket))
+    try:
+        loop.run_until_complete(serving)
+    except KeyboardInterrupt:
+        # Cancelling the server runs its shutdown, which logs the caches' statistics
+        serving.cancel()
+        loop.run_until_complete(asyncio.gather(serving, return_exceptions=True))
+
+
+def rewrite(model_dir, args, prediction_file_name):
+    """
+    Rewrites the raw questions of -rewrite_input, a JSON list of {"question": ..., "answers": [...], "facts": [...]}
+    objects, and writes the rewrites one per line.
+    """
+    config = translation_config(args)
+    vocabulary = build_vocabulary(config.vocabulary_path)
+    feature_voc = build_vocabulary(config.feature_vocabulary_path)
+    model = RepeatQ(vocabulary, config, nb_bio_tags=len(feature_voc), nb_pos_tags=len(feature_voc))
+    model.load_weights(model_dir)
+    use_encoder_cache(model, model_dir, args)
+    encoder = RequestEncoder(vocabulary, feature_voc, use_pos, use_ner, args.reduced_ner_indicators)
+    pipeline = RawTextPipeline(
+        model,
+        encoder,
+        fact_cache_size=args.fact_cache_size,
+        beam_search_size=args.beam_search_size,
+        batch_size=config.batch_size,
+        length_buckets=config.shape_buckets or DEFAULT_LENGTH_BUCKETS,
+        prediction_cache=prediction_cache(model_dir, config, args)
+    )
+    with open(args.rewrite_input, mode='r') as f:
+        inputs = json.load(f)
+    rewrites = pipeline.rewrite(
+        [example["question"] for example in inputs],
+        [example.get("answers", []) for example in inputs],
+        [example["facts"] for example in inputs]
+    )
+    pipeline.log_stats()
+    if model.encoder_cache is not None:
+        model.encoder_cache.log_stats()
+    save_path = f"{REPEAT_Q_PREDS_OUTPUT_DIR}/{prediction_file_name}_rewrites.txt"
+    os.makedirs(os.path.dirname(save_path), exist_ok=True)
+    with open(save_path, mode='w') as f:
+        f.writelines(f"{question}\n" for question in rewrites)
+    info(f"Rewrites saved to '{save_path}'.")
+
+
+def score(model_dir, args, prediction_file_name):
+    """
+    Scores candidate rewrites with a teacher-forced pass of the model instead of decoding. -score_input is a JSON list
+    of requests (see `RequestEncoder`) with their "candidates", without it the targets of the test set are scored.
+    The per-token and total log-probabilities of the candidates of each request are written one request per line.
+    """
+    config = translation_config(args)
+    vocabulary = build_vocabulary(config.vocabulary_path)
+    feature_voc = build_vocabulary(config.feature_vocabulary_path)
+    model = RepeatQ(vocabulary, config, nb_bio_tags=len(feature_voc), nb_pos_tags=len(feature_voc))
+    model.load_weights(model_dir)
+    encoder = RequestEncoder(vocabulary, feature_voc, use_pos, use_ner, args.reduced_ner_indicators)
+    if args.score_input is not None:
+        with open(args.score_input, mode='r') as f:
+            inputs = json.load(f)
+        candidates = [example["candidates"] for example in inputs]
+    else:
+        inputs = load_requests(f"{REPEAT_Q_DATA_DIR}/{args.ds_name}/test.data.json")
+        candidates = [[example["target"]] for example in inputs]
+        # The scores of the test targets must agree with the training loss on a batch of the test set
+        examples = get_examples(f"{REPEAT_Q_DATA_DIR}/{args.ds_name}", vocabulary, feature_voc, -1, config, "test")
+        data = make_tf_dataset(examples, config, shuffle=False, drop_remainder=False, is_training=False)
+        features, target = next(iter(data["organic"]))
+        scored_loss, loss = loss_parity(model, features, target)
+        info(f"Mean negative log-probability of a test batch's targets: {scored_loss:.6f}, training loss: {loss:.6f}.")
+        if not np.isclose(scored_loss, loss, rtol=1e-4):
+            warning("The scores don't match the training loss.")
+    scores = score_candidates(
+        model,
+        encoder,
+        [encoder.encode(example) for example in inputs],
+        candidates,
+        batch_size=config.batch_size,
+        length_buckets=config.shape_buckets or DEFAULT_LENGTH_BUCKETS
+    )
+    save_path = f"{REPEAT_Q_PREDS_OUTPUT_DIR}/{prediction_file_name}_scores.json"
+    os.makedirs(os.path.dirname(save_path), exist_ok=True)
+    with open(save_path, mode='w') as f:
+        for request_candidates, request_scores in zip(candidates, scores):
+            f.write(json.dumps([
+                {"candidate": candidate, "token_log_probs": token_log_probs, "log_prob": log_prob}
+                for candidate, (token_log_probs, log_prob) in zip(request_candidates, request_scores)
+            ]) + "\n")
+    nb_tokens = sum(len(token_log_probs) for request_scores in scores for token_log_probs, _ in request_scores)
+    total = sum(log_prob for request_scores in scores for _, log_prob in request_scores)
+    info(f"Scored {sum(len(c) for c in candidates)} candidates, perplexity {np.exp(-total / max(nb_tokens, 1)):.2f}. "
+         f"Scores saved to '{save_path}'.")
+
+
+def load_test(args):
+    """
+    Sends the examples of the test set as requests to a running server and reports the throughput and latencies.
+    """
+    requests = load_requests(f"{REPEAT_Q_DATA_DIR}/{args.ds_name}/test.data.json")
+    throughput, p50, p99, errors = asyncio.get_event_loop().run_until_complete(run_load_test(
+        requests, args.load_test_requests, args.load_test_concurrency, args.host, args.port, args.unix_socket
+    ))
+    info(f"{args.load_test_requests} requests from {args.load_test_concurrency} concurrent clients: "
+         f"{throughput:.1f} requests/s, p50 latency {p50:.1f} ms, p99 latency {p99:.1f} ms, errors: {errors}.")
+
+
+def translate(model_dir, args, prediction_file_name, with_stats=False):
+    config = translation_config(args, batch_size=32 if not with_stats else 1)
 
     save_path = f"{REPEAT_Q_PREDS_OUTPUT_DIR}/{prediction_file_name}_predictions.txt"
     if not (with_stats or os.path.exists(os.path.dirname(save_path))):
@@ -192,19 +680,46 @@ def translate(model_dir, args, prediction_file_name, with_stats=False):
     vocabulary = build_vocabulary(config.vocabulary_path)
     reverse_voc = _reverse_voc(vocabulary)
     feature_voc = build_vocabulary(config.feature_vocabulary_path)
-    data = get_data(
-        data_dir=f"{REPEAT_Q_DATA_DIR}/{args.ds_name}",
-        vocabulary=vocabulary,
-        feature_vocabulary=feature_voc,
-        data_limit=-1,
-        config=config,
-        data_modes=["test"]
-    )["test"]
-    model = RepeatQ(vocabulary, config, nb_bio_tags=len(feature_voc), nb_pos_tags=len(feature_voc))
-    model.load_weights(model_dir)
+    examples = get_examples(f"{REPEAT_Q_DATA_DIR}/{args.ds_name}", vocabulary, feature_voc, -1, config, "test")
+    # Inputs are decoded once and their predictions fanned out to each of their references
+    examples = [example for example in examples if not example.is_synthetic_data]
+    unique_examples, inverse = deduplicate_examples(examples)
+    cache = None if with_stats else prediction_cache(model_dir, config, args, int8=args.int8)
+    cached = {}
+    if cache is not None:
+        # Only the inputs missing from the cache are decoded
+        keys = [example_input_key(example, 2 if use_pos or use_ner else 0) for example in unique_examples]
+        cached = cache.get_many(keys)
+        decoded_examples = [example for example, key in zip(unique_examples, keys) if key not in cached]
+    else:
+        decoded_examples = unique_examples
+    info(f"Decoding {len(decoded_examples)} distinct inputs for {len(examples)} test examples.")
+    if cache is not None and len(decoded_examples) == 0:
+        write_predictions(save_path, examples, [cached[keys[index]] for index in inverse], reverse_voc)
+        cache.log_stats()
+        return
+    data = make_tf_dataset(decoded_examples, config, shuffle=False, drop_remainder=False, is_training=False)
+    if args.int8:
+        # The int8 TFLite models replace the Keras model, the float weights aren't loaded
+        model = None
+        quantized_decoder = load_quantized(quantized_model_path(model_dir), vocabulary["?"])
+    else:
+        model = RepeatQ(vocabulary, config, nb_bio_tags=len(feature_voc), nb_pos_tags=len(feature_voc))
+        model.load_weights(model_dir)
+        use_encoder_cache(model, model_dir, args)
+    if model is not None and args.beam_search_size > 1:
+        feature_specs, _ = data["organic"].element_spec
+        TRACES.warm_up(decoding_warm_up(
+            model,
+            [with_batch_size(feature_specs, size)
+             for size in batch_sizes(len(decoded_examples), config.batch_size, False)],
+            greedy=False,
+            beam_search_size=args.beam_search_size
+        ))
 
     def to_string(tokens, _reverse_voc=reverse_voc):
-        tokens = tokens.numpy()
+        if isinstance(tokens, tf.Tensor):
+            tokens = tokens.numpy()
         return " ".join([_reverse_voc[t] for t in tokens]).replace(" <blank>", "")
 
     if with_stats:
@@ -213,20 +728,40 @@ def translate(model_dir, args, prediction_file_name, with_stats=False):
             if to_string(feature["base_question"][0]) == "what year was temüjin , who became genghis khan , likely born ?":
                 model.get_actions(feature, None, training=False, show_attention=True)
     else:
-        with open(save_path, mode='w+') as pred_file:
-            for feature, labels in data["organic"]:
-                if args.beam_search_size == 1:
-                    preds, _ = model.get_actions(feature, None, training=False)
-                else:
-                    preds = model.beam_search(feature, beam_search_size=args.beam_search_size)
-                for label, base_question, facts, pred in zip(labels, feature["base_question"], feature["facts"], preds):
-                    translated = remove_adjacent_duplicate_grams(to_string(pred))
-                    tf.print("Base question: ", to_string(base_question))
-                    for fact in facts:
-                        tf.print("Fact: ", to_string(fact))
-                    tf.print("Target: ", to_string(label))
-                    tf.print("Prediction: ", translated, "\n")
-                    pred_file.write(translated + "\n")
+        predictions = []
+        for feature, _ in data["organic"]:
+            if args.int8:
+                preds = quantized_decoder.decode(feature)
+            elif args.beam_search_size == 1 and args.speculative_draft_length > 0:
+                preds = model.speculative_decode(feature, draft_length=args.speculative_draft_length)
+            elif args.beam_search_size == 1:
+                preds = model.greedy_decode(feature)
+            else:
+                preds = model.decode(feature, beam_search_size=args.beam_search_size)
+            predictions += [to_string(pred) for pred in preds]
+        if model is not None and model.encoder_cache is not None:
+            model.encoder_cache.log_stats()
+        if cache is not None:
+            decoded_keys = [key for key in keys if key not in cached]
+            cache.put_many(dict(zip(decoded_keys, predictions)))
+            predictions = iter(predictions)
+            predictions = [cached[key] if key in cached else next(predictions) for key in keys]
+            cache.log_stats()
+        write_predictions(save_path, examples, [predictions[index] for index in inverse], reverse_voc)
+
+
+def write_predictions(save_path, examples: List[RepeatQExample], predictions, reverse_voc):
+    def to_string(tokens):
+        return " ".join([reverse_voc[t] for t in tokens]).replace(" <blank>", "")
+
+    with open(save_path, mode='w+') as pred_file:
+        for example, translated in zip(examples, predictions):
+            tf.print("Base question: ", to_string(example.base_question))
+            for fact in example.facts:
+                tf.print("Fact: ", to_string(fact))
+            tf.print("Target: ", to_string(example.rephrased_question))
+            tf.print("Prediction: ", translated, "\n")
+            pred_file.write(translated + "\n")
 
 
 def create_embedding_matrix(pretrained_path, vocab, pad_token, unk_token):
@@ -361,7 +896,12 @@ if __name__ == '__main__':
     logging.getLogger(__name__).setLevel(logging.NOTSET)
 
     parser = argparse.ArgumentParser()
-    parser.add_argument("action", default="train", type=str, choices=("translate", "preprocess", "train"))
+    parser.add_argument("action", default="train", type=str, choices=("translate", "preprocess", "train",
+                                                                             "length_budget", "shortlist",
+                                                                             "precision_report", "quantize",
+                                                                             "distillation_report", "export",
+                                                                             "serve", "load_test", "rewrite",
+                                                                             "encode_facts", "score"))
     parser.add_argument("-save_data_dir", help="If action is preprocess, base directory where the processed files will "
                                           "be saved.", type=str, required=False, default=REPEAT_Q_DATA_DIR)
     parser.add_argument("-save_model_dir", help="If action is train, name of the directory to save the checkpoints "
@@ -409,6 +949,25 @@ if __name__ == '__main__':
                              "dataset.")
     parser.add_argument("-nb_epochs", type=int, default=20, help="Total number of epochs to train for.", required=False)
     parser.add_argument("-beam_search_size", type=int, default=5, help="Beam search size to use during translation.")
+    parser.add_argument("-no_repeat_ngram_size", type=int, default=0,
+                        help="During translation, prevents the model from generating the same n-gram of this size "
+                             "twice. Default to 0, which disables the constraint.")
+    parser.add_argument("-max_adjacent_duplicate_size", type=int, default=4,
+                        help="During translation, prevents the model from generating an n-gram identical to the one "
+                             "right before it, for every n up to this size. 0 disables the constraint.")
+    parser.add_argument("-speculative_draft_length", type=int, default=0,
+                        help="When translating with a beam search size of 1, verifies drafts of this many tokens "
+                             "copied from the base question and facts in a single decoder pass. Predictions are "
+                             "identical to greedy decoding. Default to 0, which disables speculative decoding.")
+    parser.add_argument("--length_budget", action="store_true",
+                        help="During translation, stops decoding each example at its length budget (computed by the "
+                             "length_budget action) instead of max_generated_question_length steps.")
+    parser.add_argument("-length_budget_mode", type=str, default="linear", choices=("linear", "heuristic"),
+                        help="Used if action is length_budget. 'linear' fits the base question and fact length "
+                             "coefficients on the training set, 'heuristic' uses their sum. The intercept is always "
+                             "fitted to cover -length_budget_coverage of the training targets.")
+    parser.add_argument("-length_budget_coverage", type=float, default=0.99,
+                        help="Used if action is length_budget. Share of training targets the budget should cover.")
     parser.add_argument("-checkpoint_name", type=str, required=False, default=None,
                         help="Name of a checkpoint of the model to resume from. When in translate mode, the model"
                              "will be loaded and directly used to make predictions. When in train or train_rl mode,"
@@ -427,6 +986,141 @@ if __name__ == '__main__':
                              "generated by the encoder RNN network)")
     parser.add_argument("--no_glove", action="store_true", help="Randomly initialize embedding matrix instead of using"
                                                                 " pretrained GloVe embeddings.")
+    parser.add_argument("--fused_output_head", action="store_true",
+                        help="Merges the generation and copy probabilities onto vocabulary ids once per step, and uses "
+                             "this distribution for token selection and for the training loss. Models trained with "
+                             "this flag should also be used with it for translation.")
+    parser.add_argument("--per_step_loss", action="store_true",
+                        help="Computes the training loss step by step while decoding instead of storing the output "
+                             "distributions of every step. Same loss, lower memory usage (allows larger batches).")
+    parser.add_argument("--precomputed_teacher_forcing", action="store_true",
+                        help="During training, embeds the whole shifted target once and projects it through the "
+                             "decoder's LSTM input kernel and U_r with one large matmul instead of one per step.")
+    parser.add_argument("-shortlist_size", type=int, default=0,
+                        help="If positive, restricts the generation vocabulary of each batch to this many most frequent "
+                             "words plus the words of its base questions and facts, and only computes the output "
+                             "projection for these. Used for translation, for training with --shortlist_in_training, "
+                             "and as the number of frequent words if action is shortlist. 0 disables the shortlist.")
+    parser.add_argument("--shortlist_in_training", action="store_true",
+                        help="Also uses the shortlist (extended with the batch's target words) for supervised training.")
+    parser.add_argument("--shortlist_candidates", action="store_true",
+                        help="Adds the candidates of the base question words, learned by the shortlist action, to the "
+                             "shortlist.")
+    parser.add_argument("-shortlist_nb_candidates", type=int, default=20,
+                        help="Used if action is shortlist. Number of candidates learned for each word.")
+    parser.add_argument("-sampled_softmax_size", type=int, default=0,
+                        help="If positive, trains with a sampled softmax over the batch's words and this many negative "
+                             "words sampled by frequency instead of the full vocabulary softmax, so that the training "
+                             "cost doesn't grow with -voc_size. Translation always uses the full softmax.")
+    parser.add_argument("--mixed_precision", action="store_true",
+                        help="Computes in bfloat16 with float32 variables (softmaxes and losses stay in float32). "
+                             "Checkpoints are compatible with float32 models. The precision_report action compares "
+                             "both precisions on the dev set for -checkpoint_name.")
+    parser.add_argument("--int8", action="store_true",
+                        help="Translates greedily with the int8 TFLite models of -checkpoint_name created by the "
+                             "quantize action instead of the float checkpoint. They take batches of the shapes of the "
+                             "test set they were exported with.")
+    parser.add_argument("-fact_encoder_hidden_size", type=int, default=None,
+                        help="Number of units of the fact encoder. Defaults to the model configuration's.")
+    parser.add_argument("-decoder_hidden_size", type=int, default=None,
+                        help="Number of units of the decoder. Defaults to the model configuration's.")
+    parser.add_argument("-attention_depth", type=int, default=None,
+                        help="Depth of the attention layers. Defaults to the model configuration's.")
+    parser.add_argument("-decoder_readout_size", type=int, default=None,
+                        help="Size of the decoder's readout state. Defaults to the model configuration's.")
+    parser.add_argument("-embedding_size", type=int, default=None,
+                        help="Size of the word embeddings, only used with --no_glove. Defaults to the model "
+                             "configuration's.")
+    parser.add_argument("-teacher_checkpoint_name", type=str, default=None,
+                        help="If action is train, trains the model (with the sizes given above) as a student of this "
+                             "checkpoint (built with the configuration saved along with it) by distillation. Also "
+                             "the teacher of the distillation_report action, the student being -checkpoint_name.")
+    parser.add_argument("-distillation_soft_weight", type=float, default=0.5,
+                        help="Weight of the cross-entropy with the teacher's output distributions when distilling, the "
+                             "cross-entropy with the labels getting the rest.")
+    parser.add_argument("-distillation_beam_weight", type=float, default=0.5,
+                        help="Weight of the cross-entropy of the teacher's beam search outputs when distilling.")
+    parser.add_argument("-pruning_epochs", type=int, default=0,
+                        help="Number of pruning-aware fine-tuning epochs after the supervised ones. The sparsity grows "
+                             "gradually up to -pruning_sparsity, and the dev BLEU and speed-up of the compacted model "
+                             "are reported after each epoch. With --save_model, each compacted model is saved, its "
+                             "readout size and attention depth being part of its name (pass them as "
+                             "-decoder_readout_size and -attention_depth to translate with it).")
+    parser.add_argument("-pruning_sparsity", type=float, default=0.5,
+                        help="Share of the readout units, attention units and LSTM kernel blocks pruned at the end of "
+                             "the pruning epochs.")
+    parser.add_argument("-pruning_block_size", type=int, default=4,
+                        help="Number of consecutive input rows of an LSTM kernel column pruned together.")
+    parser.add_argument("--tied_output_embedding", action="store_true",
+                        help="Ties the decoder's output layer to the embedding matrix: the readout is projected into "
+                             "the embedding space and scored against every word embedding, so no separate "
+                             "vocabulary projection is stored. Models trained with this flag should also be used with "
+                             "it for translation.")
+    parser.add_argument("-export_dir", type=str, default=None,
+                        help="If action is export, directory of the SavedModel. Defaults to the checkpoint's path "
+                             "followed by \"_saved_model\".")
+    parser.add_argument("-export_beam_sizes", type=int, nargs="*", default=[5],
+                        help="If action is export, beam sizes to export a beam search signature for.")
+    parser.add_argument("-shape_buckets", type=int, nargs="*", default=[],
+                        help="Lengths the base questions, facts and targets of each dataset are padded up to (the "
+                             "smallest one holding them), so that datasets share a small set of traced shapes. "
+                             "Example: -shape_buckets 16 32 64.")
+    parser.add_argument("-host", type=str, default="127.0.0.1",
+                        help="If action is serve or load_test, host the server listens on.")
+    parser.add_argument("-port", type=int, default=8080,
+                        help="If action is serve or load_test, port the server listens on.")
+    parser.add_argument("-unix_socket", type=str, default=None,
+                        help="If action is serve or load_test, path of a unix socket used instead of -host and -port.")
+    parser.add_argument("-max_batch_size", type=int, default=32,
+                        help="If action is serve, maximum number of requests decoded together.")
+    parser.add_argument("-max_batch_wait_ms", type=float, default=5,
+                        help="If action is serve, maximum time to wait for more requests after the first request of a "
+                             "batch.")
+    parser.add_argument("-request_timeout_ms", type=float, default=1000,
+                        help="If action is serve, deadline of requests which don't give their own \"timeout_ms\".")
+    parser.add_argument("--continuous_batching", action="store_true",
+                        help="If action is serve, decodes greedily over a pool of -max_batch_size decoder slots, "
+                             "admitting new requests into the slots freed by finished questions after every decoder "
+                             "step instead of decoding micro-batches to completion.")
+    parser.add_argument("-slot_question_length", type=int, default=64,
+                        help="With --continuous_batching, maximum base question length of the requests.")
+    parser.add_argument("-slot_nb_facts", type=int, default=8,
+                        help="With --continuous_batching, maximum number of facts of the requests.")
+    parser.add_argument("-slot_fact_length", type=int, default=64,
+                        help="With --continuous_batching, maximum fact length of the requests.")
+    parser.add_argument("--raw_text", action="store_true",
+                        help="If action is serve, also serves raw text requests on /rewrite_text, which are annotated "
+                             "with Stanza.")
+    parser.add_argument("-rewrite_input", type=str, default=None,
+                        help="If action is rewrite, JSON file of the raw questions to rewrite, a list of "
+                             "{\"question\": ..., \"answers\": [...], \"facts\": [...]} objects.")
+    parser.add_argument("-fact_cache_size", type=int, default=10000,
+                        help="If action is rewrite or serve with --raw_text, number of annotated fact sentences kept "
+                             "in memory.")
+    parser.add_argument("-load_test_requests", type=int, default=1000,
+                        help="If action is load_test, number of requests sent.")
+    parser.add_argument("-load_test_concurrency", type=int, default=16,
+                        help="If action is load_test, number of concurrent clients.")
+    parser.add_argument("-prediction_cache", type=str, default=None,
+                        help="Path of an on-disk cache of the predictions of translate, rewrite and serve, keyed by "
+                             "checkpoint, input and decoding settings (disabled by default).")
+    parser.add_argument("-prediction_cache_size", type=int, default=1000000,
+                        help="Maximum number of predictions kept in the prediction cache, the least recently used "
+                             "ones being evicted.")
+    parser.add_argument("-encoder_cache_size", type=int, default=0,
+                        help="Number of base questions and of facts whose encoder outputs are kept in memory by "
+                             "greedy inference (translate, rewrite and serve, not used by beam search), 0 to "
+                             "disable. Greedy serving then uses the eager decoding loop instead of the traced decoding "
+                             "function, which only pays off when most inputs repeat and the encoder is large.")
+    parser.add_argument("-fact_store", type=str, default=None,
+                        help="Directory of the precomputed fact encodings, written by the encode_facts action and "
+                             "read by greedy inference (not by beam search) instead of encoding the facts it "
+                             "contains.")
+    parser.add_argument("--fact_store_float16", action="store_true",
+                        help="Stores the fact encodings in float16.")
+    parser.add_argument("-score_input", type=str, default=None,
+                        help="If action is score, JSON list of requests with the \"candidates\" rewrites to score "
+                             "(the targets of the test set by default).")
     parser.add_argument("-gpu_id", type=str, help="ID of the GPU to use.", default=None)
     parser.add_argument("-prediction_file_name", type=str, required=False, help="Filename for prediction file.")
     args = parser.parse_args()
@@ -446,8 +1140,49 @@ if __name__ == '__main__':
         preprocess(args.preprocess_data_dir, args.save_data_dir, args.ds_name, args.voc_size,
                    args.pretrained_embeddings_path)
         info("Preprocessing completed successfully.")
+    elif args.action == "length_budget":
+        length_budget(args)
+        info("Length budget computed.")
+    elif args.action == "shortlist":
+        shortlist(args)
+        info("Shortlist candidates computed.")
+    elif args.action == "precision_report":
+        assert args.checkpoint_name is not None and args.ds_name is not None
+        precision_report(f"{REPEAT_Q_TRAIN_CHECKPOINTS_DIR}/{args.checkpoint_name}", args)
+    elif args.action == "quantize":
+        assert args.checkpoint_name is not None and args.ds_name is not None
+        quantization_report(f"{REPEAT_Q_TRAIN_CHECKPOINTS_DIR}/{args.checkpoint_name}", args)
+    elif args.action == "distillation_report":
+        assert args.checkpoint_name is not None and args.teacher_checkpoint_name is not None
+        distillation_report(f"{REPEAT_Q_TRAIN_CHECKPOINTS_DIR}/{args.teacher_checkpoint_name}",
+                            f"{REPEAT_Q_TRAIN_CHECKPOINTS_DIR}/{args.checkpoint_name}", args)
+    elif args.action == "export":
+        assert args.checkpoint_name is not None and args.ds_name is not None
+        export(f"{REPEAT_Q_TRAIN_CHECKPOINTS_DIR}/{args.checkpoint_name}", args)
+    elif args.action == "serve":
+        assert args.checkpoint_name is not None and args.ds_name is not None
+        serve(f"{REPEAT_Q_TRAIN_CHECKPOINTS_DIR}/{args.checkpoint_name}", args)
+    elif args.action == "rewrite":
+        assert args.checkpoint_name is not None and args.ds_name is not None and args.rewrite_input is not None
+        rewrite(f"{REPEAT_Q_TRAIN_CHECKPOINTS_DIR}/{args.checkpoint_name}", args,
+                args.prediction_file_name or os.path.splitext(os.path.basename(args.rewrite_input))[0])
+    elif args.action == "score":
+        assert args.checkpoint_name is not None and args.ds_name is not None
+        score(f"{REPEAT_Q_TRAIN_CHECKPOINTS_DIR}/{args.checkpoint_name}", args, args.prediction_file_name or (
+            os.path.splitext(os.path.basename(args.score_input))[0] if args.score_input is not None else args.ds_name
+        ))
+        info("Scoring completed.")
+    elif args.action == "encode_facts":
+        assert args.checkpoint_name is not None and args.ds_name is not None and args.fact_store is not None
+        encode_facts(f"{REPEAT_Q_TRAIN_CHECKPOINTS_DIR}/{args.checkpoint_name}", args)
+        info("Fact encodings computed.")
+    elif args.action == "load_test":
+        assert args.ds_name is not None
+        load_test(args)
     elif args.action == "translate":
         assert args.checkpoint_name is not None and args.ds_name is not None
+        # The int8 models only decode greedily
+        assert not args.int8 or (args.beam_search_size == 1 and args.speculative_draft_length == 0)
         if args.prediction_file_name is None:
             prediction_file_name = args.ds_name
         else:
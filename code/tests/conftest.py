@@ -0,0 +1,53 @@
+import numpy as np
+import pytest
+import tensorflow as tf
+
+from model.RepeatQ.distillation import copy_indicators
+from model.RepeatQ.model import RepeatQ
+from model.RepeatQ.model_config import ModelConfiguration
+
+VOCABULARY = {"<blank>": 0, "<unk>": 1, "?": 2, **{f"w{i}": i + 3 for i in range(60)}}
+NB_TAGS = 10
+
+
+@pytest.fixture
+def make_model():
+    """
+    Builds small models with random weights, trainable embeddings and no dropout.
+    """
+    def make(**settings):
+        config = dict(embedding_size=16, fact_encoder_hidden_size=8, decoder_hidden_size=8, decoder_readout_size=8,
+                      attention_depth=8, use_glove_embeddings=False, max_generated_question_length=7, batch_size=4,
+                      dropout_rate=0.0, attention_dropout_rate=0.0)
+        config.update(settings)
+        tf.random.set_seed(0)
+        return RepeatQ(VOCABULARY, ModelConfiguration(**config), nb_bio_tags=NB_TAGS, nb_pos_tags=NB_TAGS)
+    return make
+
+
+@pytest.fixture
+def batch():
+    """
+    A random batch with padded base questions, facts and targets, the targets copying the first base question word.
+    :return: The features, with their target copy indicators, and the targets.
+    """
+    rng = np.random.RandomState(0)
+    base_question = rng.randint(3, len(VOCABULARY), size=(4, 6)).astype(np.int32)
+    base_question[:, -2:] = 0
+    facts = rng.randint(3, len(VOCABULARY), size=(4, 2, 5)).astype(np.int32)
+    facts[:, :, -1] = 0
+    base_question_features = rng.randint(1, NB_TAGS, size=(4, 6, 2)) * (base_question[..., None] != 0)
+    facts_features = rng.randint(1, NB_TAGS, size=(4, 2, 5, 2)) * (facts[..., None] != 0)
+    target = rng.randint(3, len(VOCABULARY), size=(4, 7)).astype(np.int32)
+    target[:, 2] = base_question[:, 0]
+    target[:, -3] = VOCABULARY["?"]
+    target[:, -2:] = 0
+    features = {
+        "base_question": tf.constant(base_question),
+        "base_question_features": tf.constant(base_question_features, dtype=tf.float32),
+        "facts": tf.constant(facts),
+        "facts_features": tf.constant(facts_features, dtype=tf.float32)
+    }
+    target = tf.constant(target)
+    features["target_copy_indicator"] = copy_indicators(target, features["base_question"], features["facts"])
+    return features, target
@@ -0,0 +1,32 @@
+from model.RepeatQ.caching import LRUCache
+
+
+def test_least_recently_used_entry_is_evicted():
+    cache = LRUCache(2)
+    cache.put("a", 1)
+    cache.put("b", 2)
+    assert cache.get("a") == 1
+    cache.put("c", 3)
+    assert "b" not in cache
+    assert cache.get("a") == 1
+    assert cache.get("c") == 3
+    assert len(cache) == 2
+
+
+def test_put_refreshes_an_entry():
+    cache = LRUCache(2)
+    cache.put("a", 1)
+    cache.put("b", 2)
+    cache.put("a", 3)
+    cache.put("c", 4)
+    assert "b" not in cache
+    assert cache.get("a") == 3
+
+
+def test_hit_rate():
+    cache = LRUCache(2)
+    assert cache.hit_rate == 0.0
+    cache.put("a", 1)
+    cache.get("a")
+    assert cache.get("b", default=0) == 0
+    assert cache.hit_rate == 0.5
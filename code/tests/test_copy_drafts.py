@@ -0,0 +1,43 @@
+import numpy as np
+import tensorflow as tf
+
+from model.RepeatQ.copy_drafts import propose_copy_drafts
+
+# Copy words: [5, 6, 7, 3, 6, 9]
+BASE_QUESTION = tf.constant([[5, 6, 7]])
+FACTS = tf.constant([[[3, 6, 9]]])
+
+
+def drafts(history, position, draft_length=2):
+    return propose_copy_drafts(
+        tf.constant([history]), tf.constant([position]), BASE_QUESTION, FACTS, draft_length
+    ).numpy()[0].tolist()
+
+
+def test_first_draft_is_the_base_question():
+    assert drafts([0, 0, 0], 0) == [5, 6]
+
+
+def test_draft_continues_the_last_token():
+    assert drafts([7, 0, 0], 1) == [3, 6]
+
+
+def test_occurrences_preceded_by_the_token_before_last_are_preferred():
+    assert drafts([5, 6, 0], 2) == [7, 3]
+    assert drafts([3, 6, 0], 2) == [9, 0]
+
+
+def test_drafts_are_padded_past_the_copy_words():
+    assert drafts([9, 0, 0], 1, draft_length=3) == [0, 0, 0]
+
+
+def test_no_draft_without_candidate_span():
+    assert drafts([8, 0, 0], 1) == [0, 0]
+
+
+def test_rows_are_independent():
+    result = propose_copy_drafts(
+        tf.constant([[5, 0], [9, 0]]), tf.constant([1, 0]), tf.constant([[5, 6], [9, 8]]),
+        tf.constant([[[7, 0]], [[1, 2]]]), 2
+    )
+    np.testing.assert_array_equal(result.numpy(), [[6, 7], [9, 8]])
@@ -0,0 +1,52 @@
+import numpy as np
+import tensorflow as tf
+
+from model.RepeatQ.decoding_constraints import banned_tokens_mask, write_step
+
+VOCAB_SIZE = 10
+
+
+def banned(history, step, **constraints):
+    mask = banned_tokens_mask(tf.constant(history, dtype=tf.int32), tf.constant(step), VOCAB_SIZE, **constraints)
+    return [sorted(np.flatnonzero(row).tolist()) for row in mask.numpy()]
+
+
+def test_no_constraints_bans_nothing():
+    assert banned([[5, 6, 5, 0]], 3) == [[]]
+
+
+def test_repeated_ngram_is_banned():
+    # "5 6" was generated, so 6 can't follow 5 again
+    assert banned([[5, 6, 7, 5, 0, 0]], 4, no_repeat_ngram_size=2) == [[6]]
+
+
+def test_ngrams_must_be_generated_already():
+    # The history beyond the step isn't generated yet
+    assert banned([[5, 6, 7, 8, 7, 9]], 3, no_repeat_ngram_size=2) == [[]]
+
+
+def test_adjacent_duplicate_words_are_banned():
+    assert banned([[4, 0, 0]], 1, max_adjacent_duplicate_size=1) == [[4]]
+
+
+def test_adjacent_duplicate_ngrams_are_banned():
+    # "3 4 3" followed by 4 duplicates "3 4", and followed by 3 duplicates "3"
+    assert banned([[3, 4, 3, 0, 0]], 3, max_adjacent_duplicate_size=2) == [[3, 4]]
+
+
+def test_steps_per_row():
+    history = [[5, 6, 5, 0, 0], [5, 6, 5, 0, 0]]
+    assert banned(history, [3, 2], no_repeat_ngram_size=2) == [[6], []]
+
+
+def test_nothing_is_banned_before_the_first_step():
+    assert banned([[0, 0, 0]], 0, no_repeat_ngram_size=2, max_adjacent_duplicate_size=2) == [[]]
+
+
+def test_padding_is_never_banned():
+    assert banned([[0, 0, 0, 0]], 2, no_repeat_ngram_size=1, max_adjacent_duplicate_size=1) == [[]]
+
+
+def test_write_step():
+    history = write_step(tf.zeros((2, 3), dtype=tf.int32), tf.constant([0, 2]), tf.constant([7, 8]))
+    np.testing.assert_array_equal(history.numpy(), [[7, 0, 0], [0, 0, 8]])
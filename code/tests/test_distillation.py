@@ -0,0 +1,26 @@
+import numpy as np
+import tensorflow as tf
+
+from model.RepeatQ.distillation import copy_indicators, soft_cross_entropy
+
+
+def test_copy_indicators():
+    # Copy words: [5, 6, 6, 7, 7, 8], the base question followed by 2 facts of 2 words
+    base_question = tf.constant([[5, 6]])
+    facts = tf.constant([[[6, 7], [7, 8]]])
+    target = tf.constant([[5, 6, 7, 9, 0]])
+    indicators = copy_indicators(target, base_question, facts)
+    # 6 and 7 are copied from the last fact containing them, 9 and the padding can't be copied
+    np.testing.assert_array_equal(indicators.numpy(), [[0, 2, 4, -1, -1]])
+
+
+def test_copy_indicators_use_the_first_occurrence():
+    indicators = copy_indicators(tf.constant([[7, 3]]), tf.constant([[3, 3]]), tf.constant([[[7, 7]]]))
+    np.testing.assert_array_equal(indicators.numpy(), [[2, 0]])
+
+
+def test_soft_cross_entropy_is_minimal_for_the_teacher_distributions():
+    teacher = tf.constant([[[0.7, 0.2, 0.1], [0.1, 0.1, 0.8]]])
+    student = tf.constant([[[0.2, 0.4, 0.4], [0.3, 0.3, 0.4]]])
+    target = tf.constant([[1, 2]])
+    assert float(soft_cross_entropy(teacher, teacher, target)) < float(soft_cross_entropy(teacher, student, target))
@@ -0,0 +1,69 @@
+import numpy as np
+import pytest
+import tensorflow as tf
+
+from model.RepeatQ.fact_store import FactEncodingStore
+
+
+@pytest.fixture
+def checkpoint(make_model, batch, tmp_path):
+    """
+    :return: A model and the path of its checkpoint.
+    """
+    model = make_model()
+    model.decode(batch[0])
+    model_dir = str(tmp_path / "checkpoint")
+    model.save_weights(model_dir)
+    return model, model_dir
+
+
+def fact_corpus(batch):
+    features, _ = batch
+    facts = features["facts"].numpy().reshape((-1, 5))
+    facts_features = features["facts_features"].numpy().reshape((-1, 5, 2))
+    return facts, facts_features
+
+
+def encodings(model, fact, fact_features):
+    length = len(np.trim_zeros(fact, 'b'))
+    return model.encode_facts(
+        tf.constant(fact[None, None, :length]), tf.constant(fact_features[None, None, :length]), training=False
+    ).numpy()[0, 0]
+
+
+def test_write_and_read(checkpoint, batch, tmp_path):
+    model, model_dir = checkpoint
+    facts, facts_features = fact_corpus(batch)
+    path = str(tmp_path / "store")
+    FactEncodingStore.write(path, model, model_dir, facts, facts_features, batch_size=3)
+    store = FactEncodingStore(path, model_dir)
+    assert len(store) == len(facts)
+    for fact, fact_features in zip(facts, facts_features):
+        # Padded and unpadded facts share their encodings
+        stored = store.get(np.trim_zeros(fact, 'b'), fact_features)
+        np.testing.assert_allclose(stored, encodings(model, fact, fact_features), atol=1e-5)
+    assert store.get(np.array([3, 4]), np.ones((2, 2), dtype=np.float32)) is None
+    assert store.hit_rate == len(facts) / (len(facts) + 1)
+
+
+def test_float16_store(checkpoint, batch, tmp_path):
+    model, model_dir = checkpoint
+    facts, facts_features = fact_corpus(batch)
+    path = str(tmp_path / "store")
+    FactEncodingStore.write(path, model, model_dir, facts, facts_features, float16=True)
+    store = FactEncodingStore(path)
+    stored = store.get(facts[0], facts_features[0])
+    assert stored.dtype == np.float16
+    np.testing.assert_allclose(stored, encodings(model, facts[0], facts_features[0]), atol=1e-2)
+
+
+def test_store_of_another_checkpoint(checkpoint, batch, tmp_path):
+    model, model_dir = checkpoint
+    facts, facts_features = fact_corpus(batch)
+    path = str(tmp_path / "store")
+    FactEncodingStore.write(path, model, model_dir, facts, facts_features)
+    other_dir = str(tmp_path / "other_checkpoint")
+    model.embedding_layer.trainable_variables[0].assign_add(tf.ones_like(model.embedding_layer.trainable_variables[0]))
+    model.save_weights(other_dir)
+    with pytest.raises(ValueError):
+        FactEncodingStore(path, other_dir)
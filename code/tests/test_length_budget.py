@@ -0,0 +1,63 @@
+import numpy as np
+import pytest
+
+from data_processing.class_defs import RepeatQExample
+from model.RepeatQ.length_budget import fit_length_budget, compute_length_budgets, length_budget_report, \
+    save_length_budget, load_length_budget
+
+
+def example(question_length, fact_lengths, target_length, padding=2):
+    """
+    :return: An example with padded base question, facts and target of the given lengths.
+    """
+    facts = np.zeros((len(fact_lengths), max(fact_lengths) + padding), dtype=np.int32)
+    for i, length in enumerate(fact_lengths):
+        facts[i, :length] = 5
+    return RepeatQExample(
+        base_question=np.pad(np.full(question_length, 3), (0, padding)),
+        base_question_features=None,
+        facts=facts,
+        facts_features=None,
+        rephrased_question=np.pad(np.full(target_length, 4), (0, padding)),
+        is_synthetic_data=False
+    )
+
+
+def test_heuristic_budget_covers_the_targets():
+    examples = [example(3, [4, 2], 5), example(2, [6], 10), example(4, [1], 3)]
+    coefficients = fit_length_budget(examples, mode="heuristic", coverage=1.0)
+    # Residuals of the targets are -2, 2 and -2
+    assert coefficients == (1.0, 1.0, 2.0)
+    np.testing.assert_array_equal(compute_length_budgets(examples, coefficients, max_length=50), [9, 10, 7])
+
+
+def test_linear_budget_fits_the_lengths():
+    # Targets of 2 * question length + fact length / 2 + 1 words
+    examples = [example(q, [f], 2 * q + f // 2 + 1) for q, f in ((2, 4), (3, 2), (5, 6), (7, 2))]
+    question_coefficient, fact_coefficient, intercept = fit_length_budget(examples, mode="linear", coverage=0.5)
+    assert question_coefficient == pytest.approx(2.0)
+    assert fact_coefficient == pytest.approx(0.5)
+    assert intercept == pytest.approx(1.0)
+
+
+def test_budgets_are_clipped():
+    examples = [example(1, [1], 1), example(30, [30], 1)]
+    np.testing.assert_array_equal(compute_length_budgets(examples, (1.0, 1.0, -5.0), max_length=20), [1, 20])
+
+
+def test_report():
+    examples = [example(3, [4], 5), example(2, [6], 10)]
+    truncation_rate, mean_budget = length_budget_report(examples, (1.0, 1.0, 0.0), max_length=50)
+    assert truncation_rate == 0.5
+    assert mean_budget == 7.5
+
+
+def test_unknown_mode():
+    with pytest.raises(ValueError):
+        fit_length_budget([example(1, [1], 1)], mode="quadratic")
+
+
+def test_save_and_load(tmp_path):
+    path = str(tmp_path / "length_budget.json")
+    save_length_budget(path, (1.5, 0.25, 3.0))
+    assert load_length_budget(path) == (1.5, 0.25, 3.0)
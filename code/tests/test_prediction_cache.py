@@ -0,0 +1,70 @@
+import itertools
+
+import numpy as np
+import pytest
+
+from model.RepeatQ import prediction_cache
+from model.RepeatQ.prediction_cache import PredictionCache, input_key, checkpoint_hash
+
+SETTINGS = {"beam_search_size": 1, "no_repeat_ngram_size": 0}
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """
+    Makes every access of the cache happen one second after the previous one.
+    """
+    ticks = itertools.count()
+    monkeypatch.setattr(prediction_cache.time, "time", lambda: float(next(ticks)))
+
+
+def test_get_and_put(tmp_path):
+    cache = PredictionCache(str(tmp_path / "cache.sqlite"), "checkpoint", SETTINGS)
+    assert cache.get("a") is None
+    cache.put("a", "what is it ?")
+    assert cache.get("a") == "what is it ?"
+    assert cache.get_many(["a", "b"]) == {"a": "what is it ?"}
+    assert (cache.hits, cache.misses) == (2, 2)
+
+
+def test_least_recently_used_entries_are_evicted(tmp_path, clock):
+    cache = PredictionCache(str(tmp_path / "cache.sqlite"), "checkpoint", SETTINGS, max_entries=2)
+    cache.put_many({"a": "1", "b": "2"})
+    assert cache.get("a") == "1"
+    cache.put("c", "3")
+    assert cache.get_many(["a", "b", "c"]) == {"a": "1", "c": "3"}
+
+
+def test_entries_are_namespaced_by_checkpoint_and_settings(tmp_path):
+    path = str(tmp_path / "cache.sqlite")
+    PredictionCache(path, "checkpoint", SETTINGS).put("a", "1")
+    assert PredictionCache(path, "checkpoint", dict(SETTINGS)).get("a") == "1"
+    assert PredictionCache(path, "other checkpoint", SETTINGS).get("a") is None
+    assert PredictionCache(path, "checkpoint", {**SETTINGS, "beam_search_size": 5}).get("a") is None
+
+
+def test_input_key_ignores_padding():
+    question, facts = [4, 5, 6], [[7, 8], [9, 3]]
+    question_features, facts_features = np.ones((3, 2)), [np.ones((2, 2)), 2 * np.ones((2, 2))]
+    key = input_key(question, question_features, facts, facts_features)
+    padded_key = input_key(
+        question + [0, 0], np.pad(question_features, ((0, 2), (0, 0))), [f + [0] for f in facts] + [[0, 0, 0]],
+        [np.pad(f, ((0, 1), (0, 0))) for f in facts_features] + [np.zeros((3, 2))]
+    )
+    assert key == padded_key
+    assert key != input_key(question, question_features, facts[:1], facts_features[:1])
+    assert key != input_key(question, 2 * question_features, facts, facts_features)
+
+
+def test_checkpoint_hash(tmp_path):
+    model_dir = str(tmp_path / "checkpoint")
+    with open(f"{model_dir}.index", mode='wb') as f:
+        f.write(b"index")
+    with open(f"{model_dir}.data-00000-of-00001", mode='wb') as f:
+        f.write(b"weights")
+    digest = checkpoint_hash(model_dir)
+    with open(f"{model_dir}.data-00000-of-00001", mode='wb') as f:
+        f.write(b"other weights")
+    assert checkpoint_hash(model_dir) != digest
+    with pytest.raises(ValueError):
+        checkpoint_hash(str(tmp_path / "missing"))
@@ -0,0 +1,36 @@
+import numpy as np
+import pytest
+
+from model.RepeatQ.pruning import polynomial_sparsity, kept_units, block_mask
+
+
+def test_polynomial_sparsity():
+    assert polynomial_sparsity(0.5, 0, 4) == 0.0
+    assert 0.25 < polynomial_sparsity(0.5, 1, 4) < polynomial_sparsity(0.5, 2, 4) < 0.5
+    assert polynomial_sparsity(0.5, 4, 4) == pytest.approx(0.5)
+    assert polynomial_sparsity(0.5, 6, 4) == pytest.approx(0.5)
+
+
+def test_kept_units():
+    scores = np.array([0.1, 0.5, 0.3, 0.9])
+    np.testing.assert_array_equal(kept_units(scores, 0.5), [1, 3])
+    np.testing.assert_array_equal(kept_units(scores, 0.0), [0, 1, 2, 3])
+    # At least one unit is kept
+    np.testing.assert_array_equal(kept_units(scores, 1.0), [3])
+
+
+def test_block_mask_zeroes_the_smallest_blocks():
+    weights = np.array([[1.0, 0.1], [1.0, 0.1], [0.1, 1.0], [0.1, 1.0]])
+    mask = block_mask(weights, 0.5, block_size=2)
+    np.testing.assert_array_equal(mask, [[1, 0], [1, 0], [0, 1], [0, 1]])
+    assert mask.dtype == np.float32
+
+
+def test_block_mask_with_a_partial_block():
+    weights = np.array([[1.0], [1.0], [0.1], [0.1], [5.0]])
+    mask = block_mask(weights, 0.5, block_size=2)
+    np.testing.assert_array_equal(mask, [[1], [1], [0], [0], [1]])
+
+
+def test_block_mask_without_sparsity():
+    np.testing.assert_array_equal(block_mask(np.ones((3, 2)), 0.0, block_size=2), np.ones((3, 2)))
@@ -0,0 +1,25 @@
+import numpy as np
+import pytest
+
+from model.RepeatQ.scoring import score_batch, loss_parity
+
+
+@pytest.mark.parametrize("fused_output_head", [False, True])
+def test_scores_match_the_training_loss(make_model, batch, fused_output_head):
+    model = make_model(fused_output_head=fused_output_head)
+    features, target = batch
+    mean_negative_log_prob, loss = loss_parity(model, features, target)
+    assert mean_negative_log_prob == pytest.approx(loss, rel=1e-4)
+
+
+def test_scores_of_each_target(make_model, batch):
+    model = make_model()
+    features, target = batch
+    token_log_probs, log_probs = score_batch(model, features, target)
+    token_log_probs = token_log_probs.numpy()
+    assert np.all(token_log_probs[target.numpy() == 0] == 0.0)
+    assert np.all(token_log_probs[target.numpy() != 0] < 0.0)
+    np.testing.assert_allclose(log_probs.numpy(), token_log_probs.sum(axis=-1), rtol=1e-5)
+    # Targets are scored independently of the other rows of the batch
+    _, first_log_prob = score_batch(model, {name: value[:1] for name, value in features.items()}, target[:1])
+    assert float(first_log_prob[0]) == pytest.approx(float(log_probs[0]), rel=1e-4)
@@ -0,0 +1,40 @@
+import numpy as np
+import tensorflow as tf
+
+from model.RepeatQ.shortlist import batch_shortlist_ids, sampled_softmax_ids, shortlist_positions
+
+BASE_QUESTION = tf.constant([[5, 1, 0]])
+FACTS = tf.constant([[[7, 0], [12, 5]]])
+
+
+def test_shortlist_holds_the_frequent_and_batch_words():
+    ids = batch_shortlist_ids(3, BASE_QUESTION, FACTS)
+    np.testing.assert_array_equal(ids.numpy(), [0, 1, 2, 5, 7, 12])
+
+
+def test_shortlist_with_candidates_and_target():
+    candidate_table = np.zeros((20, 2), dtype=np.int32)
+    candidate_table[5] = [15, 16]
+    ids = batch_shortlist_ids(2, BASE_QUESTION, FACTS, candidate_table=tf.constant(candidate_table),
+                              target=tf.constant([[18, 0]]))
+    np.testing.assert_array_equal(ids.numpy(), [0, 1, 5, 7, 12, 15, 16, 18])
+
+
+def test_shortlist_positions():
+    positions = shortlist_positions(tf.constant([1, 4]), 6)
+    np.testing.assert_array_equal(positions.numpy(), [-1, 0, -1, -1, 1, -1])
+
+
+def test_sampled_softmax_ids():
+    tf.random.set_seed(0)
+    target = tf.constant([[40, 2, 0]])
+    ids, corrections = sampled_softmax_ids(10, 50, BASE_QUESTION, FACTS, target)
+    ids, corrections = ids.numpy(), corrections.numpy()
+    batch_ids = [0, 1, 2, 5, 7, 12, 40]
+    assert np.all(np.diff(ids) > 0)
+    assert set(batch_ids) <= set(ids.tolist())
+    assert len(ids) >= 10
+    # Batch words are always in the sample, the sampled negatives have an expected count of at most 1
+    is_batch_id = np.isin(ids, batch_ids)
+    np.testing.assert_array_equal(corrections[is_batch_id], 0.0)
+    assert np.all(corrections[~is_batch_id] <= 0.0)
@@ -0,0 +1,40 @@
+import numpy as np
+import tensorflow as tf
+
+from model.RepeatQ.tracing import bucket_length, pad_to_length, remap_copy_indicators, batch_sizes, \
+    decoding_signature
+
+
+def test_bucket_length():
+    assert bucket_length(10, (16, 32)) == 16
+    assert bucket_length(16, (32, 16)) == 16
+    assert bucket_length(20, (16, 32)) == 32
+    # Lengths above the largest bucket are rounded up to a multiple of it
+    assert bucket_length(33, (16, 32)) == 64
+    assert bucket_length(10, ()) == 10
+
+
+def test_pad_to_length():
+    np.testing.assert_array_equal(pad_to_length([[1, 2]], 4), [[1, 2, 0, 0]])
+    np.testing.assert_array_equal(pad_to_length([[1], [2]], 3, axis=0), [[1], [2], [0]])
+
+
+def test_remap_copy_indicators():
+    # Base question of 2 words and facts of 3 words, padded to 4 and 5 words
+    remapped = remap_copy_indicators([-1, 1, 2, 4, 5], question_length=2, fact_length=3, bucketed_question_length=4,
+                                     bucketed_fact_length=5)
+    np.testing.assert_array_equal(remapped, [-1, 1, 4, 6, 9])
+
+
+def test_batch_sizes():
+    assert batch_sizes(10, 4, drop_remainder=False) == [4, 2]
+    assert batch_sizes(10, 4, drop_remainder=True) == [4]
+    assert batch_sizes(8, 4, drop_remainder=False) == [4]
+    assert batch_sizes(3, 4, drop_remainder=False) == [3]
+
+
+def test_decoding_signature(batch):
+    features, _ = batch
+    signature = decoding_signature(features)
+    assert [spec.name for spec in signature] == ["base_question", "base_question_features", "facts", "facts_features"]
+    assert signature[2] == tf.TensorSpec((4, 2, 5), dtype=tf.int32, name="facts")